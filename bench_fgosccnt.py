@@ -0,0 +1,162 @@
+# pytest-benchmark による ScreenShot の性能計測
+#
+# synthetic.py で合成したスクショを使うので、実際のスクショやアイテム画像は要らない
+# ファイル名が test_ で始まらないので通常の pytest では集められない。明示して実行する
+#
+#   pytest bench_fgosccnt.py
+#   pytest bench_fgosccnt.py --benchmark-json=bench.json    (CI で記録する場合)
+#   pytest bench_fgosccnt.py -k stage                       (段階ごとの計測だけ)
+#   pytest bench_fgosccnt.py -k warm                        (キャッシュが効く場合だけ)
+import argparse
+import logging
+
+import numpy as np
+import pytest  # type: ignore
+
+import fgosccnt
+import pageinfo
+import synthetic
+
+pytest.importorskip("pytest_benchmark")
+
+# (mode, size, chestnum, pagenum, bonus_rate)
+SCREENS = [
+    ("jp", (1920, 1080), 20, 1, 0),
+    ("jp", (1920, 1080), 30, 2, 0.3),
+    ("jp", (1920, 1080), 97, 5, 0.3),
+    ("na", (1920, 1080), 30, 2, 0.3),
+    ("na", (1920, 1080), 62, 3, 0),
+    ("jp", (1280, 720), 30, 1, 0.3),
+    ("jp", (2532, 1170), 62, 3, 0.3),
+    ("na", (2048, 1536), 30, 1, 0.3),
+    ("jp", (2400, 1080), 90, 4, 0.3),
+]
+STAGES = ["frame", "pageinfo", "qp_region", "items"]
+# キャッシュを空にしてから1回ずつ計測する回数
+ROUNDS = 5
+
+
+def screen_id(screen):
+    mode, (width, height), chestnum, pagenum, bonus_rate = screen
+    bonus = "-bonus" if bonus_rate else ""
+    return f"{mode}-{width}x{height}-{chestnum}-p{pagenum}{bonus}"
+
+
+@pytest.fixture(scope="module")
+def env(tmp_path_factory):
+    """新規アイテムを一時フォルダと読み直したカタログに登録する認識の環境"""
+    tmpdir = tmp_path_factory.mktemp("bench")
+    with pytest.MonkeyPatch.context() as mp:
+        for name in ("Item_dir", "CE_dir", "Point_dir"):
+            path = tmpdir / name
+            path.mkdir()
+            mp.setattr(fgosccnt, name, path)
+        mp.setattr(fgosccnt, "_catalog", fgosccnt.Catalog.load(fgosccnt.catalog_snapshot_file))
+        # 合成画像なので認識の警告は出さない
+        level = fgosccnt.logger.level
+        fgosccnt.logger.setLevel(logging.CRITICAL)
+        try:
+            yield {
+                "args": argparse.Namespace(lang=fgosccnt.DEFAULT_ITEM_LANG),
+                "models": fgosccnt.get_models().load_all(),
+                "logger": fgosccnt.CustomAdapter(fgosccnt.logger, {"target": "bench"}),
+                "screens": {},
+            }
+        finally:
+            fgosccnt.logger.setLevel(level)
+
+
+def recognize(env, img):
+    return fgosccnt.ScreenShot(env["args"], img, env["models"], ".png", env["logger"])
+
+
+def clear_caches():
+    """スクショをまたぐキャッシュを空にする (キャッシュが無いときの処理を計測する)"""
+    fgosccnt.get_stack_cache().clear()
+    fgosccnt.get_tile_cache().clear()
+    fgosccnt.get_screen_memo().start(object())
+
+
+def cold(benchmark, func, *args):
+    """clear_caches() してから func を1回呼ぶ計測を ROUNDS 回行う"""
+    return benchmark.pedantic(func, args=args, setup=clear_caches, rounds=ROUNDS)
+
+
+def get_screen(env, screen):
+    """合成したスクショ・正解と、一度認識した ScreenShot
+    一度目は新規アイテムの登録が入るので、計測の前に済ませておく
+    """
+    if screen not in env["screens"]:
+        mode, size, chestnum, pagenum, bonus_rate = screen
+        rng = np.random.default_rng(0)
+        img, truth = synthetic.random_screen(
+            rng, chestnum, pagenum, mode, size, bonus_rate=bonus_rate
+        )
+        env["screens"][screen] = (img, truth, recognize(env, img))
+    return env["screens"][screen]
+
+
+def recognize_items(env, sc, mode):
+    """ScreenShot が切り出したアイテム画像を Item で認識し直す"""
+    priority = fgosccnt.PRIORITY_REWARD_QP
+    prev_item = None
+    for item in sc.items:
+        prev_item = fgosccnt.Item(
+            env["args"],
+            item.position,
+            prev_item,
+            item.img_rgb,
+            item.img_gray,
+            env["models"],
+            ".png",
+            priority,
+            env["logger"],
+            mode,
+        )
+        priority = fgosccnt.catalog.item_dropPriority[prev_item.id]
+
+
+def run_stage(env, stage, img, sc, mode):
+    if stage == "frame":
+        return fgosccnt.get_coodinates(img)
+    if stage == "pageinfo":
+        return pageinfo.guess_pageinfo(img, next_button=env["models"].template("next"))
+    if stage == "qp_region":
+        return pageinfo.detect_qp_region(img, mode)
+    if stage == "items":
+        return recognize_items(env, sc, mode)
+    raise ValueError(stage)
+
+
+@pytest.mark.parametrize("screen", SCREENS, ids=screen_id)
+def test_screenshot(benchmark, env, screen):
+    img, truth, _ = get_screen(env, screen)
+    benchmark.group = "screenshot"
+    sc = cold(benchmark, recognize, env, img)
+    # 読み違えると処理の経路が変わるので、正しく読めていることも確かめる
+    assert (sc.chestnum, sc.pagenum, sc.pages, sc.lines) == (
+        truth["chestnum"],
+        truth["pagenum"],
+        truth["pages"],
+        truth["lines"],
+    )
+    assert len(sc.itemlist) == len(truth["items"])
+
+
+@pytest.mark.parametrize("screen", SCREENS, ids=screen_id)
+@pytest.mark.parametrize("stage", STAGES)
+def test_stage(benchmark, env, stage, screen):
+    img, truth, sc = get_screen(env, screen)
+    benchmark.group = "stage: " + stage
+    cold(benchmark, run_stage, env, stage, img, sc, truth["mode"])
+
+
+@pytest.mark.parametrize("screen", SCREENS, ids=screen_id)
+def test_screenshot_warm(benchmark, env, screen):
+    """同じアイテムのスクショを続けて認識したとき (キャッシュが効く場合)"""
+    img, truth, _ = get_screen(env, screen)
+    recognize(env, img)
+    benchmark.group = "screenshot (warm)"
+    sc = benchmark(recognize, env, img)
+    assert len(sc.itemlist) == len(truth["items"])
+    assert sc.cache_stats["stack_hit"] > 0 and sc.cache_stats["tile_hit"] > 0
@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+# 認識処理の性能計測用スクリプト
+# 実際のスクショやカタログが無くても計測できるよう、必要なデータは合成して使う
+import argparse
+import logging
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+import fgosccnt
+import pageinfo
+
+logger = logging.getLogger(__name__)
+
+
+def random_hex(rng):
+    return f"{rng.getrandbits(64):016x}"
+
+
+def flip_bits(hexstr, nbits, rng):
+    """pHash の nbits ビットを反転させたものを返す"""
+    value = int(hexstr, 16)
+    for bit in rng.sample(range(64), nbits):
+        value ^= 1 << bit
+    return f"{value:016x}"
+
+
+def make_catalog(size, rng, duplicate_rate=0.05):
+    """{pHash: id} の合成カタログ
+    実データ同様、一部の id は複数の pHash を持つ
+    """
+    catalog = {}
+    ids = []
+    for i in range(size):
+        if ids and rng.random() < duplicate_rate:
+            itemid = rng.choice(ids)
+        else:
+            itemid = 9400000 + i
+            ids.append(itemid)
+        catalog[random_hex(rng)] = itemid
+    return catalog
+
+
+def make_queries(catalog, n, rng):
+    """カタログのどれかに近いものと無関係なものを混ぜた検索用 pHash"""
+    keys = list(catalog)
+    queries = []
+    for i in range(n):
+        if i % 4 == 3:
+            hexstr = random_hex(rng)
+        else:
+            hexstr = flip_bits(rng.choice(keys), rng.randint(0, 12), rng)
+        queries.append(fgosccnt.hex2hash(hexstr))
+    return queries
+
+
+def timeit(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def legacy_search(hash_item, dist_dic, threshold):
+    """HashIndex 導入前の classify_ce_sub と同じ比較ループ"""
+    itemfiles = {}
+    for i in dist_dic.keys():
+        d = fgosccnt.hasher.compare(hash_item, fgosccnt.hex2hash(i))
+        if d <= threshold:
+            itemfiles[dist_dic[i]] = d
+    return [(k, int(v)) for k, v in sorted(itemfiles.items(), key=lambda x: x[1])]
+
+
+def bench_hashindex(args):
+    rng = random.Random(args.seed)
+    catalog = make_catalog(args.size, rng)
+    queries = make_queries(catalog, args.queries, rng)
+
+    start = time.perf_counter()
+    index = fgosccnt.HashIndex(catalog.items())
+    build = time.perf_counter() - start
+
+    t_legacy, expected = timeit(
+        lambda: [legacy_search(q, catalog, args.threshold) for q in queries],
+        args.repeat,
+    )
+    t_index, actual = timeit(
+        lambda: [index.search(q, args.threshold) for q in queries],
+        args.repeat,
+    )
+    if actual != expected:
+        raise AssertionError("HashIndex returned different results from the loop")
+
+    n = len(queries)
+    print(f"catalog size: {len(catalog)}, queries: {n}, threshold: {args.threshold}")
+    print(f"index build: {build * 1000:.2f} ms")
+    print(f"loop:        {t_legacy / n * 1e6:10.1f} us/query")
+    print(f"HashIndex:   {t_index / n * 1e6:10.1f} us/query")
+    print(f"speedup:     {t_legacy / t_index:10.1f} x (results identical)")
+
+
+def bench_ce_scaling(args):
+    rng = random.Random(args.seed)
+    n = args.queries
+    print(f"queries: {n} near + {n} miss, threshold: {args.threshold}  (us/query)")
+    print(
+        f"{'size':>8} {'build(ms)':>10} {'loop':>10} "
+        f"{'linear':>8} {'mih':>8} {'linear(miss)':>13} {'mih(miss)':>10}"
+    )
+    for size in args.sizes:
+        # CE で同じ id が複数の pHash を持つのはローカルファイルと重複した場合のみ
+        catalog = make_catalog(size, rng, duplicate_rate=0.001)
+        keys = list(catalog)
+        near = [
+            fgosccnt.hex2hash(flip_bits(rng.choice(keys), rng.randint(0, 6), rng))
+            for _ in range(n)
+        ]
+        miss = [fgosccnt.hex2hash(random_hex(rng)) for _ in range(n)]
+
+        linear = fgosccnt.HashIndex(catalog.items())
+        start = time.perf_counter()
+        mih = fgosccnt.MultiIndexHash(catalog.items())
+        build = time.perf_counter() - start
+
+        row = []
+        for queries in (near, miss):
+            t_linear, expected = timeit(
+                lambda: [linear.nearest(q, args.threshold) for q in queries],
+                args.repeat,
+            )
+            t_mih, actual = timeit(
+                lambda: [mih.nearest(q, args.threshold) for q in queries],
+                args.repeat,
+            )
+            if actual != expected:
+                raise AssertionError(f"MultiIndexHash differs from HashIndex ({size=})")
+            row.append((t_linear / n * 1e6, t_mih / n * 1e6))
+        loop = "-"
+        if size <= args.loop_limit:
+            t_loop, legacy = timeit(
+                lambda: [legacy_search(q, catalog, args.threshold) for q in near],
+                1,
+            )
+            legacy = [found[0] if found else None for found in legacy]
+            if legacy != [linear.nearest(q, args.threshold) for q in near]:
+                raise AssertionError(f"HashIndex differs from the loop ({size=})")
+            loop = f"{t_loop / n * 1e6:.1f}"
+        print(
+            f"{size:>8} {build * 1000:>10.1f} {loop:>10} "
+            f"{row[0][0]:>8.1f} {row[0][1]:>8.1f} {row[1][0]:>13.1f} {row[1][1]:>10.1f}"
+        )
+
+
+def bench_startup(args):
+    catalog = fgosccnt.Catalog
+    t_signature, _ = timeit(catalog.source_signature, args.repeat)
+    t_json, _ = timeit(catalog.from_json, args.repeat)
+    t_compile, _ = timeit(lambda: catalog.from_json().compile(), args.repeat)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        snapshot = Path(tmpdir) / "catalog.pickle"
+        t_build, _ = timeit(lambda: catalog.load(snapshot), 1)
+        t_snapshot, loaded = timeit(lambda: catalog.load(snapshot), args.repeat)
+        size = snapshot.stat().st_size
+    if vars(loaded).keys() != vars(catalog.from_json()).keys():
+        raise AssertionError("snapshot differs from the JSON catalog")
+
+    def run_python(code):
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=fgosccnt.basedir)
+
+    t_import, _ = timeit(lambda: run_python("import fgosccnt"), args.repeat)
+    t_catalog, _ = timeit(
+        lambda: run_python("import fgosccnt; fgosccnt.get_catalog()"),
+        args.repeat,
+    )
+
+    catalog_size = len(loaded.item_name)
+    print(f"items: {catalog_size}, free quests: {len(loaded.freequest)}")
+    print(f"JSON parse + dicts:         {t_json * 1000:8.1f} ms  (before)")
+    print(f"  + HashIndex build:        {t_compile * 1000:8.1f} ms")
+    print(f"snapshot first build:       {t_build * 1000:8.1f} ms  ({size / 1024:.0f} KiB)")
+    print(f"snapshot load:              {t_snapshot * 1000:8.1f} ms  (after)")
+    print(f"  of which source stat:     {t_signature * 1000:8.1f} ms")
+    print(f"process: import fgosccnt:    {t_import * 1000:8.1f} ms")
+    print(f"process: + get_catalog():    {t_catalog * 1000:8.1f} ms")
+
+
+def make_glyphs(n, rng):
+    """ドロップ数の1文字を模した画像"""
+    glyphs = []
+    for _ in range(n):
+        img = np.zeros((28, 20), dtype=np.uint8)
+        cv2.putText(
+            img,
+            rng.choice("0123456789+x"),
+            (2, 24),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.7 + rng.random() * 0.2,
+            255,
+            2,
+        )
+        glyphs.append(img)
+    return glyphs
+
+
+def legacy_predict(svm, imgs):
+    """HogOcr 導入前の read_char() と同じく、1文字ずつ HOG を作って predict する"""
+    results = []
+    for img in imgs:
+        tmpimg = cv2.resize(img, (120, 60))
+        hog = cv2.HOGDescriptor((120, 60), (16, 16), (4, 4), (4, 4), 9)
+        pred = svm.predict(np.array([hog.compute(tmpimg)]))
+        results.append(int(pred[1][0][0]))
+    return results
+
+
+def bench_ocr(args):
+    model = fgosccnt.basedir / args.model
+    if not model.is_file():
+        raise SystemExit(f"{model} not found (run makeitem.py etc. first)")
+    svm = cv2.ml.SVM_load(str(model))
+    rng = random.Random(args.seed)
+    ocr = fgosccnt.HogOcr()
+    predictor = ocr.predictor(svm)
+    print(f"model: {args.model}, linear: {predictor.linear}  (us/glyph)")
+    print(f"{'batch':>6} {'legacy':>10} {'HogOcr':>10} {'speedup':>8}")
+    for batch in args.batches:
+        glyphs = make_glyphs(batch * args.rounds, rng)
+        chunks = [glyphs[k : k + batch] for k in range(0, len(glyphs), batch)]
+        t_legacy, expected = timeit(
+            lambda: [legacy_predict(svm, chunk) for chunk in chunks], args.repeat
+        )
+        t_ocr, actual = timeit(
+            lambda: [ocr.predict(svm, chunk) for chunk in chunks], args.repeat
+        )
+        if actual != expected:
+            raise AssertionError("HogOcr returned different labels")
+        n = len(glyphs)
+        print(
+            f"{batch:>6} {t_legacy / n * 1e6:>10.0f} {t_ocr / n * 1e6:>10.0f} "
+            f"{t_legacy / t_ocr:>7.1f}x"
+        )
+
+
+def make_screenshot(width, height, rng, text=0):
+    """ゲーム画面の枠 (幅:高さ = 1.82:1 の暗い線) を持つ合成スクショ
+    get_coodinates() を通るので、中身は乱数でも ScreenShot の処理は最後まで進む
+    text を指定すると枠の中に暗い数字を散らして輪郭の多い画面にする
+    """
+    img = rng.integers(60, 255, (height, width, 3), dtype=np.uint8)
+    frame_width = width - 40
+    frame_height = int(frame_width / 1.82)
+    if frame_height > height * 0.8:
+        # 横長のスマホでは高さに合わせる
+        frame_height = int(height * 0.8)
+        frame_width = int(frame_height * 1.82)
+    left = (width - frame_width) // 2
+    top = (height - frame_height) // 2
+    cv2.rectangle(
+        img, (left, top), (left + frame_width, top + frame_height), (0, 0, 0), 4
+    )
+    # 数字は最大で幅 fontscale * 70px、高さ fontscale * 25px 程度
+    fontscale = frame_height / 600
+    for _ in range(text):
+        x = int(rng.integers(left + frame_width // 20, left + frame_width * 8 // 10))
+        y = int(rng.integers(top + frame_height // 10, top + frame_height * 9 // 10))
+        cv2.putText(
+            img,
+            str(int(rng.integers(0, 1000))),
+            (x, y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            fontscale * float(rng.uniform(0.5, 2.0)),
+            (0, 0, 0),
+            2,
+        )
+    return img
+
+
+def find_frame_fullres(img):
+    """縮小して探す前の get_coodinates(): 元の解像度の画像全体で輪郭を探す"""
+    height, width = img.shape[:2]
+    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    _, inv = cv2.threshold(img_gray, 30, 255, cv2.THRESH_BINARY_INV)
+    rect = fgosccnt.find_frame(inv, height, width)
+    if rect is None:
+        raise ValueError("Game screen not found.")
+    x, y, width, height = rect
+    return ((x, y), (x + width, y + height))
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def bench_screenshot(args):
+    rng = np.random.default_rng(args.seed)
+    models = fgosccnt.get_models().load_all()
+    ns = argparse.Namespace(lang=fgosccnt.DEFAULT_ITEM_LANG)
+    exLogger = fgosccnt.CustomAdapter(fgosccnt.logger, {"target": "synthetic"})
+    # 合成画像なので認識の警告・エラーは出さない
+    fgosccnt.logger.setLevel(logging.CRITICAL)
+    print(f"{'size':>10} {'time(ms)':>10} {'peak(MiB)':>10}  (tracemalloc)")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # 新規アイテムのファイルはリポジトリの item/ ではなく一時フォルダに作る
+        for name in ("Item_dir", "CE_dir", "Point_dir"):
+            setattr(fgosccnt, name, Path(tmpdir) / name)
+
+        for width, height in args.sizes:
+            img = make_screenshot(width, height, rng)
+
+            def run():
+                return fgosccnt.ScreenShot(ns, img, models, ".png", exLogger)
+
+            # 1回目は新規アイテムの登録が入るので計測しない
+            run()
+            t_run, _ = timeit(run, args.repeat)
+            tracemalloc.start()
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{width:>5}x{height:<4} {t_run * 1000:>10.0f} {peak / 2**20:>10.1f}")
+
+
+def bench_frame(args):
+    rng = np.random.default_rng(args.seed)
+    print(
+        f"{'size':>10} {'text':>5} {'full(ms)':>9} {'downscaled(ms)':>15} {'speedup':>8}"
+    )
+    for width, height in args.sizes:
+        for count in args.text:
+            img = make_screenshot(width, height, rng, count)
+            t_full, expected = timeit(lambda: find_frame_fullres(img), args.repeat)
+            t_new, actual = timeit(lambda: fgosccnt.get_coodinates(img), args.repeat)
+            assert actual == expected, (actual, expected)
+            print(
+                f"{width:>5}x{height:<4} {count:>5} {t_full * 1000:>9.1f}"
+                f" {t_new * 1000:>15.1f} {t_full / t_new:>7.1f}x"
+            )
+
+
+def legacy_side_black_margin(im_gray):
+    """ScreenAnalysis 導入前の detect_side_black_margin(): 列ごとに Python で数える"""
+    height, width = im_gray.shape[:2]
+    for i in range(width):
+        black_pixels = sum([pixel < 10 for pixel in im_gray[:, i]])
+        if black_pixels / height < 0.91:
+            break
+    left_margin = i
+    for j in range(width):
+        black_pixels = sum([pixel < 10 for pixel in im_gray[:, width - j - 1]])
+        if black_pixels / height < 0.91:
+            break
+    right_margin = j
+    if left_margin + right_margin >= width:
+        return 0, 0
+    return left_margin, right_margin
+
+
+def analysis_stages(img, models, shared):
+    """ScreenShot の前処理の段階ごとの処理時間 (s) と結果
+    shared が False なら ScreenAnalysis 導入前と同じく段階ごとに計算し直す
+    """
+    times = {}
+    results = {}
+
+    def stage(name, func):
+        start = time.perf_counter()
+        results[name] = func()
+        times[name] = times.get(name, 0) + time.perf_counter() - start
+        return results[name]
+
+    next_button = models.template("next")
+    if shared:
+        analysis = stage("gray", lambda: pageinfo.ScreenAnalysis(img))
+        stage("gray", lambda: analysis.gray)
+        (x1, _), (x2, _) = stage(
+            "frame", lambda: fgosccnt.get_coodinates(img, img_gray=analysis.gray)
+        )
+    else:
+        (x1, _), (x2, _) = stage("frame", lambda: fgosccnt.get_coodinates(img))
+    center = int((x2 - x1) / 2 + x1)
+    half_width = min(center, img.shape[1] - center)
+    left, right = center - half_width, center + half_width
+    if shared:
+        sub = analysis.columns(left, right)
+    else:
+        sub = stage("gray", lambda: pageinfo.ScreenAnalysis(img[:, left:right]))
+        stage("gray", lambda: sub.gray)
+    stage("margin", lambda: sub.side_black_margin)
+    stage("pageinfo", lambda: pageinfo.guess_pageinfo(sub, next_button=next_button))
+    # get_qp() と get_qp_gained() がそれぞれ検出する
+    for _ in range(2):
+        if shared:
+            stage("qp region", lambda: analysis.qp_region("jp"))
+        else:
+            stage("qp region", lambda: pageinfo.detect_qp_region(img, "jp"))
+    if not shared:
+        # ScreenAnalysis 導入後はページ情報の補正が必要なときだけ検出する
+        frame, _ = fgosccnt.standardize_size(img[:, x1:x2])
+        sc = SimpleNamespace(
+            img_rgb=frame, img_gray=cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        )
+        stage("scrollbar", lambda: fgosccnt.ScreenShot.detect_scroll_bar(sc))
+    return times, results
+
+
+def bench_analysis(args):
+    rng = np.random.default_rng(args.seed)
+    models = fgosccnt.get_models().load_all()
+    stages = ["gray", "frame", "margin", "pageinfo", "qp region", "scrollbar"]
+    print(f"{'size':>10} {'margin':>6} {'stage':>10} {'before(ms)':>11} {'after(ms)':>10}")
+    for width, height in args.sizes:
+        img = make_screenshot(width, height, rng, 300)
+        # 端末によってはゲーム画面の左右に黒い余白が入る
+        img[:, : args.margin] = 0
+        img[:, width - args.margin :] = 0
+        best = {}
+        for shared in (False, True):
+            patch = pageinfo.detect_side_black_margin
+            if not shared:
+                pageinfo.detect_side_black_margin = legacy_side_black_margin
+            try:
+                runs = [analysis_stages(img, models, shared) for _ in range(args.repeat)]
+            finally:
+                pageinfo.detect_side_black_margin = patch
+            best[shared] = {
+                name: min(times.get(name, 0) for times, _ in runs) for name in stages
+            }
+            best[shared]["total"] = min(sum(times.values()) for times, _ in runs)
+            results = runs[0][1]
+            results.pop("gray", None)
+            best[shared]["results"] = results
+        before = best[False].pop("results")
+        after = best[True].pop("results")
+        before.pop("scrollbar")
+        assert before == after, (before, after)
+        for name in stages + ["total"]:
+            print(
+                f"{width:>5}x{height:<4} {args.margin:>6} {name:>10}"
+                f" {best[False][name] * 1000:>11.2f} {best[True][name] * 1000:>10.2f}"
+            )
+
+
+def make_qp_crop(value, rng):
+    """固定範囲 (550x76) から切り出した QP の画像 (明るい数字・暗い背景)"""
+    img = np.full((76, 550, 3), int(rng.integers(10, 50)), dtype=np.uint8)
+    cv2.putText(
+        img,
+        f"{value:,}",
+        (int(rng.integers(10, 60)), 58),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        1.6,
+        (255, 255, 255),
+        4,
+    )
+    return img
+
+
+def bench_tesseract(args):
+    """フォールバックの QP を毎回 tesseract で読むセッション
+    (1ファイルあたり所持 QP と獲得 QP の2枚)
+    """
+    import pytesseract
+
+    rng = np.random.default_rng(args.seed)
+    images = []
+    for _ in range(args.files):
+        for value in (int(rng.integers(10**6, 2 * 10**9)), int(rng.integers(0, 10**5))):
+            images.append(fgosccnt.tesseract_qp_image(make_qp_crop(value, rng)))
+
+    def single():
+        return [
+            pytesseract.image_to_string(img, config=fgosccnt.TESSERACT_QP_CONFIG)
+            for img in images
+        ]
+
+    def batched():
+        texts = []
+        # recognize_files() と同じく TESSERACT_BATCH_FILES ファイルずつ読む
+        step = fgosccnt.TESSERACT_BATCH_FILES * 2
+        for start in range(0, len(images), step):
+            batch = fgosccnt.TesseractBatch()
+            for img in images[start : start + step]:
+                batch.add(img)
+            texts.extend(batch.run())
+        return texts
+
+    t_single, expected = timeit(single, args.repeat)
+    t_batched, actual = timeit(batched, args.repeat)
+    expected = [fgosccnt.ScreenShot.get_qp_from_text(t) for t in expected]
+    actual = [fgosccnt.ScreenShot.get_qp_from_text(t) for t in actual]
+    mismatches = sum(a != b for a, b in zip(actual, expected, strict=True))
+    print(f"{'files':>6} {'single(s)':>10} {'batched(s)':>11} {'speedup':>8} {'mismatch':>9}")
+    print(
+        f"{args.files:>6} {t_single:>10.2f} {t_batched:>11.2f}"
+        f" {t_single / t_batched:>7.1f}x {mismatches:>9}"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks for fgosccnt")
+    subparsers = parser.add_subparsers(required=True)
+
+    def add_common_arguments(p):
+        p.add_argument("--seed", type=int, default=0, help="random seed")
+        p.add_argument("--repeat", type=int, default=3, help="number of repetitions")
+
+    hashindex_parser = subparsers.add_parser(
+        "hashindex",
+        help="pHash catalog lookup: dict loop vs HashIndex",
+    )
+    add_common_arguments(hashindex_parser)
+    hashindex_parser.add_argument("--size", type=int, default=2000)
+    hashindex_parser.add_argument("--queries", type=int, default=200)
+    hashindex_parser.add_argument("--threshold", type=int, default=20)
+    hashindex_parser.set_defaults(func=bench_hashindex)
+
+    ce_parser = subparsers.add_parser(
+        "ce-scaling",
+        help="Craft Essence nearest match on growing synthetic catalogs",
+    )
+    add_common_arguments(ce_parser)
+    ce_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+    )
+    ce_parser.add_argument("--queries", type=int, default=200)
+    ce_parser.add_argument("--threshold", type=int, default=20)
+    ce_parser.add_argument(
+        "--loop-limit",
+        type=int,
+        default=10000,
+        help="skip the dict loop above this catalog size",
+    )
+    ce_parser.set_defaults(func=bench_ce_scaling)
+
+    startup_parser = subparsers.add_parser(
+        "startup",
+        help="catalog loading: hash_drop.json vs compiled snapshot",
+    )
+    add_common_arguments(startup_parser)
+    startup_parser.set_defaults(func=bench_startup)
+
+    ocr_parser = subparsers.add_parser(
+        "ocr",
+        help="HOG+SVM character OCR: one predict per glyph vs HogOcr batches",
+    )
+    add_common_arguments(ocr_parser)
+    ocr_parser.add_argument("--model", default="item.xml")
+    ocr_parser.add_argument("--batches", type=int, nargs="+", default=[1, 8, 21])
+    ocr_parser.add_argument("--rounds", type=int, default=4, help="batches per size")
+    ocr_parser.set_defaults(func=bench_ocr)
+
+    screenshot_parser = subparsers.add_parser(
+        "screenshot",
+        help="ScreenShot on synthetic images: time and peak memory",
+    )
+    add_common_arguments(screenshot_parser)
+    screenshot_parser.add_argument(
+        "--sizes",
+        type=parse_size,
+        nargs="+",
+        default=[(2732, 2048), (2224, 1668), (2048, 1536)],
+        help="WIDTHxHEIGHT",
+    )
+    screenshot_parser.set_defaults(func=bench_screenshot)
+
+    frame_parser = subparsers.add_parser(
+        "frame",
+        help="get_coodinates: full resolution vs downscaled search",
+    )
+    add_common_arguments(frame_parser)
+    frame_parser.add_argument(
+        "--sizes",
+        type=parse_size,
+        nargs="+",
+        default=[
+            (1334, 750),
+            (2436, 1125),
+            (2796, 1290),
+            (2048, 1536),
+            (2388, 1668),
+            (2732, 2048),
+        ],
+        help="WIDTHxHEIGHT",
+    )
+    frame_parser.add_argument(
+        "--text",
+        type=int,
+        nargs="+",
+        default=[0, 300, 1000],
+        help="number of dark numbers drawn in the frame",
+    )
+    frame_parser.set_defaults(func=bench_frame)
+
+    analysis_parser = subparsers.add_parser(
+        "analysis",
+        help="ScreenShot preprocessing stages: per consumer vs ScreenAnalysis",
+    )
+    add_common_arguments(analysis_parser)
+    analysis_parser.add_argument(
+        "--sizes",
+        type=parse_size,
+        nargs="+",
+        default=[(2436, 1125), (2048, 1536), (2732, 2048)],
+        help="WIDTHxHEIGHT",
+    )
+    analysis_parser.add_argument(
+        "--margin",
+        type=int,
+        default=16,
+        help="width of the black side margins (px)",
+    )
+    analysis_parser.set_defaults(func=bench_analysis)
+
+    tesseract_parser = subparsers.add_parser(
+        "tesseract",
+        help="fallback QP by tesseract: one process per crop vs TesseractBatch",
+    )
+    add_common_arguments(tesseract_parser)
+    tesseract_parser.add_argument("--files", type=int, default=100)
+    tesseract_parser.set_defaults(func=bench_tesseract)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    args.func(args)
@@ -1,25 +1,32 @@
 #!/usr/bin/env python3
 import argparse
+import bisect
 import csv
 import datetime
+import functools
+import hashlib
 import io
 import itertools
 import json
 import logging
 import math
+import multiprocessing
+import os
+import pickle
 import re
+import sqlite3
+import struct
 import sys
-from collections import Counter
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from operator import itemgetter
 from pathlib import Path
 
 import cv2
 import numpy as np
-import pytesseract
 from numpy import ndarray
-from PIL import Image
-from PIL.ExifTags import TAGS
 
 import pageinfo
 
@@ -27,6 +34,8 @@ PROGNAME = "FGOスクショカウント"
 VERSION = "0.4.0"
 DEFAULT_ITEM_LANG = "jpn"  # "jpn": japanese, "eng": English
 
+LOG_FORMAT = "%(name)s <%(filename)s-L%(lineno)s> [%(levelname)s] %(message)s"
+
 logger = logging.getLogger(__name__)
 
 
@@ -45,6 +54,7 @@ class Ordering(Enum):
     NOTSPECIFIED = "notspecified"  # 指定なし
     FILENAME = "filename"  # ファイル名
     TIMESTAMP = "timestamp"  # 作成日時
+    EXIF = "exif"  # EXIF の撮影日時
 
     def __str__(self):
         return str(self.value)
@@ -59,12 +69,16 @@ train_chest = basedir / Path("chest.xml")  # drop_coount (Old UI)
 train_dcnt = basedir / Path("dcnt.xml")  # drop_coount (New UI)
 train_card = basedir / Path("card.xml")  # card name
 train_exp_class = basedir / Path("exp_class.xml")  # exp class
+train_qp = basedir / Path("qp.xml")  # QP (fallback region)
 drop_file = basedir / Path("fgoscdata/hash_drop.json")
 eventquest_dir = basedir / Path("fgoscdata/data/json/")
 items_img = basedir / Path("data/misc/items_img.png")
 bunyan1_img = basedir / Path("data/misc/bunyan1.png")
-
-hasher = cv2.img_hash.PHash_create()
+next_img = basedir / Path("data/pageinfo/next.png")
+red_tea_img = basedir / Path("data/misc/red_tea.png")
+yellow_tea_img = basedir / Path("data/misc/yellow_tea.png")
+cache_file = basedir / Path("cache/recognition.sqlite3")
+catalog_snapshot_file = basedir / Path("cache/catalog.pickle")
 
 FONTSIZE_UNDEFINED = -1
 FONTSIZE_NORMAL = 0
@@ -105,6 +119,31 @@ ID_RED_TEA = 94074506
 ID_WEST_AMERICA_AREA = 93040104
 TIMEOUT = 15
 QP_UNKNOWN = -1
+# QP の読み取り方法 (使う順)
+QP_READERS = ("region", "fallback", "tesseract", "failed")
+TESSERACT_QP_CONFIG = "-l eng --oem 1 --psm 7 -c tessedit_char_whitelist=+,0123456789"
+# tesseract で読む QP を何ファイル分までまとめるか
+TESSERACT_BATCH_FILES = 32
+# 固定範囲の QP の字を SVM の読み取り結果として採用する決定値の余裕の下限
+# (縮小された数字でも 99% はこれ以上、数字でない図形は半分程度がこれ未満)
+QP_FALLBACK_MARGIN = 0.1
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+IMAGE_SUFFIXES = (".PNG", ".JPG", ".JPEG")
+WATCH_INTERVAL = 2  # --watch でフォルダを調べる間隔 (秒)
+EXIF_READ_THREADS = 16  # --ordering exif で撮影日時を並行して読むスレッド数
+# StackCache で覚えるアイテムの種類の数と、1種類あたりの読み取り結果の数
+STACK_CACHE_KEYS = 256
+STACK_CACHE_ENTRIES = 8
+# TileCache で覚えるアイテム画像の数
+TILE_CACHE_SIZE = 512
+# ScreenMemo で前のスクショと比べる縮小画像の倍率と、同じ画面とみなす画素値の差
+SCREEN_FINGERPRINT_SCALE = 4
+SCREEN_FINGERPRINT_TOLERANCE = 16
+# ScreenMemo で元の解像度で比べるアイテムのドロップ数・ボーナスの帯 (タイルの高さ 206 での上端)、
+# 違うとみなす画素値の差と、帯のうち違ってよい画素の割合
+STACK_COUNT_BAND_TOP = 110
+STACK_COUNT_DIFF = 64
+STACK_COUNT_TOLERANCE = 0.001
 
 
 class FgosccntError(Exception):
@@ -115,97 +154,292 @@ class GainedQPandDropMissMatchError(FgosccntError):
     pass
 
 
-with open(drop_file, encoding="UTF-8") as f:
-    drop_item = json.load(f)
-
-# JSONファイルから各辞書を作成
-item_name = {item["id"]: item["name"] for item in drop_item}
-item_name_eng = {
-    item["id"]: item["name_eng"] for item in drop_item if "name_eng" in item.keys()
-}
-item_shortname = {
-    item["id"]: item["shortname"] for item in drop_item if "shortname" in item.keys()
-}
-item_dropPriority = {item["id"]: item["dropPriority"] for item in drop_item}
-item_background = {
-    item["id"]: item["background"] for item in drop_item if "background" in item.keys()
-}
-item_type = {item["id"]: item["type"] for item in drop_item}
-dist_item = {
-    item["phash_battle"]: item["id"]
-    for item in drop_item
-    if item["type"] == "Item" and "phash_battle" in item.keys()
-}
-dist_ce = {
-    item["phash"]: item["id"] for item in drop_item if item["type"] == "Craft Essence"
-}
-dist_ce_narrow = {
-    item["phash_narrow"]: item["id"]
-    for item in drop_item
-    if item["type"] == "Craft Essence"
-}
-dist_secret_gem = {
-    item["id"]: item["phash_class"]
-    for item in drop_item
-    if 6200 < item["id"] < 6208 and "phash_class" in item.keys()
-}
-dist_magic_gem = {
-    item["id"]: item["phash_class"]
-    for item in drop_item
-    if 6100 < item["id"] < 6108 and "phash_class" in item.keys()
-}
-dist_gem = {
-    item["id"]: item["phash_class"]
-    for item in drop_item
-    if 6000 < item["id"] < 6008 and "phash_class" in item.keys()
-}
-dist_exp_rarity = {
-    item["phash_rarity"]: item["id"]
-    for item in drop_item
-    if item["type"] == "Exp. UP" and "phash_rarity" in item.keys()
-}
-dist_exp_rarity_sold = {
-    item["phash_rarity_sold"]: item["id"]
-    for item in drop_item
-    if item["type"] == "Exp. UP" and "phash_rarity_sold" in item.keys()
-}
-dist_exp_rarity.update(dist_exp_rarity_sold)
-dist_exp_rarity["1fe03fe0517fa0bf"] = 9701200  # fix #368
-dist_exp_class = {
-    item["phash_class"]: item["id"]
-    for item in drop_item
-    if item["type"] == "Exp. UP" and "phash_class" in item.keys()
-}
-dist_exp_class_sold = {
-    item["phash_class_sold"]: item["id"]
-    for item in drop_item
-    if item["type"] == "Exp. UP" and "phash_class_sold" in item.keys()
-}
-dist_exp_class.update(dist_exp_class_sold)
-dist_point = {
-    item["phash_battle"]: item["id"]
-    for item in drop_item
-    if item["type"] == "Point" and "phash_battle" in item.keys()
-}
-
-with open(drop_file, encoding="UTF-8") as f:
-    drop_item = json.load(f)
-
-freequest = []
-evnetfiles = eventquest_dir.glob("**/*.json")
-for evnetfile in evnetfiles:
-    try:
-        with open(evnetfile, encoding="UTF-8") as f:
-            event = json.load(f)
-            freequest = freequest + event
-    except (OSError, UnicodeEncodeError) as e:
-        logger.exception(e)
+class ModelError(FgosccntError):
+    """学習済みモデル・テンプレート画像が無い、または読み込めない"""
+
+    pass
+
+
+class CatalogFrozenError(FgosccntError):
+    """catalog_frozen のときにカタログに無いアイテムが見つかった"""
+
+    pass
+
+
+# True のとき make_new_file() はファイルを作らずに CatalogFrozenError を送出する
+catalog_frozen = False
+# make_new_file() でカタログが増えた回数
+catalog_generation = 0
+
+
+# カタログ・背景ヒストグラム・テンプレート画像などは import 時には読み込まず、
+# 最初に使うときに読み込む。import するだけのスクリプトや --help を軽くするため
+
+
+@functools.cache
+def get_hasher():
+    return cv2.img_hash.PHash_create()
+
+
+@functools.cache
+def get_background_hists():
+    """背景判別用のヒストグラム {"hist_zero": ..., "hist_gold": ..., ...}"""
+    with np.load(basedir / Path("background.npz")) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+class SvmPredictor:
+    """cv2.ml.SVM の predict() と同じラベルを返す予測器
+
+    学習済みモデルは全て線形カーネルの C_SVC (一対一の多クラス分類) なので、
+    全ての決定関数を行列積一回で計算して投票する。predict() は1行ずつ
+    単精度で内積を計算するので、決定値が 0 に近く誤差で結果が変わりうる行と、
+    まだラベルが分かっていないクラスに投票された行だけは predict() を呼ぶ。
+    それ以外のモデルと、行数が少ない場合は predict() をそのまま使う。
+    """
+
+    # 決定値の誤差の上限 (|x|・|sv| に対する相対値)。単精度の内積の誤差より十分大きい
+    TOLERANCE = 1e-5
+    # これより少ない行数では行列積より predict() のほうが速い
+    MIN_ROWS = 3
+
+    def __init__(self, svm):
+        self.svm = svm
+        self.linear = False
+        if svm.getKernelType() != cv2.ml.SVM_LINEAR or svm.getType() != cv2.ml.SVM_C_SVC:
+            return
+        # 線形カーネルの場合、サポートベクトルは決定関数ごとに一つにまとめられている
+        sv = svm.getSupportVectors().astype(np.float64)
+        n_df = sv.shape[0]
+        class_count = int(round((1 + math.sqrt(1 + 8 * n_df)) / 2))
+        if class_count * (class_count - 1) // 2 != n_df:
+            return
+        self.sv = sv
+        self.sv_norm = np.linalg.norm(sv, axis=1)
+        self.alpha = np.zeros((n_df, n_df))
+        self.rho = np.zeros(n_df)
+        for dfi in range(n_df):
+            rho, alpha, svidx = svm.getDecisionFunction(dfi)
+            self.alpha[svidx.ravel(), dfi] = alpha.ravel()
+            self.rho[dfi] = rho
+        self.abs_alpha = np.abs(self.alpha)
+        # 決定関数 dfi は (i, j) の組 (i < j) の順に並んでおり、正なら i、それ以外は j に投票する
+        pairs = list(itertools.combinations(range(class_count), 2))
+        self.vote_i = np.zeros((n_df, class_count), dtype=np.int64)
+        self.vote_j = np.zeros((n_df, class_count), dtype=np.int64)
+        for dfi, (i, j) in enumerate(pairs):
+            self.vote_i[dfi, i] = 1
+            self.vote_j[dfi, j] = 1
+        # クラス番号 -> ラベル。predict() の結果から分かったものを埋めていく
+        self.labels = np.full(class_count, -1, dtype=np.int64)
+        self.linear = True
+
+    def predict(self, features):
+        """特徴量の行列 (1行が1サンプル) のラベルのリストを返す"""
+        features = np.asarray(features, dtype=np.float32)
+        if len(features) == 0:
+            return []
+        features = features.reshape(len(features), -1)
+        if not self.linear or len(features) < self.MIN_ROWS:
+            return [int(v) for v in self.svm.predict(features)[1][:, 0]]
+
+        x = features.astype(np.float64)
+        dec = x @ self.sv.T @ self.alpha - self.rho
+        x_norm = np.linalg.norm(x, axis=1)
+        bound = np.outer(x_norm, self.sv_norm) @ self.abs_alpha * self.TOLERANCE
+        votes = (dec > 0) @ self.vote_i + (dec <= 0) @ self.vote_j
+        # 同数の場合は番号の小さいクラス
+        winner = votes.argmax(axis=1)
+        exact = ~(np.abs(dec) <= bound).any(axis=1)
+        labels = self.labels[winner]
+
+        ask = np.flatnonzero(~exact | (labels < 0))
+        if ask.size > 0:
+            answers = self.svm.predict(features[ask])[1][:, 0].astype(np.int64)
+            labels[ask] = answers
+            for k, answer in zip(ask.tolist(), answers.tolist(), strict=True):
+                if exact[k]:
+                    self.labels[winner[k]] = answer
+        return labels.tolist()
+
+    def margins(self, features):
+        """行ごとに、勝ったクラスが関わる決定関数の決定値の余裕の最小値
+
+        全ての対戦で勝っていれば正で、サポートベクトルと同程度に
+        学習データらしいものは 1 前後になる。線形でないモデルでは None
+        """
+        if not self.linear:
+            return None
+        features = np.asarray(features, dtype=np.float64)
+        features = features.reshape(len(features), -1)
+        dec = features @ self.sv.T @ self.alpha - self.rho
+        votes = (dec > 0) @ self.vote_i + (dec <= 0) @ self.vote_j
+        winner = votes.argmax(axis=1)
+        # 勝ったクラスが i なら +1、j なら -1、関わらない決定関数は 0
+        sign = self.vote_i[:, winner].T - self.vote_j[:, winner].T
+        return np.where(sign != 0, dec * sign, np.inf).min(axis=1)
+
+
+class HogOcr:
+    """HOG 特徴量 + SVM による文字認識
+
+    HOGDescriptor を使い回し、複数の文字画像の特徴量を一度に計算して、
+    モデルごとに一回の予測でまとめて認識する
+    """
+
+    # Hog特徴のパラメータ (全モデル共通)
+    WIN_SIZE = (120, 60)
+    BLOCK_SIZE = (16, 16)
+    BLOCK_STRIDE = (4, 4)
+    CELL_SIZE = (4, 4)
+    BINS = 9
+
+    def __init__(self):
+        self.hog = cv2.HOGDescriptor(
+            self.WIN_SIZE, self.BLOCK_SIZE, self.BLOCK_STRIDE, self.CELL_SIZE, self.BINS
+        )
+        self.predictors = {}
+
+    def features(self, imgs):
+        """画像ごとの HOG 特徴量を並べた行列
+
+        画像を WIN_SIZE に縮小して横に並べ、一度の compute() で計算する。
+        個々の画像の周囲に 1px の折り返しを付けておくと、
+        画像ごとに compute() したときと同じ値になる
+        """
+        width, height = self.WIN_SIZE
+        tiles = [
+            cv2.copyMakeBorder(
+                cv2.resize(img, self.WIN_SIZE), 1, 1, 1, 1, cv2.BORDER_REFLECT_101
+            )
+            for img in imgs
+        ]
+        if len(tiles) == 0:
+            return np.empty((0, self.hog.getDescriptorSize()), dtype=np.float32)
+        locations = [((width + 2) * k + 1, 1) for k in range(len(tiles))]
+        descriptors = self.hog.compute(
+            np.hstack(tiles), self.BLOCK_STRIDE, (0, 0), locations
+        )
+        return descriptors.reshape(len(tiles), -1)
+
+    def predictor(self, svm):
+        key = id(svm)
+        if key not in self.predictors:
+            self.predictors[key] = SvmPredictor(svm)
+        return self.predictors[key]
 
-npz = np.load(basedir / Path("background.npz"))
-hist_zero = npz["hist_zero"]
-hist_gold = npz["hist_gold"]
-hist_silver = npz["hist_silver"]
-hist_bronze = npz["hist_bronze"]
+    def predict(self, svm, imgs):
+        """画像ごとの予測ラベル (int) のリスト"""
+        return self.predictor(svm).predict(self.features(imgs))
+
+    def predict_with_margins(self, svm, imgs):
+        """画像ごとの予測ラベルのリストと SvmPredictor.margins() の組"""
+        features = self.features(imgs)
+        predictor = self.predictor(svm)
+        return predictor.predict(features), predictor.margins(features)
+
+
+class ModelRegistry:
+    """学習済みモデル (SVM) とテンプレート画像を名前で引けるようにまとめたもの
+
+    それぞれ最初に参照したときに一度だけ読み込む。
+    ScreenShot・Item にはこれを渡し、プロセス内では get_models() の
+    ものを共有する。並列処理では読み込み済みのものをワーカーに引き継ぐ
+    テンプレート画像は使う色空間に変換した上で読み取り専用にして渡す
+    """
+
+    # 名前: (ファイル, 作成するスクリプト)
+    MODELS = {
+        "item": (train_item, "makeitem.py"),  # item stack & bonus
+        "chest": (train_chest, "makechest.py"),  # drop_coount (Old UI)
+        "dcnt": (train_dcnt, "makedcnt.py"),  # drop_coount (New UI)
+        "card": (train_card, "makecard.py"),  # card name
+        "exp_class": (train_exp_class, "makeexp.py"),  # exp class
+        "qp": (train_qp, "makeqp.py"),  # QP (fallback region)
+    }
+    # 無くても動くモデル: ファイルが無いときに代わりに使うモデル
+    # (QP の数字は旧 UI のドロップ数と同じフォント)
+    SUBSTITUTES = {"qp": "chest"}
+    # 名前: (ファイル, imread の flags, 読み込み後の cv2.cvtColor の code)
+    TEMPLATES = {
+        "items": (items_img, cv2.IMREAD_GRAYSCALE, None),
+        "bunyan1": (bunyan1_img, cv2.IMREAD_GRAYSCALE, None),
+        # pageinfo.guess_pageinfo() 用 pageinfo と同じくカラーで読んでから変換する
+        "next": (next_img, cv2.IMREAD_COLOR, cv2.COLOR_BGR2GRAY),
+        "red_tea": (red_tea_img, cv2.IMREAD_COLOR, None),
+        "yellow_tea": (yellow_tea_img, cv2.IMREAD_COLOR, None),
+    }
+
+    def __init__(self):
+        self.ocr = HogOcr()
+        self.svms = {}
+        self.templates = {}
+        self.loaded = False
+
+    def check(self):
+        """モデルファイルが揃っているか確認する"""
+        for name, (path, script) in self.MODELS.items():
+            if name not in self.SUBSTITUTES and not path.exists():
+                raise ModelError(f"{path.name} is not found\nTry to run 'python {script}'")
+
+    def svm(self, name):
+        if name not in self.svms:
+            path, script = self.MODELS[name]
+            if name in self.SUBSTITUTES and not path.exists():
+                logger.debug("%s is not found; use %s", path.name, self.SUBSTITUTES[name])
+                self.svms[name] = self.svm(self.SUBSTITUTES[name])
+                return self.svms[name]
+            try:
+                svm = cv2.ml.SVM_load(str(path))
+            except cv2.error as e:
+                raise ModelError(f"{path.name} cannot be loaded: {e}") from e
+            if (
+                not svm.isTrained()
+                or svm.getVarCount() != self.ocr.hog.getDescriptorSize()
+            ):
+                raise ModelError(
+                    f"{path.name} is not a valid model\nTry to run 'python {script}'"
+                )
+            self.svms[name] = svm
+        return self.svms[name]
+
+    def template(self, name):
+        if name not in self.templates:
+            path, flags, code = self.TEMPLATES[name]
+            img = imread(path, flags)
+            if img is None:
+                raise ModelError(f"{path} cannot be loaded")
+            if code is not None:
+                img = cv2.cvtColor(img, code)
+            img.flags.writeable = False
+            self.templates[name] = img
+        return self.templates[name]
+
+    def predict(self, name, imgs):
+        """モデル name で画像ごとの予測ラベル (int) のリストを返す"""
+        return self.ocr.predict(self.svm(name), imgs)
+
+    def predict_with_margins(self, name, imgs):
+        """モデル name で画像ごとの予測ラベルのリストと決定値の余裕を返す"""
+        return self.ocr.predict_with_margins(self.svm(name), imgs)
+
+    def load_all(self):
+        """全てのモデル・テンプレートを読み込んで検証する (2回目以降は何もしない)"""
+        if self.loaded:
+            return self
+        self.check()
+        for name in self.MODELS:
+            self.svm(name)
+        for name in self.TEMPLATES:
+            self.template(name)
+        self.loaded = True
+        return self
+
+
+@functools.cache
+def get_models():
+    """プロセスで共有する ModelRegistry"""
+    return ModelRegistry()
 
 
 def has_intersect(a, b):
@@ -215,6 +449,260 @@ def has_intersect(a, b):
     return max(a[0], b[0]) < min(a[2], b[2]) and max(a[1], b[1]) < min(a[3], b[3])
 
 
+# --profile のときに段階ごとの処理時間とフォールバックの回数を記録する Profile
+# (プロセスごと。使わないときは None で、stage() と count_event() は何もしない)
+_profile = None
+# 報告に出す段階 (認識の順) とフォールバック
+PROFILE_STAGES = (
+    "decode",
+    "fingerprint",
+    "frame",
+    "pageinfo",
+    "standardize",
+    "drop_count",
+    "tile",
+    "stack",
+    "qp",
+    "exif",
+    "tesseract",
+)
+PROFILE_EVENTS = ("ce_narrow", "background_retry", "new_file", "qp_fallback", "tesseract")
+
+
+class Profile:
+    """1ファイル (または tesseract の1回の一括読み取り) 分の処理時間の記録
+
+    spans は (段階, 開始, 時間) で、時刻は time.time() に合わせた秒
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # perf_counter() を time.time() に合わせる (Chrome trace で別プロセスと並べるため)
+        self.offset = time.time() - time.perf_counter()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.events = Counter()
+
+    def result(self):
+        """record に入れる (プロセス間で渡せる) dict"""
+        return {
+            "pid": os.getpid(),
+            "start": self.start + self.offset,
+            "total": time.perf_counter() - self.start,
+            "spans": [(name, start + self.offset, t) for name, start, t in self.spans],
+            "events": dict(self.events),
+        }
+
+
+class stage:
+    """with stage("frame"): の間の処理時間を _profile に記録する"""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _profile is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if _profile is not None:
+            _profile.spans.append(
+                (self.name, self.start, time.perf_counter() - self.start)
+            )
+
+
+def count_event(name, n=1):
+    if _profile is not None:
+        _profile.events[name] += n
+
+
+class ProfileReport:
+    """ファイルごとの Profile の結果を集めて、JSON の報告と Chrome trace を書く"""
+
+    SLOWEST = 10
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.files = []
+        self.batches = []
+        self.start = time.time()
+
+    def add(self, filename, result):
+        self.files.append((str(filename), result))
+
+    def add_batch(self, result):
+        self.batches.append(result)
+
+    @staticmethod
+    def summarize(values):
+        values = np.array(values)
+        return {
+            "count": len(values),
+            "total": float(values.sum()),
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "max": float(values.max()),
+        }
+
+    def report(self):
+        per_stage = {}
+        events = Counter()
+        for result in [r for _, r in self.files] + self.batches:
+            for name, t in self.stage_totals(result).items():
+                per_stage.setdefault(name, []).append(t)
+            events.update(result["events"])
+        names = [n for n in PROFILE_STAGES if n in per_stage]
+        names += sorted(set(per_stage) - set(names))
+        slowest = sorted(self.files, key=lambda f: f[1]["total"], reverse=True)
+        return {
+            "files": len(self.files),
+            "wall": time.time() - self.start,
+            "stages": {name: self.summarize(per_stage[name]) for name in names},
+            "total": self.summarize([r["total"] for _, r in self.files]) if self.files else None,
+            "events": {name: events[name] for name in PROFILE_EVENTS},
+            "slowest": [
+                {
+                    "filename": filename,
+                    "total": result["total"],
+                    "stages": self.stage_totals(result),
+                }
+                for filename, result in slowest[: self.SLOWEST]
+            ],
+        }
+
+    @staticmethod
+    def stage_totals(result):
+        totals = Counter()
+        for name, _, t in result["spans"]:
+            totals[name] += t
+        return dict(totals)
+
+    def trace(self):
+        """Chrome trace (chrome://tracing, Perfetto) の形式"""
+        events = []
+        for filename, result in self.files:
+            common = {"pid": result["pid"], "tid": 0}
+            events.append(
+                {
+                    "name": filename,
+                    "cat": "file",
+                    "ph": "X",
+                    "ts": result["start"] * 1e6,
+                    "dur": result["total"] * 1e6,
+                    **common,
+                }
+            )
+            for name, start, t in result["spans"]:
+                events.append(
+                    {
+                        "name": name,
+                        "cat": "stage",
+                        "ph": "X",
+                        "ts": start * 1e6,
+                        "dur": t * 1e6,
+                        "args": {"file": filename},
+                        **common,
+                    }
+                )
+        for result in self.batches:
+            for name, start, t in result["spans"]:
+                events.append(
+                    {
+                        "name": name,
+                        "cat": "batch",
+                        "ph": "X",
+                        "ts": start * 1e6,
+                        "dur": t * 1e6,
+                        "pid": result["pid"],
+                        "tid": 1,
+                        "args": result["events"],
+                    }
+                )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self):
+        """報告を path に、Chrome trace を <path の拡張子を除いたもの>.trace.json に書く"""
+        trace_path = self.path.with_suffix(".trace.json")
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        with open(trace_path, "w", encoding="utf-8") as f:
+            json.dump(self.trace(), f)
+        logger.info("profile: %s, trace: %s", self.path, trace_path)
+
+
+def tesseract_qp_image(image):
+    """tesseract に渡す QP の画像 (黒い数字・白い背景)"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    _, qp_image = cv2.threshold(gray, 65, 255, cv2.THRESH_BINARY_INV)
+    return qp_image
+
+
+class TesseractBatch:
+    """tesseract で読む QP の画像を貯めて、1回の起動でまとめて読む
+
+    画像を余白を挟んで縦に並べた1枚にし、行ごとに読んだ単語を
+    位置から元の画像に対応付ける。
+    まとめて読んで数字が見つからなかった画像だけ1枚ずつ読み直す
+    """
+
+    GAP = 24  # 画像の間の余白 (px)
+    CONFIG = TESSERACT_QP_CONFIG.replace("--psm 7", "--psm 6")
+
+    def __init__(self):
+        self.images = []
+
+    def add(self, qp_image):
+        """画像を追加し、run() の戻り値での位置を返す"""
+        self.images.append(qp_image)
+        return len(self.images) - 1
+
+    def page(self):
+        """(並べた画像, 各画像の上端の y 座標のリスト)"""
+        width = max(img.shape[1] for img in self.images)
+        rows = [np.full((self.GAP, width), 255, dtype=np.uint8)]
+        tops = []
+        y = self.GAP
+        for img in self.images:
+            tops.append(y)
+            rows.append(
+                cv2.copyMakeBorder(
+                    img, 0, self.GAP, 0, width - img.shape[1], cv2.BORDER_CONSTANT, value=255
+                )
+            )
+            y += img.shape[0] + self.GAP
+        return np.vstack(rows), tops
+
+    def run(self):
+        """画像ごとの読み取り結果の文字列のリスト"""
+        import pytesseract  # 読み込みが重いので使うときに import する
+
+        if len(self.images) == 0:
+            return []
+        page, tops = self.page()
+        data = pytesseract.image_to_data(
+            page, config=self.CONFIG, output_type=pytesseract.Output.DICT
+        )
+        words = [[] for _ in self.images]
+        for text, left, top, height in zip(
+            data["text"], data["left"], data["top"], data["height"], strict=True
+        ):
+            if text.strip() == "":
+                continue
+            # 単語の中心を含む (上の余白の半分から) 画像
+            k = bisect.bisect_right(tops, top + height / 2 + self.GAP / 2) - 1
+            words[max(k, 0)].append((left, text.strip()))
+        texts = [" ".join(text for _, text in sorted(w)) for w in words]
+        for k, text in enumerate(texts):
+            if re.search("[0-9]", text) is None:
+                texts[k] = pytesseract.image_to_string(
+                    self.images[k], config=TESSERACT_QP_CONFIG
+                )
+        logger.debug("tesseract batch: %d images", len(self.images))
+        return texts
+
+
 class State:
     def set_screen(self):
         self.screen_type = "normal"
@@ -303,14 +791,149 @@ class Context:
         self.state.set_max_qp()
 
 
+# get_coodinates() で輪郭を探す画像の長辺の目安
+FRAME_SEARCH_SIZE = 800
+
+
+def frame_contours(contours, height: float, width: float, relax: int = 0):
+    """輪郭のうちゲーム画面の枠の条件に合うもの
+
+    height, width は輪郭と同じ縮尺での元画像の大きさ、relax は画像を縮小して
+    探す場合に許す幅・高さの誤差 (px)
+    """
+    contours2 = []
+    for cnt in contours:
+        _, _, w, h = cv2.boundingRect(cnt)
+        if relax == 0:
+            if (
+                1.81 < w / h < 1.83
+                and cv2.contourArea(cnt) > height / 2 * width / 2
+                and height / h > 1080 / 910
+            ):
+                contours2.append(cnt)
+        elif (
+            1.81 < (w + relax) / max(h - relax, 1)
+            and (w - relax) / (h + relax) < 1.83
+            and (w + relax) * (h + relax) > height / 2 * width / 2
+            and height / max(h - relax, 1) > 1080 / 910
+        ):
+            contours2.append(cnt)
+    return contours2
+
+
+def find_frame(inv: ndarray, height: int, width: int):
+    """二値画像 inv で枠の条件に合う最大の輪郭の boundingRect  見つからなければ None"""
+    contours, _ = cv2.findContours(inv, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    contours = frame_contours(contours, height, width)
+    if len(contours) == 0:
+        return None
+    max_contour = max(contours, key=lambda x: cv2.contourArea(x))
+    return cv2.boundingRect(max_contour)
+
+
+def find_frame_downscaled(inv: ndarray):
+    """縮小した画像で枠を探し、元の解像度では枠の周辺の帯だけを調べる
+
+    縮小は scale x scale 画素に1画素でも暗いものがあれば暗いとするので、
+    枠で囲まれた明るい領域は縮小しても閉じたまま残る。
+    元の解像度では縮小画像で見つけた枠より内側を塗りつぶし、
+    枠の周辺の帯の輪郭から find_frame() と同じ boundingRect を求める。
+    帯の中で確かめられない場合は None
+    """
+    height, width = inv.shape[:2]
+    scale = math.ceil(max(height, width) / FRAME_SEARCH_SIZE)
+    if scale < 2:
+        return None
+    # scale x scale のブロックの最大値をブロックの anchor の位置から取り出す
+    anchor = scale // 2
+    small = cv2.dilate(inv, np.ones((scale, scale), np.uint8))
+    small = np.ascontiguousarray(
+        small[
+            anchor : height // scale * scale : scale,
+            anchor : width // scale * scale : scale,
+        ]
+    )
+    all_contours, _ = cv2.findContours(small, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    contours = frame_contours(all_contours, height / scale, width / scale, relax=2)
+    if len(contours) == 0:
+        return None
+
+    margin = 2 * scale + 2
+    # 帯の外側: 枠になり得る大きさの連結成分をすべて含む範囲
+    # 元の解像度の連結成分は縮小画像のどれかの連結成分に含まれるので、
+    # 帯で切り取られる輪郭は元の解像度でも枠の条件に合わない
+    # (連結成分の範囲は外側の輪郭の boundingRect)
+    boxes = []
+    for cnt in all_contours:
+        x, y, w, h = cv2.boundingRect(cnt)
+        if (w + 2) * (h + 2) * scale * scale > height / 2 * width / 2:
+            boxes.append((x, y, w, h))
+    left = max(min(x for x, _, _, _ in boxes) * scale - margin, 0)
+    top = max(min(y for _, y, _, _ in boxes) * scale - margin, 0)
+    right = min(max(x + w for x, _, w, _ in boxes) * scale + margin, width)
+    bottom = min(max(y + h for _, y, _, h in boxes) * scale + margin, height)
+    # 帯の内側: find_frame() と同じく面積最大の輪郭の内側
+    x, y, w, h = cv2.boundingRect(max(contours, key=lambda x: cv2.contourArea(x)))
+    in_left, in_top = x * scale + margin, y * scale + margin
+    in_right, in_bottom = (x + w) * scale - margin, (y + h) * scale - margin
+    # 塗りつぶす領域のすぐ外側の1画素に暗い画素があると、塗りつぶしで
+    # 枠につながった暗い部分が変わり輪郭や面積が元の解像度と一致しない。
+    # 暗い画素がある辺は内側に寄せ、半分より小さくなるなら諦める
+    if in_left >= in_right or in_top >= in_bottom:
+        return None
+    min_width = (in_right - in_left) // 2
+    min_height = (in_bottom - in_top) // 2
+    while True:
+        if in_right - in_left < min_width or in_bottom - in_top < min_height:
+            return None
+        dark_top = inv[in_top - 1, in_left - 1 : in_right + 1].any()
+        dark_bottom = inv[in_bottom, in_left - 1 : in_right + 1].any()
+        dark_left = inv[in_top - 1 : in_bottom + 1, in_left - 1].any()
+        dark_right = inv[in_top - 1 : in_bottom + 1, in_right].any()
+        if not (dark_top or dark_bottom or dark_left or dark_right):
+            break
+        in_top += scale * dark_top
+        in_bottom -= scale * dark_bottom
+        in_left += scale * dark_left
+        in_right -= scale * dark_right
+
+    band = inv[top:bottom, left:right].copy()
+    band[in_top - top : in_bottom - top, in_left - left : in_right - left] = 0
+    rects = []
+    contours, _ = cv2.findContours(band, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    for cnt in frame_contours(contours, height, width):
+        x, y, w, h = cv2.boundingRect(cnt)
+        # 帯で切り取られた (画像の端以外で帯の外側に接する) 輪郭は除く
+        if (
+            (x == 0 and left > 0)
+            or (y == 0 and top > 0)
+            or (x + w == right - left and right < width)
+            or (y + h == bottom - top and bottom < height)
+        ):
+            continue
+        rects.append((cv2.contourArea(cnt), (x + left, y + top, w, h)))
+    if len(rects) == 0:
+        return None
+    x, y, w, h = max(rects, key=lambda r: r[0])[1]
+    # 塗りつぶした内側を囲んでいなければ別の輪郭
+    if not (x < in_left and y < in_top and x + w > in_right and y + h > in_bottom):
+        return None
+    return x, y, w, h
+
+
 def get_coodinates(
     img: ndarray,
     display: bool = False,
+    img_gray: ndarray | None = None,
 ) -> tuple[tuple[int, int], tuple[int, int]]:
+    """ゲーム画面の枠の座標 ((x1, y1), (x2, y2))
+    img_gray に img のグレースケール画像を渡すと変換を省略する
+    """
     threshold: int = 30
 
     height, width = img.shape[:2]
-    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img_gray is None:
+        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     if display:
         cv2.imshow("image", img_gray)
         cv2.waitKey(0)
@@ -320,21 +943,13 @@ def get_coodinates(
         cv2.imshow("image", inv)
         cv2.waitKey(0)
         cv2.destroyAllWindows()
-    contours, _ = cv2.findContours(inv, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-    contours2 = []
-    for cnt in contours:
-        _, _, w, h = cv2.boundingRect(cnt)
-        area = cv2.contourArea(cnt)
-        if (
-            1.81 < w / h < 1.83
-            and area > height / 2 * width / 2
-            and height / h > 1080 / 910
-        ):
-            contours2.append(cnt)
-    if len(contours2) == 0:
+    # 大きな画像ではまず縮小して探し、確かめられなければ元の解像度で探す
+    rect = find_frame_downscaled(inv)
+    if rect is None:
+        rect = find_frame(inv, height, width)
+    if rect is None:
         raise ValueError("Game screen not found.")
-    max_contour = max(contours2, key=lambda x: cv2.contourArea(x))
-    x, y, width, height = cv2.boundingRect(max_contour)
+    x, y, width, height = rect
     return ((x, y), (x + width, y + height))
 
 
@@ -376,11 +991,11 @@ def standardize_size(
     return frame_img, resize_scale
 
 
-def area_decision(frame_img: ndarray, display: bool = False) -> str:
+def area_decision(frame_img: ndarray, template: ndarray, display: bool = False) -> str:
     """FGOアプリの地域を選択
     "na", 'jp'に対応
 
-    'items_img.png' とのオブジェクトマッチングで判定
+    'items_img.png' (template) とのオブジェクトマッチングで判定
     """
     img = frame_img[0:100, 0:500]
     img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -388,7 +1003,6 @@ def area_decision(frame_img: ndarray, display: bool = False) -> str:
         cv2.imshow("image", img_gray)
         cv2.waitKey(0)
         cv2.destroyAllWindows()
-    template = imread(items_img, 0)
     res = cv2.matchTemplate(
         img_gray,
         template,
@@ -401,6 +1015,197 @@ def area_decision(frame_img: ndarray, display: bool = False) -> str:
     return "jp"
 
 
+def ocr_number(im_th, models, max_qp):
+    """二値化した QP などの数字の画像を SVM で読む (読めなければ -1)"""
+    h, w = im_th.shape[:2]
+    # 物体検出
+    im_th = cv2.bitwise_not(im_th)
+    contours = cv2.findContours(im_th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[
+        0
+    ]
+    item_pts = []
+    for cnt in contours:
+        ret = cv2.boundingRect(cnt)
+        area = cv2.contourArea(cnt)
+        pt = [ret[0], ret[1], ret[0] + ret[2], ret[1] + ret[3]]
+        if (
+            ret[2] < int(w / 2)
+            and area > 80
+            and ret[1] < h / 2
+            and 0.3 < ret[2] / ret[3] < 0.85
+            and ret[3] > h * 0.45
+        ):
+            flag = False
+            for p in item_pts:
+                if has_intersect(p, pt):
+                    # どちらかを消す
+                    p_area = (p[2] - p[0]) * (p[3] - p[1])
+                    pt_area = ret[2] * ret[3]
+                    if p_area < pt_area:
+                        item_pts.remove(p)
+                    else:
+                        flag = True
+
+            if flag is False:
+                item_pts.append(pt)
+
+    if len(item_pts) == 0:
+        # Recognizing Failure
+        return -1
+    item_pts.sort()
+    if len(item_pts) > len(str(max_qp)):
+        # QP may be misrecognizing the 10th digit or more, so cut it
+        item_pts = item_pts[len(item_pts) - len(str(max_qp)) :]
+    logger.debug("ocr item_pts: %s", item_pts)
+    logger.debug("ドロップ桁数(OCR): %d", len(item_pts))
+
+    imgs = []
+    for pt in item_pts:
+        if pt[0] == 0:
+            tmpimg = im_th[pt[1] : pt[3], pt[0] : pt[2] + 1]
+        else:
+            tmpimg = im_th[pt[1] : pt[3], pt[0] - 1 : pt[2] + 1]
+        imgs.append(tmpimg)
+
+    res = ""
+    for pred in models.predict("chest", imgs):
+        res = res + str(pred)
+
+    return int(res)
+
+
+def screen_fingerprint(img_rgb):
+    """同じ画面を撮ったスクショかを比べるための縮小画像"""
+    height, width = img_rgb.shape[:2]
+    size = (width // SCREEN_FINGERPRINT_SCALE, height // SCREEN_FINGERPRINT_SCALE)
+    return cv2.resize(img_rgb, size, interpolation=cv2.INTER_AREA)
+
+
+class ScreenMemo:
+    """このプロセスで最後に認識したスクショの縮小画像と認識結果
+
+    同じ戦闘結果のスクショは続けて何枚も撮られることが多い。
+    次のスクショの縮小画像が画素値の差 SCREEN_FINGERPRINT_TOLERANCE 以内で一致し、
+    縮小すると潰れるドロップ数・ボーナスの帯も元の解像度で一致して、
+    所持 QP を同じ方法 (qp_region() の範囲の SVM) で読んで同じ値なら、
+    認識結果は前のスクショと同じになるので、アイテムなどの認識を省略して使い回す。
+    所持 QP がカンストしていると別の戦闘でも同じ値なので使い回さない。
+    重複かどうかは使い回した結果から OutputMerger がいつも通り判定する
+    """
+
+    # 使い回す認識結果 (所持 QP・日時はファイルごとに読む)
+    FIELDS = ("itemlist", "chestnum", "pagenum", "pages", "lines", "qp_gained", "bunyan")
+
+    def __init__(self):
+        self.last = None
+        self.run = None
+
+    def start(self, run):
+        """認識の単位 (実行・サーバーのリクエスト) ごとに最初に呼ぶ。run が変われば忘れる"""
+        if run != self.run:
+            self.last = None
+            self.run = run
+
+    def remember(self, fingerprint, sc):
+        """ScreenShot sc の認識結果を覚える
+
+        所持 QP を範囲から読めなかったものとカンストしているものは覚えない
+        """
+        if (
+            sc.qp_pending
+            or sc.qp_readers.get("total_qp") != "region"
+            or sc.total_qp == QP_UNKNOWN
+            or sc.total_qp >= sc.max_qp
+        ):
+            self.last = None
+            return
+        regions = sc.stack_count_regions()
+        self.last = {
+            "fingerprint": fingerprint,
+            "shape": sc.img_rgb_orig.shape,
+            "stack_counts": [
+                (region, sc.img_gray_orig[region[1] : region[3], region[0] : region[2]].copy())
+                for region in regions
+            ],
+            "mode": sc.mode,
+            "max_qp": sc.max_qp,
+            "total_qp": sc.total_qp,
+            "itemlist": sc.itemlist,
+            "chestnum": sc.chestnum,
+            "pagenum": sc.pagenum,
+            "pages": sc.pages,
+            "lines": sc.lines,
+            "qp_gained": sc.qp_gained,
+            "qp_readers": sc.qp_readers,
+            "bunyan": sc.Bunyan,
+        }
+
+    def recall(self, img_rgb, fingerprint, models, exLogger):
+        """前のスクショと同じ認識結果になるなら record に入れる dict を返す。違えば None"""
+        last = self.last
+        if last is None or last["fingerprint"].shape != fingerprint.shape:
+            return None
+        if cv2.absdiff(last["fingerprint"], fingerprint).max() > SCREEN_FINGERPRINT_TOLERANCE:
+            return None
+        if img_rgb.shape != last["shape"]:
+            return None
+        analysis = pageinfo.ScreenAnalysis(img_rgb)
+        for (x1, y1, x2, y2), band in last["stack_counts"]:
+            diff = cv2.absdiff(analysis.gray[y1:y2, x1:x2], band)
+            if np.count_nonzero(diff > STACK_COUNT_DIFF) > band.size * STACK_COUNT_TOLERANCE:
+                return None
+        pt = analysis.qp_region(last["mode"])
+        if pt is None:
+            return None
+        img_gray = analysis.gray[pt[0][1] : pt[1][1], pt[0][0] : pt[1][0]]
+        _, img_th = cv2.threshold(img_gray, ScreenShot.THRESHOLD, 255, cv2.THRESH_BINARY)
+        qp_total = ocr_number(cv2.bitwise_not(img_th), models, last["max_qp"])
+        if qp_total == -1:
+            return None
+        if finish_total_qp(qp_total, last["max_qp"], exLogger) != last["total_qp"]:
+            return None
+        recalled = {name: last[name] for name in self.FIELDS}
+        recalled["itemlist"] = [dict(item) for item in last["itemlist"]]
+        recalled["total_qp"] = last["total_qp"]
+        recalled["qp_readers"] = dict(last["qp_readers"])
+        return recalled
+
+
+@functools.cache
+def get_screen_memo():
+    """プロセスで共有する ScreenMemo"""
+    return ScreenMemo()
+
+
+def finish_total_qp(qp_total, max_qp, exLogger):
+    """読み取った所持 QP を確かめる (0 は読めなかったものとする)"""
+    logger.debug("qp_total from text: %s", qp_total)
+    if qp_total > max_qp:
+        exLogger.warning(
+            "qp_total exceeds the system's maximum: %s",
+            qp_total,
+        )
+    if qp_total == 0:
+        return QP_UNKNOWN
+
+    return qp_total
+
+
+def finish_qp_gained(qp_gain):
+    """読み取った獲得 QP を確かめる (0 は読めなかったものとする)"""
+    logger.debug("qp from text: %s", qp_gain)
+    if qp_gain == 0:
+        qp_gain = QP_UNKNOWN
+
+    return qp_gain
+
+
+def check_qp_gained(qp_gained, itemlist):
+    """獲得 QP があるのにドロップが無いスクショは受け付けない"""
+    if qp_gained > 0 and len(itemlist) == 0:
+        raise GainedQPandDropMissMatchError
+
+
 def check_page_mismatch(
     page_items: int,
     chestnum: int,
@@ -422,60 +1227,84 @@ def check_page_mismatch(
     return True
 
 
+def is_grayscale(img, block_rows=64):
+    """全画素で B = G = R か
+    チャンネルごとの全体のコピーを作らないよう block_rows 行ずつ比べる
+    """
+    for top in range(0, img.shape[0], block_rows):
+        block = img[top : top + block_rows]
+        if not (
+            np.array_equal(block[..., 0], block[..., 1])
+            and np.array_equal(block[..., 1], block[..., 2])
+        ):
+            return False
+    return True
+
+
 class ScreenShot:
-    """戦利品スクリーンショットを表すクラス"""
+    """戦利品スクリーンショットを表すクラス
+
+    img_rgb_orig / img_rgb から作るグレースケール・HSV・二値化画像は
+    最初に参照したときに作る
+    img_rgb_orig のグレースケール画像・所持 QP 領域は pageinfo と
+    analysis (pageinfo.ScreenAnalysis) で共有する
+    """
+
+    THRESHOLD = 80
 
     def __init__(
         self,
         args,
         img_rgb,
-        svm,
-        svm_chest,
-        svm_dcnt,
-        svm_card,
-        svm_exp_class,
+        models,
         fileextention,
         exLogger,
         reward_only=False,
+        defer_tesseract=False,
     ):
+        self.models = models
+        # True のときは tesseract で読む QP を qp_pending に残して None にする
+        # (read_pending_qp() でまとめて読む)
+        self.defer_tesseract = defer_tesseract
+        self.qp_pending = {}
         self.exLogger = exLogger
-        threshold = 80
         self.img_rgb_orig = img_rgb
-        img_blue, img_green, img_red = cv2.split(img_rgb)
-        if (img_blue == img_green).all() & (img_green == img_red).all():
+        if is_grayscale(img_rgb):
             raise ValueError("Input image is grayscale")
-        self.img_gray_orig = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2GRAY)
-        self.img_hsv_orig = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
-        _, self.img_th_orig = cv2.threshold(
-            self.img_gray_orig,
-            threshold,
-            255,
-            cv2.THRESH_BINARY,
-        )
-
-        (self.x1, self.y1), (self.x2, self.y2) = get_coodinates(self.img_rgb_orig)
+        with stage("frame"):
+            self.analysis = pageinfo.ScreenAnalysis(img_rgb)
+            (self.x1, self.y1), (self.x2, self.y2) = get_coodinates(
+                self.img_rgb_orig, img_gray=self.img_gray_orig
+            )
         # Remove the extra notch by centering
         center = int((self.x2 - self.x1) / 2 + self.x1)
         half_width = min(center, img_rgb.shape[1] - center)
-        img_rgb_tmp = img_rgb[:, center - half_width : center + half_width]
+        analysis_tmp = self.analysis.columns(center - half_width, center + half_width)
         try:
-            self.pagenum, self.pages, self.lines = pageinfo.guess_pageinfo(img_rgb_tmp)
+            with stage("pageinfo"):
+                self.pagenum, self.pages, self.lines = pageinfo.guess_pageinfo(
+                    analysis_tmp, next_button=models.template("next")
+                )
             if self.lines / self.pages > 3:
                 logger.warning("The maximum number of lines has been exceeded")
                 self.lines = self.pages * 3
         except pageinfo.TooManyAreasDetectedError:
             self.pagenum, self.pages, self.lines = (-1, -1, -1)
-        frame_img: ndarray = self.img_rgb_orig[self.y1 : self.y2, self.x1 : self.x2]
-        img_resize, resize_scale = standardize_size(frame_img)
-        self.img_rgb = img_resize
-        mode = area_decision(img_resize)
+        with stage("standardize"):
+            frame_img: ndarray = self.img_rgb_orig[self.y1 : self.y2, self.x1 : self.x2]
+            img_resize, resize_scale = standardize_size(frame_img)
+            self.img_rgb = img_resize
+            self.resize_scale = resize_scale
+            mode = area_decision(img_resize, models.template("items"))
         logger.debug("lang: %s", mode)
+        self.mode = mode
         # UI modeを決める
         sc = Context()
         sc.change_state(mode)
         self.max_qp = sc.state.max_qp
         self.screen_type = sc.state.screen_type
-        dcnt_old, dcnt_new = self.drop_count_area(self.img_rgb_orig, resize_scale, sc)
+        with stage("drop_count"):
+            dcnt_old, dcnt_new = self.drop_count_area(self.img_rgb_orig, resize_scale, sc)
 
         if logger.isEnabledFor(logging.DEBUG):
             cv2.imwrite("frame_img.png", img_resize)
@@ -485,26 +1314,22 @@ class ScreenShot:
                 cv2.imwrite("dcnt_old.png", dcnt_old)
             cv2.imwrite("dcnt_new.png", dcnt_new)
 
-        self.img_gray = cv2.cvtColor(self.img_rgb, cv2.COLOR_BGR2GRAY)
-        _, self.img_th = cv2.threshold(self.img_gray, threshold, 255, cv2.THRESH_BINARY)
-        self.svm = svm
-        self.svm_chest = svm_chest
-        self.svm_dcnt = svm_dcnt
-
         self.height, self.width = self.img_rgb.shape[:2]
-        if self.screen_type == "normal":
-            self.chestnum = self.ocr_tresurechest(dcnt_old)
-            if self.chestnum == -1:
+        with stage("drop_count"):
+            if self.screen_type == "normal":
+                self.chestnum = self.ocr_tresurechest(dcnt_old)
+                if self.chestnum == -1:
+                    self.chestnum = self.ocr_dcnt(dcnt_new)
+            else:
                 self.chestnum = self.ocr_dcnt(dcnt_new)
-        else:
-            self.chestnum = self.ocr_dcnt(dcnt_new)
-        self.asr_y, self.actual_height = self.detect_scroll_bar()
 
         logger.debug("Total Drop (OCR): %d", self.chestnum)
         item_pts = self.img2points(mode)
         logger.debug("item_pts:%s", item_pts)
 
         self.items = []
+        # アイテムの img_rgb での範囲 (left, top, right, bottom)
+        self.item_rects = []
         self.current_dropPriority = PRIORITY_REWARD_QP
         if reward_only:
             # qpsplit.py で利用
@@ -512,7 +1337,7 @@ class ScreenShot:
         prev_item = None
 
         # まんわか用イベント判定
-        template1 = cv2.imread(str(bunyan1_img), 0)
+        template1 = models.template("bunyan1")
         item15th = self.img_gray[
             item_pts[15][1] : item_pts[15][3],
             item_pts[15][0] : item_pts[15][2],
@@ -547,9 +1372,7 @@ class ScreenShot:
                 prev_item,
                 item_img_rgb,
                 item_img_gray,
-                svm,
-                svm_card,
-                svm_exp_class,
+                models,
                 fileextention,
                 self.current_dropPriority,
                 self.exLogger,
@@ -557,11 +1380,12 @@ class ScreenShot:
             )
             if dropitem.id == -1:
                 break
-            self.current_dropPriority = item_dropPriority[dropitem.id]
+            self.current_dropPriority = catalog.item_dropPriority[dropitem.id]
             if dropitem.id in [94069601, 94069602, 94069603]:
                 # まんわかイベントのバニヤンに隠されているドロップが問題を生じるので補正
                 dropitem.dropnum = "x3"
             self.items.append(dropitem)
+            self.item_rects.append((pt[0] + lx, pt[1], pt[2] + lx, pt[3]))
             prev_item = dropitem
 
         if self.Bunyan:
@@ -586,27 +1410,39 @@ class ScreenShot:
                 prev_item,
                 item_img_rgb,
                 item_img_gray,
-                svm,
-                svm_card,
-                svm_exp_class,
+                models,
                 fileextention,
                 self.current_dropPriority,
                 self.exLogger,
                 mode,
             )
             self.items.append(dropitem)
+            self.item_rects.append(
+                (item_pts[14][0] + lx, item_pts[14][1], item_pts[14][2] + lx, item_pts[14][3])
+            )
 
         self.itemlist = self.makeitemlist()
+        # スクショをまたぐキャッシュを使えた回数 ("tile_hit", "stack_miss" など)
+        self.cache_stats = Counter()
+        for item in self.items:
+            for name in ("tile", "stack"):
+                cached = getattr(item, name + "_cached")
+                if cached is not None:
+                    self.cache_stats[name + ("_hit" if cached else "_miss")] += 1
+        # QP をどの方法で読んだか ("region", "fallback", "tesseract", "failed")
+        self.qp_readers = {}
         try:
-            self.total_qp = self.get_qp(mode)
-            self.qp_gained = self.get_qp_gained(mode)
+            with stage("qp"):
+                self.total_qp = self.get_qp(mode)
+                self.qp_gained = self.get_qp_gained(mode)
         except Exception as e:
             self.total_qp = -1
             self.qp_gained = -1
+            self.qp_pending = {}
             self.exLogger.warning("QP detection fails")
             logger.exception(e)
-        if self.qp_gained > 0 and len(self.itemlist) == 0:
-            raise GainedQPandDropMissMatchError
+        if self.qp_gained is not None:
+            check_qp_gained(self.qp_gained, self.itemlist)
         logger.debug(
             f"pagenum(pageninfo) pagenum: {self.pagenum}, pages: {self.pages}, lines: {self.lines}",
         )
@@ -634,6 +1470,55 @@ class ScreenShot:
             self.exLogger.warning("drops_count = %d", self.chestnum)
             self.exLogger.warning("drops_found = %d", len(self.itemlist))
 
+    def stack_count_regions(self):
+        """アイテムごとのドロップ数・ボーナスの帯の img_rgb_orig での範囲 (x1, y1, x2, y2)"""
+        height, width = self.img_rgb_orig.shape[:2]
+        regions = []
+        for left, top, right, bottom in self.item_rects:
+            top += (bottom - top) * STACK_COUNT_BAND_TOP // 206
+            x1, y1, x2, y2 = (
+                round(self.x1 + left / self.resize_scale),
+                round(self.y1 + top / self.resize_scale),
+                round(self.x1 + right / self.resize_scale),
+                round(self.y1 + bottom / self.resize_scale),
+            )
+            regions.append((max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)))
+        return regions
+
+    @property
+    def img_gray_orig(self):
+        return self.analysis.gray
+
+    @functools.cached_property
+    def img_hsv_orig(self):
+        return cv2.cvtColor(self.img_rgb_orig, cv2.COLOR_BGR2HSV)
+
+    @functools.cached_property
+    def img_th_orig(self):
+        _, img_th = cv2.threshold(
+            self.img_gray_orig, self.THRESHOLD, 255, cv2.THRESH_BINARY
+        )
+        return img_th
+
+    @functools.cached_property
+    def img_gray(self):
+        return cv2.cvtColor(self.img_rgb, cv2.COLOR_BGR2GRAY)
+
+    @functools.cached_property
+    def img_th(self):
+        _, img_th = cv2.threshold(self.img_gray, self.THRESHOLD, 255, cv2.THRESH_BINARY)
+        return img_th
+
+    def crop_th_orig(self, top, bottom, left, right):
+        """img_th_orig[top:bottom, left:right] と同じもの
+        画素ごとの変換なので、全体を作らずにその範囲だけ二値化する
+        """
+        if "img_th_orig" in self.__dict__:
+            return self.img_th_orig[top:bottom, left:right]
+        img_gray = self.img_gray_orig[top:bottom, left:right]
+        _, img_th = cv2.threshold(img_gray, self.THRESHOLD, 255, cv2.THRESH_BINARY)
+        return img_th
+
     def find_notch(self):
         """直線検出で検出されなかったフチ幅を検出"""
         edge_width = 200
@@ -717,6 +1602,21 @@ class ScreenShot:
             cv2.destroyAllWindows()
         return dcnt_old, dcnt_new
 
+    @functools.cached_property
+    def scroll_bar(self):
+        """detect_scroll_bar() の結果 (asr_y, actual_height)
+        ページ情報の補正などで必要になったときだけ検出する
+        """
+        return self.detect_scroll_bar()
+
+    @property
+    def asr_y(self):
+        return self.scroll_bar[0]
+
+    @property
+    def actual_height(self):
+        return self.scroll_bar[1]
+
     def detect_scroll_bar(self):
         """Modified from determine_scroll_position()"""
         width = self.img_rgb.shape[1]
@@ -818,7 +1718,8 @@ class ScreenShot:
             return True
         return False
 
-    def get_qp_from_text(self, text):
+    @staticmethod
+    def get_qp_from_text(text):
         """capy-drop-parser から流用"""
         qp = 0
         power = 1
@@ -832,63 +1733,126 @@ class ScreenShot:
 
     def extract_text_from_image(self, image):
         """capy-drop-parser から流用"""
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        _, qp_image = cv2.threshold(gray, 65, 255, cv2.THRESH_BINARY_INV)
+        import pytesseract  # 読み込みが重いので使うときに import する
 
         return pytesseract.image_to_string(
-            qp_image,
-            config="-l eng --oem 1 --psm 7 -c tessedit_char_whitelist=+,0123456789",
+            tesseract_qp_image(image), config=TESSERACT_QP_CONFIG
         )
 
+    def ocr_qp_fallback(self, bounds):
+        """QP 欄が検出できなかったときに固定範囲 bounds の QP を読む
+
+        数字を切り出して "qp" の SVM で読む。
+        ("+" と "," は縦横比と高さで除く)
+        読めなかったときと、数字がつながっていたり、決定値の余裕が
+        QP_FALLBACK_MARGIN 未満の字や先頭の 0 があったりして
+        読み取り結果が信用できないときは -1 を返す
+        """
+        topleft, bottomright = bounds
+        img_gray = self.img_gray[topleft[1] : bottomright[1], topleft[0] : bottomright[0]]
+        # extract_text_from_image() と同じしきい値
+        _, im_th = cv2.threshold(img_gray, 65, 255, cv2.THRESH_BINARY)
+        h, w = im_th.shape[:2]
+        contours = cv2.findContours(im_th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[
+            0
+        ]
+        rects = []
+        wide_heights = []
+        for cnt in contours:
+            x, y, cw, ch = cv2.boundingRect(cnt)
+            # 範囲の端で切れているものは数字ではない
+            if x == 0 or x + cw == w or y == 0 or y + ch == h:
+                continue
+            if h * 0.3 < ch and 0.2 < cw / ch < 0.9:
+                rects.append((x, y, cw, ch))
+            elif h * 0.3 < ch and cw / ch >= 0.9:
+                wide_heights.append(ch)
+        if len(rects) == 0:
+            return -1
+        max_height = max(r[3] for r in rects)
+        rects = sorted(r for r in rects if r[3] >= max_height * 0.8)
+        if len(rects) > len(str(self.max_qp)):
+            return -1
+        # 数字の高さで横に広いものはつながった数字なので、桁が欠けて読める
+        if any(ch >= max_height * 0.8 for ch in wide_heights):
+            logger.debug("qp fallback rejected: joined digits")
+            return -1
+        logger.debug("qp fallback rects: %s", rects)
+        imgs = [im_th[y : y + ch, max(x - 1, 0) : x + cw + 1] for x, y, cw, ch in rects]
+        preds, margins = self.models.predict_with_margins("qp", imgs)
+        if margins is not None and margins.min() < QP_FALLBACK_MARGIN:
+            logger.debug("qp fallback rejected: margins %s", margins)
+            return -1
+        text = "".join(str(pred) for pred in preds)
+        if (len(text) > 1 and text[0] == "0") or int(text) > self.max_qp:
+            logger.debug("qp fallback rejected: %s", text)
+            return -1
+        return int(text)
+
+    def read_qp_fallback(self, name, bounds):
+        """固定範囲 bounds の QP を読み、使った方法を qp_readers[name] に記録する
+
+        "qp" の SVM で読めなかったときだけ、tesseract が使えれば使う
+        defer_tesseract のときは tesseract に渡す画像を qp_pending に残して None を返す
+        """
+        count_event("qp_fallback")
+        qp = self.ocr_qp_fallback(bounds)
+        if qp != -1:
+            self.qp_readers[name] = "fallback"
+            return qp
+        try:
+            import pytesseract  # noqa: F401
+        except ImportError:
+            self.exLogger.warning("%s cannot be read", name)
+            self.qp_readers[name] = "failed"
+            return 0
+        logger.debug("Use tesseract")
+        self.qp_readers[name] = "tesseract"
+        topleft, bottomright = bounds
+        image = self.img_rgb[topleft[1] : bottomright[1], topleft[0] : bottomright[0]]
+        if self.defer_tesseract:
+            self.qp_pending[name] = tesseract_qp_image(image)
+            return None
+        count_event("tesseract")
+        qp_text = self.extract_text_from_image(image)
+        logger.debug("qp text from tesseract: %s", qp_text)
+        return self.get_qp_from_text(qp_text)
+
     def get_qp(self, mode):
         """capy-drop-parser から流用
         tesseract-OCR is quite slow and changed to use SVM
         """
-        use_tesseract = False
-        pt = pageinfo.detect_qp_region(self.img_rgb_orig, mode)
+        pt = self.analysis.qp_region(mode)
         logger.debug("pt from pageinfo: %s", pt)
-        if pt is None:
-            use_tesseract = True
 
         qp_total = -1
-        if use_tesseract is False:  # use SVM
+        if pt is not None:  # use SVM
             im_th = cv2.bitwise_not(
-                self.img_th_orig[pt[0][1] : pt[1][1], pt[0][0] : pt[1][0]],
+                self.crop_th_orig(pt[0][1], pt[1][1], pt[0][0], pt[1][0]),
             )
             qp_total = self.ocr_text(im_th)
-        if use_tesseract or qp_total == -1:
+            self.qp_readers["total_qp"] = "region"
+        if qp_total == -1:
             if self.screen_type == "normal":
                 pt = ((288, 948), (838, 1024))
             else:
                 pt = ((288, 838), (838, 914))
-            logger.debug("Use tesseract")
-            qp_total_text = self.extract_text_from_image(
-                self.img_rgb[pt[0][1] : pt[1][1], pt[0][0] : pt[1][0]],
-            )
-            logger.debug("qp_total_text from text: %s", qp_total_text)
-            qp_total = self.get_qp_from_text(qp_total_text)
-
-        logger.debug("qp_total from text: %s", qp_total)
-        if qp_total > self.max_qp:
-            self.exLogger.warning(
-                "qp_total exceeds the system's maximum: %s",
-                qp_total,
-            )
-        if qp_total == 0:
-            return QP_UNKNOWN
+            qp_total = self.read_qp_fallback("total_qp", pt)
+            if qp_total is None:
+                return None
 
-        return qp_total
+        return finish_total_qp(qp_total, self.max_qp, self.exLogger)
 
     def get_qp_gained(self, mode):
-        use_tesseract = False
-        bounds = pageinfo.detect_qp_region(self.img_rgb_orig, mode)
+        use_fallback = False
+        bounds = self.analysis.qp_region(mode)
         if bounds is None:
             # fall back on hardcoded bound
             if self.screen_type == "normal":
                 bounds = ((398, 858), (948, 934))
             else:
                 bounds = ((398, 748), (948, 824))
-            use_tesseract = True
+            use_fallback = True
         else:
             # Detecting the QP box with different shading is "easy", while detecting the absence of it
             # for the gain QP amount is hard. However, the 2 values have the same font and thus roughly
@@ -907,26 +1871,20 @@ class ScreenShot:
             cv2.imwrite("./qp_gain_detection.jpg", img_copy)
 
         qp_gain = -1
-        if use_tesseract is False:
+        if use_fallback is False:
             im_th = cv2.bitwise_not(
-                self.img_th_orig[
-                    topleft[1] : bottomright[1],
-                    topleft[0] : bottomright[0],
-                ],
+                self.crop_th_orig(
+                    topleft[1], bottomright[1], topleft[0], bottomright[0]
+                ),
             )
             qp_gain = self.ocr_text(im_th)
-        if use_tesseract or qp_gain == -1:
-            logger.debug("Use tesseract")
-            topleft, bottomright = bounds
-            qp_gain_text = self.extract_text_from_image(
-                self.img_rgb[topleft[1] : bottomright[1], topleft[0] : bottomright[0]],
-            )
-            qp_gain = self.get_qp_from_text(qp_gain_text)
-        logger.debug("qp from text: %s", qp_gain)
-        if qp_gain == 0:
-            qp_gain = QP_UNKNOWN
+            self.qp_readers["qp_gained"] = "region"
+        if use_fallback or qp_gain == -1:
+            qp_gain = self.read_qp_fallback("qp_gained", bounds)
+            if qp_gain is None:
+                return None
 
-        return qp_gain
+        return finish_qp_gained(qp_gain)
 
     def find_edge(self, img_th, reverse=False):
         """直線検出で検出されなかったフチ幅を検出"""
@@ -961,7 +1919,7 @@ class ScreenShot:
             tmp = {}
             tmp["id"] = item.id
             tmp["name"] = item.name
-            tmp["dropPriority"] = item_dropPriority[item.id]
+            tmp["dropPriority"] = catalog.item_dropPriority[item.id]
             tmp["dropnum"] = int(item.dropnum[1:])
             tmp["bonus"] = item.bonus
             tmp["category"] = item.category
@@ -969,72 +1927,7 @@ class ScreenShot:
         return itemlist
 
     def ocr_text(self, im_th):
-        h, w = im_th.shape[:2]
-        # 物体検出
-        im_th = cv2.bitwise_not(im_th)
-        contours = cv2.findContours(im_th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[
-            0
-        ]
-        item_pts = []
-        for cnt in contours:
-            ret = cv2.boundingRect(cnt)
-            area = cv2.contourArea(cnt)
-            pt = [ret[0], ret[1], ret[0] + ret[2], ret[1] + ret[3]]
-            if (
-                ret[2] < int(w / 2)
-                and area > 80
-                and ret[1] < h / 2
-                and 0.3 < ret[2] / ret[3] < 0.85
-                and ret[3] > h * 0.45
-            ):
-                flag = False
-                for p in item_pts:
-                    if has_intersect(p, pt):
-                        # どちらかを消す
-                        p_area = (p[2] - p[0]) * (p[3] - p[1])
-                        pt_area = ret[2] * ret[3]
-                        if p_area < pt_area:
-                            item_pts.remove(p)
-                        else:
-                            flag = True
-
-                if flag is False:
-                    item_pts.append(pt)
-
-        if len(item_pts) == 0:
-            # Recognizing Failure
-            return -1
-        item_pts.sort()
-        if len(item_pts) > len(str(self.max_qp)):
-            # QP may be misrecognizing the 10th digit or more, so cut it
-            item_pts = item_pts[len(item_pts) - len(str(self.max_qp)) :]
-        logger.debug("ocr item_pts: %s", item_pts)
-        logger.debug("ドロップ桁数(OCR): %d", len(item_pts))
-
-        # Hog特徴のパラメータ
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-
-        res = ""
-        for pt in item_pts:
-            test = []
-
-            if pt[0] == 0:
-                tmpimg = im_th[pt[1] : pt[3], pt[0] : pt[2] + 1]
-            else:
-                tmpimg = im_th[pt[1] : pt[3], pt[0] - 1 : pt[2] + 1]
-            tmpimg = cv2.resize(tmpimg, (win_size))
-            hog = cv2.HOGDescriptor(win_size, block_size, block_stride, cell_size, bins)
-            test.append(hog.compute(tmpimg))  # 特徴量の格納
-            test = np.array(test)
-
-            pred = self.svm_chest.predict(test)
-            res = res + str(int(pred[1][0][0]))
-
-        return int(res)
+        return ocr_number(im_th, self.models, self.max_qp)
 
     def ocr_tresurechest(self, drop_count_img):
         """宝箱数をOCRする関数"""
@@ -1051,28 +1944,12 @@ class ScreenShot:
             im_th[0, x] = 255
         return self.ocr_text(im_th)
 
-    def pred_dcnt(self, img):
+    def pred_dcnt(self, imgs):
         """For JP new UI"""
-        # Hog特徴のパラメータ
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-        char = []
-
-        tmpimg = cv2.resize(img, (win_size))
-        hog = cv2.HOGDescriptor(win_size, block_size, block_stride, cell_size, bins)
-        char.append(hog.compute(tmpimg))  # 特徴量の格納
-        char = np.array(char)
-
-        pred = self.svm_dcnt.predict(char)
-        res = str(int(pred[1][0][0]))
-
-        return int(res)
+        return self.models.predict("dcnt", imgs)
 
     def img2num(self, img, img_th, pts, char_w, end):
-        """実際より小さく切り抜かれた数字画像を補正して認識させる"""
+        """実際より小さく切り抜かれた数字画像を補正する"""
         height, width = img.shape[:2]
         c_center = int(pts[0] + (pts[2] - pts[0]) / 2)
         # newimg = img[:, item_pts[-1][0]-1:item_pts[-1][2]+1]
@@ -1095,8 +1972,7 @@ class ScreenShot:
             newimg_th[height - 2, w] = 0
             newimg_th[height - 3, w] = 0
 
-        res = self.pred_dcnt(newimg_th)
-        return res
+        return newimg_th
 
     def ocr_dcnt(self, drop_count_img):
         """Ocr drop_count (for New UI)"""
@@ -1139,15 +2015,18 @@ class ScreenShot:
             return -1
         item_pts.sort()
 
-        res = self.img2num(img, img_th, item_pts[-1], char_w, end)
+        # 下の桁から読む桁を決めて、まとめて認識する
+        digits = [item_pts[-1]]
         if len(item_pts) >= 2:
             if item_pts[-1][0] - item_pts[-2][2] < char_w / (2 / 3):
-                res2 = self.img2num(img, img_th, item_pts[-2], char_w, end)
-                res = res2 * 10 + res
+                digits.append(item_pts[-2])
                 if len(item_pts) == 3:
                     if item_pts[-2][0] - item_pts[-3][2] < char_w / (2 / 3):
-                        res3 = self.img2num(img, img_th, item_pts[-3], char_w, end)
-                        res = res3 * 100 + res2 * 10 + res
+                        digits.append(item_pts[-3])
+        imgs = [self.img2num(img, img_th, pts, char_w, end) for pts in digits]
+        res = 0
+        for k, num in enumerate(self.pred_dcnt(imgs)):
+            res = res + num * 10**k
 
         return res
 
@@ -1320,7 +2199,144 @@ def generate_booty_pts(
     return pts
 
 
+class StackCache:
+    """スクショをまたいでドロップ数・ボーナスの読み取り結果を覚える LRU キャッシュ
+
+    キーは Item.stack_cache_key() の (アイテムID, 画面の種類, タイルの大きさ)、
+    値はドロップ数から下の帯の画像と読み取り結果 (フォントサイズを含む) のリスト。
+    帯の画像が完全に一致するか、ほぼ一致 (TM_CCOEFF_NORMED が THRESHOLD 以上) すれば
+    その結果を返す。帯はボーナスの位置まで含むので、ボーナスが変わると一致しない
+    """
+
+    THRESHOLD = 0.97
+    MARGIN = 2  # ほぼ一致を探すときにずれを許す幅 (px)
+    LEFT = 5  # 帯の左右の余白 (px)
+
+    def __init__(self, keys=STACK_CACHE_KEYS, entries=STACK_CACHE_ENTRIES):
+        self.keys = keys
+        self.entries = entries
+        self.table = OrderedDict()
+
+    @classmethod
+    def band(cls, img_gray, top, margin=0):
+        """img_gray のドロップ数から下の帯 (上端が top) を切り抜く"""
+        height, width = img_gray.shape
+        return img_gray[
+            max(top - margin, 0) : height - cls.MARGIN + margin,
+            cls.LEFT - margin : width - cls.LEFT + margin,
+        ]
+
+    def find(self, key, img_gray):
+        """img_gray の帯と一致する読み取り結果を返す。無ければ None"""
+        found = self.table.get(key)
+        if found is None:
+            return None
+        self.table.move_to_end(key)
+        for entry in found:
+            template = entry["img"]
+            if np.array_equal(self.band(img_gray, entry["top"]), template):
+                return entry
+        for entry in found:
+            img = self.band(img_gray, entry["top"], self.MARGIN)
+            template = entry["img"]
+            if img.shape[0] < template.shape[0] or img.shape[1] < template.shape[1]:
+                continue
+            res = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
+            if res.max() >= self.THRESHOLD:
+                return entry
+        return None
+
+    def add(self, key, img_gray, top, **result):
+        """img_gray の読み取り結果 result (dropnum, bonus, bonus_pts, font_size) を覚える"""
+        found = self.table.setdefault(key, [])
+        self.table.move_to_end(key)
+        found.insert(0, {"top": top, "img": self.band(img_gray, top).copy(), **result})
+        del found[self.entries :]
+        while len(self.table) > self.keys:
+            self.table.popitem(last=False)
+
+    def clear(self):
+        self.table.clear()
+
+
+@functools.cache
+def get_stack_cache():
+    """プロセスで共有する StackCache (認識を続ける間、スクショをまたいで使う)"""
+    return StackCache()
+
+
+class TileCache:
+    """スクショをまたいでアイテム画像の pHash と判別結果 (id, カテゴリ) を覚える LRU キャッシュ
+
+    背景が同じで pHash の距離が THRESHOLD 以下のものがあれば、その判別結果を返す
+    (同じスクショの直前のアイテムと比べていたときと同じ条件)。
+    報酬 QP・QP と、似ているものがある石・サイコロ・種火・お茶は覚えない
+    """
+
+    THRESHOLD = 4
+
+    def __init__(self, size=TILE_CACHE_SIZE):
+        self.size = size
+        self.table = OrderedDict()  # (背景, pHash のバイト列): (id, カテゴリ)
+        self.keys = None  # 距離計算用の table のキーの並びと配列 (table が変わったら作り直す)
+        self.hashes = None
+
+    @staticmethod
+    def cacheable(id):
+        return not (
+            id in (-1, ID_QP, ID_REWARD_QP)
+            or ID_GEM_MIN <= id <= ID_SECRET_GEM_MAX
+            or ID_2ZORO_DICE <= id <= ID_3ZORO_DICE
+            or ID_EXP_MIN <= id <= ID_EXP_MAX
+            or ID_GREEN_TEA <= id <= ID_RED_TEA
+        )
+
+    def find(self, background, hash_item):
+        """(id, カテゴリ) を返す。無ければ None"""
+        key = (background, hash_item.tobytes())
+        if key not in self.table:
+            if len(self.table) == 0:
+                return None
+            if self.keys is None:
+                self.keys = list(self.table)
+                self.hashes = np.frombuffer(
+                    b"".join(h for _, h in self.keys), dtype=np.uint64
+                )
+            target = np.frombuffer(key[1], dtype=np.uint64)[0]
+            dist = popcount(self.hashes ^ target)
+            dist[[bg != background for bg, _ in self.keys]] = self.THRESHOLD + 1
+            k = int(dist.argmin())
+            if dist[k] > self.THRESHOLD:
+                return None
+            key = self.keys[k]
+        self.table.move_to_end(key)
+        return self.table[key]
+
+    def add(self, background, hash_item, id, category):
+        if not self.cacheable(id):
+            return
+        self.table[(background, hash_item.tobytes())] = (id, category)
+        while len(self.table) > self.size:
+            self.table.popitem(last=False)
+        self.keys = None
+
+    def clear(self):
+        self.table.clear()
+        self.keys = None
+
+
+@functools.cache
+def get_tile_cache():
+    """プロセスで共有する TileCache (認識を続ける間、スクショをまたいで使う)"""
+    return TileCache()
+
+
 class Item:
+    """ドロップアイテム1つ分の画像を表すクラス
+
+    HSV・二値化画像は最初に参照したときに作る
+    """
+
     def __init__(
         self,
         args,
@@ -1328,61 +2344,58 @@ class Item:
         prev_item,
         img_rgb,
         img_gray,
-        svm,
-        svm_card,
-        svm_exp_class,
+        models,
         fileextention,
         current_dropPriority,
         exLogger,
         mode="jp",
     ):
+        self.models = models
         self.position = pos
         self.prev_item = prev_item
         self.img_rgb = img_rgb
         self.img_gray = img_gray
-        self.img_hsv = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
-        _, img_th = cv2.threshold(self.img_gray, 174, 255, cv2.THRESH_BINARY)
-        self.img_th = cv2.bitwise_not(img_th)
         self.fileextention = fileextention
         self.exLogger = exLogger
         self.dropnum_cache = []
+        # 判別結果・ドロップ数を TileCache・StackCache から得たか
+        # (True/False、使わなかったときは None)
+        self.tile_cached = None
+        self.stack_cached = None
         self.margin_left = 5
 
         self.height, self.width = img_rgb.shape[:2]
         logger.debug("pos: %d", pos)
-        self.identify_item(
-            args,
-            prev_item,
-            svm_card,
-            svm_exp_class,
-            current_dropPriority,
-        )
+        with stage("tile"):
+            self.identify_item(args, prev_item, current_dropPriority)
         if self.id == -1:
             return
         logger.debug("id: %d", self.id)
         logger.debug("background: %s", self.background)
-        logger.debug("dropPriority: %s", item_dropPriority[self.id])
+        logger.debug("dropPriority: %s", catalog.item_dropPriority[self.id])
         logger.debug("Category: %s", self.category)
         logger.debug("Name: %s", self.name)
 
-        self.svm = svm
         self.bonus = ""
         # if self.category != "Craft Essence" and self.category != "Exp. UP":
         if self.category != "Craft Essence":
-            self.ocr_digit(mode)
+            with stage("stack"):
+                self.ocr_digit(mode)
         else:
             self.dropnum = "x1"
         logger.debug("Bonus: %s", self.bonus)
         logger.debug("Stack: %s", self.dropnum)
 
-    def identify_item(
-        self,
-        args,
-        prev_item,
-        svm_card,
-        svm_exp_class,
-        current_dropPriority,
-    ):
+    @functools.cached_property
+    def img_hsv(self):
+        return cv2.cvtColor(self.img_rgb, cv2.COLOR_BGR2HSV)
+
+    @functools.cached_property
+    def img_th(self):
+        _, img_th = cv2.threshold(self.img_gray, 174, 255, cv2.THRESH_BINARY)
+        return cv2.bitwise_not(img_th)
+
+    def identify_item(self, args, prev_item, current_dropPriority):
         self.background = classify_background(self.img_rgb)
         self.hash_item = compute_hash(self.img_rgb)  # 画像の距離
         if prev_item is not None:
@@ -1400,26 +2413,36 @@ class Item:
                     or ID_GREEN_TEA <= prev_item.id <= ID_RED_TEA
                 )
             ):
-                d = hasher.compare(self.hash_item, prev_item.hash_item)
+                d = get_hasher().compare(self.hash_item, prev_item.hash_item)
                 if d <= 4:
                     self.category = prev_item.category
                     self.id = prev_item.id
                     self.name = prev_item.name
                     return
-        self.category = self.classify_category(svm_card)
-        self.id = self.classify_card(self.img_rgb, svm_exp_class, current_dropPriority)
+        cached = get_tile_cache().find(self.background, self.hash_item)
+        # ドロップは dropPriority の高い順に並ぶので、前のアイテムより高いものは使わない
+        if cached is not None and catalog.item_dropPriority[cached[0]] > current_dropPriority:
+            cached = None
+        self.tile_cached = cached is not None
+        if cached is not None:
+            self.id, self.category = cached
+        else:
+            self.category = self.classify_category()
+            self.id = self.classify_card(self.img_rgb, current_dropPriority)
         if args.lang == "jpn":
-            self.name = item_name[self.id]
-        elif self.id in item_name_eng:
-            self.name = item_name_eng[self.id]
+            self.name = catalog.item_name[self.id]
+        elif self.id in catalog.item_name_eng:
+            self.name = catalog.item_name_eng[self.id]
         else:
-            self.name = item_name[self.id]
+            self.name = catalog.item_name[self.id]
 
         if self.category == "":
-            if self.id in item_type:
-                self.category = item_type[self.id]
+            if self.id in catalog.item_type:
+                self.category = catalog.item_type[self.id]
             else:
                 self.category = "Item"
+        if cached is None:
+            get_tile_cache().add(self.background, self.hash_item, self.id, self.category)
 
     def conflictcheck(self, pts, pt):
         """Pt が ptsのどれかと衝突していたら面積に応じて入れ替える"""
@@ -1656,6 +2679,8 @@ class Item:
         else:
             max_digits = 7
 
+        # 候補の位置をまとめて読んでから、右から順に判定する
+        scan = []
         for i in range(max_digits):
             if i == 0:
                 continue
@@ -1671,16 +2696,19 @@ class Item:
                 - comma_width * int((i - 1) / 3),
                 base_line,
             ]
-            result = self.read_char(pt)
-            if i == 1 and ord(result) == 0:
+            scan.append((i, pt))
+        results = self.read_chars([pt for _, pt in scan])
+        for (k, _), result in zip(scan, results, strict=True):
+            if k == 1 and ord(result) == 0:
                 # アイテム数 x1 とならず表記無し場合のエラー処理
                 return "", pts
             if result in ["x", "+"]:
+                i = k
                 break
         # 決まった位置まで出力する
         line = ""
-        for j in range(i):
-            pt = [
+        row = [
+            [
                 self.width
                 - margin_right
                 - cut_width * (j + 1)
@@ -1689,7 +2717,9 @@ class Item:
                 self.width - margin_right - cut_width * j - comma_width * int(j / 3),
                 base_line,
             ]
-            c = self.read_char(pt)
+            for j in range(i)
+        ]
+        for j, (pt, c) in enumerate(zip(row, self.read_chars(row), strict=True)):
             if ord(c) == 0:  # Null文字対策
                 line = line + "?"
                 break
@@ -1726,6 +2756,8 @@ class Item:
         pts = []
         max_digits = 7
 
+        # 候補の位置をまとめて読んでから、右から順に判定する
+        scan = []
         for i in range(max_digits):
             if i == 0:
                 continue
@@ -1741,16 +2773,19 @@ class Item:
                 - comma_width * int((i - 1) / 3),
                 base_line,
             ]
-            result = self.read_char(pt)
-            if i == 1 and ord(result) == 0:
+            scan.append((i, pt))
+        results = self.read_chars([pt for _, pt in scan])
+        for (k, _), result in zip(scan, results, strict=True):
+            if k == 1 and ord(result) == 0:
                 # アイテム数 x1 とならず表記無し場合のエラー処理
                 return "", pts
             if result in ["x", "+"]:
+                i = k
                 break
         # 決まった位置まで出力する
         line = ""
-        for j in range(i):
-            pt = [
+        row = [
+            [
                 self.width
                 - margin_right
                 - cut_width * (j + 1)
@@ -1759,7 +2794,9 @@ class Item:
                 self.width - margin_right - cut_width * j - comma_width * int(j / 3),
                 base_line,
             ]
-            c = self.read_char(pt)
+            for j in range(i)
+        ]
+        for j, (pt, c) in enumerate(zip(row, self.read_chars(row), strict=True)):
             if ord(c) == 0:  # Null文字対策
                 line = line + "?"
                 break
@@ -1793,6 +2830,8 @@ class Item:
         cut_width, cut_height, comma_width = self.define_fontsize(font_size, mode)
         top_y = base_line - cut_height
         # まず、+, xの位置が何桁目か調査する
+        # 候補の位置をまとめて読んでから、右から順に判定する
+        scan = []
         for i in range(8):  # 8桁以上は無い
             if i == 0:
                 continue
@@ -1816,19 +2855,24 @@ class Item:
             ]
             if pt[0] < 0:
                 break
-            result = self.read_char(pt)
-            if i == 1 and ord(result) == 0:
+            scan.append((i, pt))
+        results = self.read_chars([pt for _, pt in scan])
+        for (k, pt), result in zip(scan, results, strict=True):
+            if k == 1 and ord(result) == 0:
                 # アイテム数 x1 とならず表記無し場合のエラー処理
                 return ""
             if result in ["x", "+"]:
                 self.margin_left = pt[0]
+                i = k
                 break
         # 決まった位置まで出力する
-        line = ""
+        # 読む位置は None にしておき、まとめて読んでから埋める
+        chars = []
+        pts = []
         for j in range(i):
             if (self.name == "QP" or self.category in ["Point"]) and j < 2:
                 # QPとPointは下二桁は00
-                line += "0"
+                chars.append("0")
                 continue
             pt = [
                 self.width
@@ -1841,10 +2885,8 @@ class Item:
             ]
             if pt[0] < 0:
                 break
-            c = self.read_char(pt)
-            if ord(c) == 0:  # Null文字対策
-                c = "?"
-            line = line + c
+            chars.append(None)
+            pts.append(pt)
         j = j + 1
         pt = [
             self.width
@@ -1856,9 +2898,15 @@ class Item:
             base_line,
         ]
         if pt[0] > 0:
-            c = self.read_char(pt)
-            if ord(c) == 0:  # Null文字対策
-                c = "?"
+            chars.append(None)
+            pts.append(pt)
+        results = iter(self.read_chars(pts))
+        line = ""
+        for c in chars:
+            if c is None:
+                c = next(results)
+                if ord(c) == 0:  # Null文字対策
+                    c = "?"
             line = line + c
         line = line[::-1]
 
@@ -1871,6 +2919,8 @@ class Item:
         # margin_right = 15
         top_y = base_line - cut_height
         # まず、+, xの位置が何桁目か調査する
+        # 候補の位置をまとめて読んでから、右から順に判定する
+        scan = []
         for i in range(8):  # 8桁以上は無い
             if i == 0:
                 continue
@@ -1894,19 +2944,24 @@ class Item:
             ]
             if pt[0] < 0:
                 break
-            result = self.read_char(pt)
-            if i == 1 and ord(result) == 0:
+            scan.append((i, pt))
+        results = self.read_chars([pt for _, pt in scan])
+        for (k, pt), result in zip(scan, results, strict=True):
+            if k == 1 and ord(result) == 0:
                 # アイテム数 x1 とならず表記無し場合のエラー処理
                 return ""
             if result in ["x", "+"]:
                 self.margin_left = pt[0]
+                i = k
                 break
         # 決まった位置まで出力する
-        line = ""
+        # 読む位置は None にしておき、まとめて読んでから埋める
+        chars = []
+        pts = []
         for j in range(i):
             if (self.name == "QP" or self.category in ["Point"]) and j < 2:
                 # QPとPointは下二桁は00
-                line += "0"
+                chars.append("0")
                 continue
             pt = [
                 self.width
@@ -1919,10 +2974,8 @@ class Item:
             ]
             if pt[0] < 0:
                 break
-            c = self.read_char(pt)
-            if ord(c) == 0:  # Null文字対策
-                c = "?"
-            line = line + c
+            chars.append(None)
+            pts.append(pt)
         j = j + 1
         pt = [
             self.width
@@ -1934,9 +2987,15 @@ class Item:
             base_line,
         ]
         if pt[0] > 0:
-            c = self.read_char(pt)
-            if ord(c) == 0:  # Null文字対策
-                c = "?"
+            chars.append(None)
+            pts.append(pt)
+        results = iter(self.read_chars(pts))
+        line = ""
+        for c in chars:
+            if c is None:
+                c = next(results)
+                if ord(c) == 0:  # Null文字対策
+                    c = "?"
             line = line + c
         line = line[::-1]
 
@@ -2052,24 +3111,11 @@ class Item:
 
     def read_item(self, pts):
         """ボーナスの数値をOCRする(エラー訂正有)"""
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
         lines = ""
 
-        for pt in pts:
-            char = []
-            tmpimg = self.img_gray[pt[1] : pt[3], pt[0] : pt[2]]
-            tmpimg = cv2.resize(tmpimg, (win_size))
-            hog = cv2.HOGDescriptor(win_size, block_size, block_stride, cell_size, bins)
-            char.append(hog.compute(tmpimg))
-            char = np.array(char)
-            pred = self.svm.predict(char)
-            result = int(pred[1][0][0])
-            if result != 0:
-                lines = lines + chr(result)
+        for c in self.read_chars(pts):
+            if ord(c) != 0:
+                lines = lines + c
         logger.debug("OCR Result: %s", lines)
         # 以下エラー訂正
         if not lines.endswith(")"):
@@ -2118,25 +3164,47 @@ class Item:
         """戦利品の数値1文字をOCRする
         白文字検出で使用
         """
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-        char = []
-        tmpimg = self.img_gray[pt[1] : pt[3], pt[0] : pt[2]]
-        tmpimg = cv2.resize(tmpimg, (win_size))
-        hog = cv2.HOGDescriptor(win_size, block_size, block_stride, cell_size, bins)
-        char.append(hog.compute(tmpimg))
-        char = np.array(char)
-        pred = self.svm.predict(char)
-        result = int(pred[1][0][0])
-        return chr(result)
+        return next(self.read_chars([pt]))
+
+    def read_chars(self, pts):
+        """read_char() を複数の位置についてまとめて行うイテレータ
+
+        画像外で切り抜けない位置があれば、その手前までをまとめて読む。
+        その位置は一つずつ読んでいたときと同じく、参照されたときに例外になる
+        """
+        imgs = [self.img_gray[pt[1] : pt[3], pt[0] : pt[2]] for pt in pts]
+        n = next((k for k, img in enumerate(imgs) if img.size == 0), len(imgs))
+        for result in self.models.predict("item", imgs[:n]):
+            yield chr(result)
+        for img in imgs[n:]:
+            yield chr(self.models.predict("item", [img])[0])
+
+    def stack_cache_key(self, mode):
+        """StackCache のキー。スクショをまたいで覚えないアイテムは None"""
+        if (
+            self.id == ID_REWARD_QP
+            or ID_GEM_MAX <= self.id <= ID_MONUMENT_MAX
+            or ID_GREEN_TEA <= self.id <= ID_RED_TEA
+        ):
+            return None
+        return (self.id, mode, self.img_gray.shape)
 
     def ocr_digit(self, mode="jp"):
         """戦利品OCR"""
         self.font_size = FONTSIZE_UNDEFINED
 
+        stack_key = self.stack_cache_key(mode)
+        if stack_key is not None:
+            entry = get_stack_cache().find(stack_key, self.img_gray)
+            self.stack_cached = entry is not None
+            if entry is not None:
+                logger.debug("stack cache hit: %s", entry["dropnum"])
+                self.bonus = entry["bonus"]
+                self.dropnum = entry["dropnum"]
+                self.bonus_pts = entry["bonus_pts"]
+                self.font_size = entry["font_size"]
+                return
+
         if self.prev_item is None:
             prev_id = -1
         else:
@@ -2249,15 +3317,21 @@ class Item:
                 tmp["bonus"] = self.bonus
                 tmp["bonus_pts"] = self.bonus_pts
                 self.dropnum_cache.append(tmp)
+        if stack_key is not None:
+            _, cut_height, _ = self.define_fontsize(self.font_size, mode)
+            get_stack_cache().add(
+                stack_key,
+                self.img_gray,
+                base_line - cut_height,
+                dropnum=self.dropnum,
+                bonus=self.bonus,
+                bonus_pts=self.bonus_pts,
+                font_size=self.font_size,
+            )
 
     def gem_img2id(self, img, gem_dict):
         hash_gem = self.compute_gem_hash(img)
-        gems = {}
-        for i in gem_dict.keys():
-            d2 = hasher.compare(hash_gem, hex2hash(gem_dict[i]))
-            if d2 <= 21:
-                gems[i] = d2
-        gems = sorted(gems.items(), key=lambda x: x[1])
+        gems = get_hash_index(gem_dict).search(hash_gem, 21)
         gem = next(iter(gems))
         return gem[0]
 
@@ -2288,10 +3362,8 @@ class Item:
 
             return hist
 
-        red_tea_file = Path(__file__).resolve().parent / "data/misc/red_tea.png"
-        yellow_tea_file = Path(__file__).resolve().parent / "data/misc/yellow_tea.png"
-        img_red = imread(red_tea_file)
-        img_yellow = imread(yellow_tea_file)
+        img_red = self.models.template("red_tea")
+        img_yellow = self.models.template("yellow_tea")
         hist_red = calc_hue_hist(img_red[81:124, 56:132])
         height, width = img.shape[:2]
         hist_target = calc_hue_hist(img[81:124, 56:132])
@@ -2317,27 +3389,23 @@ class Item:
                 hex = hex + f"{h:02x}"
             logger.debug("phash: %s", hex)
 
-        def compare_distance(hash_item, background=True):
-            ids = {}
-            # 既存のアイテムとの距離を比較
-            for i in dist_item:
-                itemid = dist_item[i]
-                item_bg = item_background[itemid]
-                d = hasher.compare(hash_item, hex2hash(i))
-                if (d <= 20 and dist_item[i] == 1) or (
-                    d <= 30 and self.background == "zero"
-                ):
-                    # QPの背景が誤認識することがあるので背景チェックを回避
-                    ids[dist_item[i]] = d
-                elif background:
-                    if d <= 20 and item_bg == self.background:
-                        # ポイントと種の距離が8という例有り(IMG_0274)→16に
-                        # バーガーと脂の距離が10という例有り(IMG_2354)→14に
-                        ids[dist_item[i]] = d
-                elif d <= 20:
-                    ids[dist_item[i]] = d
+        # 既存のアイテムとの距離を比較
+        index = get_hash_index(catalog.dist_item)
+        dist = index.distances(hash_item)
+
+        def compare_distance(dist, background=True):
+            # QPの背景が誤認識することがあるので背景チェックを回避
+            mask = ((dist <= 20) & (index.ids == 1)) | (
+                (dist <= 30) & (self.background == "zero")
+            )
+            if background:
+                # ポイントと種の距離が8という例有り(IMG_0274)→16に
+                # バーガーと脂の距離が10という例有り(IMG_2354)→14に
+                mask |= (dist <= 20) & (index.background == self.background)
+            else:
+                mask |= dist <= 20
+            ids = index.rank_ids(dist, mask)
             if len(ids) > 0:
-                ids = sorted(ids.items(), key=lambda x: x[1])
                 id_tupple = next(iter(ids))
                 id = id_tupple[0]
                 if ID_SECRET_GEM_MIN <= id <= ID_SECRET_GEM_MAX:
@@ -2345,7 +3413,7 @@ class Item:
                         currnet_dropPriority == PRIORITY_ITEM
                         or currnet_dropPriority >= PRIORITY_SECRET_GEM_MIN
                     ):
-                        id = self.gem_img2id(img, dist_secret_gem)
+                        id = self.gem_img2id(img, catalog.dist_secret_gem)
                     else:
                         logger.info("Secret Gem not found")
                         return ""
@@ -2354,7 +3422,7 @@ class Item:
                         currnet_dropPriority == PRIORITY_ITEM
                         or currnet_dropPriority >= PRIORITY_MAGIC_GEM_MIN
                     ):
-                        id = self.gem_img2id(img, dist_magic_gem)
+                        id = self.gem_img2id(img, catalog.dist_magic_gem)
                     else:
                         return ""
                 elif ID_GEM_MIN <= id <= ID_GEM_MAX:
@@ -2362,7 +3430,7 @@ class Item:
                         currnet_dropPriority == PRIORITY_ITEM
                         or currnet_dropPriority >= PRIORITY_GEM_MIN
                     ):
-                        id = self.gem_img2id(img, dist_gem)
+                        id = self.gem_img2id(img, catalog.dist_gem)
                     else:
                         return ""
                 elif id == ID_YELLOW_TEA or id == ID_GREEN_TEA or id == ID_RED_TEA:
@@ -2383,42 +3451,39 @@ class Item:
 
             return ""
 
-        id = compare_distance(hash_item, background=True)
+        id = compare_distance(dist, background=True)
         if id == "":
-            id = compare_distance(hash_item, background=False)
+            count_event("background_retry")
+            id = compare_distance(dist, background=False)
 
         return id
 
     def classify_ce_sub(self, img, hasher_prog, dist_dic, threshold):
         """imgとの距離を比較して近いアイテムを求める"""
         hash_item = hasher_prog(img)  # 画像の距離
-        itemfiles = {}
         if logger.isEnabledFor(logging.DEBUG):
             hex = ""
             for h in hash_item[0]:
                 hex = hex + f"{h:02x}"
         # 既存のアイテムとの距離を比較
-        for i in dist_dic.keys():
-            d = hasher.compare(hash_item, hex2hash(i))
-            if d <= threshold:
-                itemfiles[dist_dic[i]] = d
-        if len(itemfiles) > 0:
-            itemfiles = sorted(itemfiles.items(), key=lambda x: x[1])
-            logger.debug("itemfiles: %s", itemfiles)
-            item = next(iter(itemfiles))
+        index = get_hash_index(dist_dic, index_class=CE_INDEX_CLASS)
+        item = index.nearest(hash_item, threshold)
+        if item is not None:
+            logger.debug("nearest: %s", item)
 
             return item[0]
 
         return ""
 
     def classify_ce(self, img):
-        itemid = self.classify_ce_sub(img, compute_hash_ce, dist_ce, 20)
+        itemid = self.classify_ce_sub(img, compute_hash_ce, catalog.dist_ce, 20)
         if itemid == "":
             logger.debug("use narrow image")
+            count_event("ce_narrow")
             itemid = self.classify_ce_sub(
                 img,
                 compute_hash_ce_narrow,
-                dist_ce_narrow,
+                catalog.dist_ce_narrow,
                 20,
             )
         return itemid
@@ -2426,21 +3491,19 @@ class Item:
     def classify_point(self, img):
         """imgとの距離を比較して近いアイテムを求める"""
         hash_item = compute_hash(img)  # 画像の距離
-        itemfiles = {}
         if logger.isEnabledFor(logging.DEBUG):
             hex = ""
             for h in hash_item[0]:
                 hex = hex + f"{h:02x}"
             logger.debug("phash: %s", hex)
         # 既存のアイテムとの距離を比較
-        for i in dist_point:
-            itemid = dist_point[i]
-            item_bg = item_background[itemid]
-            d = hasher.compare(hash_item, hex2hash(i))
-            if d <= 20 and item_bg == self.background:
-                itemfiles[itemid] = d
+        index = get_hash_index(catalog.dist_point)
+        dist = index.distances(hash_item)
+        itemfiles = index.rank_ids(
+            dist,
+            (dist <= 20) & (index.background == self.background),
+        )
         if len(itemfiles) > 0:
-            itemfiles = sorted(itemfiles.items(), key=lambda x: x[1])
             item = next(iter(itemfiles))
 
             return item[0]
@@ -2450,41 +3513,38 @@ class Item:
     def classify_point_and_item(self, img, currnet_dropPriority):
         """imgとの距離を比較して近いアイテムを求める"""
         hash_item = compute_hash(img)  # 画像の距離
-        itemfiles = {}
         if logger.isEnabledFor(logging.DEBUG):
             hex = ""
             for h in hash_item[0]:
                 hex = hex + f"{h:02x}"
             logger.debug("phash: %s", hex)
         # 既存のアイテムとの距離を比較
-        dist_item_and_point = dict(**dist_point, **dist_item)
-        for i in dist_item_and_point:
-            itemid = dist_item_and_point[i]
-            item_bg = item_background[itemid]
-            d = hasher.compare(hash_item, hex2hash(i))
-            if d <= 30 and itemid == 1 and self.background == "zero":
-                itemfiles[itemid] = d
-            elif d <= 20 and item_bg == self.background:
-                if item_dropPriority[itemid] <= currnet_dropPriority:  # fix #380
-                    itemfiles[itemid] = d
+        index = get_hash_index(catalog.dist_point, catalog.dist_item)
+        dist = index.distances(hash_item)
+        mask = (dist <= 30) & (index.ids == 1) & (self.background == "zero")
+        mask |= (
+            (dist <= 20)
+            & (index.background == self.background)
+            & (index.dropPriority <= currnet_dropPriority)  # fix #380
+        )
+        itemfiles = index.rank_ids(dist, mask)
         if len(itemfiles) > 0:
-            itemfiles = sorted(itemfiles.items(), key=lambda x: x[1])
             item = next(iter(itemfiles))
 
             id = item[0]
             if ID_SECRET_GEM_MIN <= id <= ID_SECRET_GEM_MAX:
                 if currnet_dropPriority >= PRIORITY_SECRET_GEM_MIN:
-                    id = self.gem_img2id(img, dist_secret_gem)
+                    id = self.gem_img2id(img, catalog.dist_secret_gem)
                     return id
                 return ""
             if ID_MAGIC_GEM_MIN <= id <= ID_MAGIC_GEM_MAX:
                 if currnet_dropPriority >= PRIORITY_MAGIC_GEM_MIN:
-                    id = self.gem_img2id(img, dist_magic_gem)
+                    id = self.gem_img2id(img, catalog.dist_magic_gem)
                     return id
                 return ""
             if ID_GEM_MIN <= id <= ID_GEM_MAX:
                 if currnet_dropPriority >= PRIORITY_GEM_MIN:
-                    id = self.gem_img2id(img, dist_gem)
+                    id = self.gem_img2id(img, catalog.dist_gem)
                     return id
                 return ""
             if (
@@ -2498,25 +3558,30 @@ class Item:
 
         return ""
 
-    def classify_exp(self, img, svm_exp_class):
+    def classify_exp(self, img):
         hash_item = self.compute_exp_rarity_hash(img)  # 画像の距離
-        exps = {}
-        for i in dist_exp_rarity:
-            dt = hasher.compare(hash_item, hex2hash(i))
-            if dt <= 15:  # IMG_1833で11 IMG_1837で15
-                exps[i] = dt
-        exps = sorted(exps.items(), key=lambda x: x[1])
+        index = get_hash_index(catalog.dist_exp_rarity)
+        dist = index.distances(hash_item)
+        exps = index.rank_keys(dist, dist <= 15)  # IMG_1833で11 IMG_1837で15
         if len(exps) > 0:
             exp = next(iter(exps))
 
-            exp_class = self.classify_exp_class(img, svm_exp_class)
+            exp_class = self.classify_exp_class(img)
 
-            return int(str(exp_class) + str(dist_exp_rarity[exp[0]])[4] + "00")
+            return int(str(exp_class) + str(catalog.dist_exp_rarity[exp[0]])[4] + "00")
 
         return ""
 
     def make_new_file(self, img, search_dir, dist_dic, dropPriority, category):
         """ファイル名候補を探す"""
+        global catalog_generation
+        if catalog_frozen:
+            raise CatalogFrozenError(category)
+        count_event("new_file")
+        catalog_generation += 1
+        # カタログが増えたので、前のスクショで覚えた判別結果・読み取り結果は使わない
+        get_tile_cache().clear()
+        get_stack_cache().clear()
         i_dic = {"Item": "item", "Craft Essence": "ce", "Point": "point"}
         initial = i_dic[category]
         for i in range(999):
@@ -2527,7 +3592,7 @@ class Item:
             # id 候補を決める
             for j in range(99999):
                 id = j + ID_START
-                if id in item_name:
+                if id in catalog.item_name:
                     continue
                 break
             if category == "Craft Essence":
@@ -2543,27 +3608,24 @@ class Item:
                 hash_hex_narrow = ""
                 for h in hash_narrow[0]:
                     hash_narrow = hash_narrow + f"{h:02x}"
-                dist_ce_narrow[hash_hex_narrow] = id
-            item_name[id] = itemfile.stem
-            item_background[id] = classify_background(img)
-            item_dropPriority[id] = dropPriority
-            item_type[id] = category
+                catalog.dist_ce_narrow[hash_hex_narrow] = id
+            catalog.item_name[id] = itemfile.stem
+            catalog.item_background[id] = classify_background(img)
+            catalog.item_dropPriority[id] = dropPriority
+            catalog.item_type[id] = category
+            if category == "Craft Essence":
+                clear_hash_index(dist_dic, catalog.dist_ce_narrow)
+            else:
+                clear_hash_index(dist_dic)
             break
         return id
 
-    def classify_category(self, svm_card):
+    def classify_category(self):
         """カード判別器"""
         """
         カード判別器
         この場合は画像全域のハッシュをとる
         """
-        # Hog特徴のパラメータ
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-        test = []
         carddic = {
             0: "Quest Reward",
             1: "Item",
@@ -2578,15 +3640,11 @@ class Item:
             int(78 / 188 * self.width) : int(115 / 188 * self.width),
         ]
 
-        tmpimg = cv2.resize(tmpimg, (win_size))
-        hog = cv2.HOGDescriptor(win_size, block_size, block_stride, cell_size, bins)
-        test.append(hog.compute(tmpimg))  # 特徴量の格納
-        test = np.array(test)
-        pred = svm_card.predict(test)
+        pred = self.models.predict("card", [tmpimg])
 
-        return carddic[pred[1][0][0]]
+        return carddic[pred[0]]
 
-    def classify_card(self, img, svm_exp_class, currnet_dropPriority):
+    def classify_card(self, img, currnet_dropPriority):
         """アイテム判別器"""
         if self.category == "Point":
             id = self.classify_point(img)
@@ -2594,7 +3652,7 @@ class Item:
                 id = self.make_new_file(
                     img,
                     Point_dir,
-                    dist_point,
+                    catalog.dist_point,
                     PRIORITY_POINT,
                     self.category,
                 )
@@ -2607,20 +3665,20 @@ class Item:
                 id = self.make_new_file(
                     img,
                     CE_dir,
-                    dist_ce,
+                    catalog.dist_ce,
                     PRIORITY_CE,
                     self.category,
                 )
             return id
         if self.category == "Exp. UP":
-            return self.classify_exp(img, svm_exp_class)
+            return self.classify_exp(img)
         if self.category == "Item":
             id = self.classify_item(img, currnet_dropPriority)
             if id == "":
                 id = self.make_new_file(
                     img,
                     Item_dir,
-                    dist_item,
+                    catalog.dist_item,
                     PRIORITY_ITEM,
                     self.category,
                 )
@@ -2630,11 +3688,11 @@ class Item:
             id = self.classify_point_and_item(img, currnet_dropPriority)
             if id != "":
                 return id
-            id = self.classify_exp(img, svm_exp_class)
+            id = self.classify_exp(img)
             if id != "":
                 return id
         if id == "":
-            id = self.make_new_file(img, Item_dir, dist_item, PRIORITY_ITEM, "Item")
+            id = self.make_new_file(img, Item_dir, catalog.dist_item, PRIORITY_ITEM, "Item")
         return id
 
     def compute_exp_rarity_hash(self, img_rgb):
@@ -2646,30 +3704,16 @@ class Item:
             int(37 / 206 * self.width) : int(149 / 206 * self.width),
         ]
 
-        return hasher.compute(img)
+        return get_hasher().compute(img)
 
-    def classify_exp_class(self, img_rgb, svm_exp_class):
+    def classify_exp_class(self, img_rgb):
         """種火クラス判別器"""
-        # Hog特徴のパラメータ
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-        test = []
-
         tmpimg = img_rgb[
             int((5 + 9) / 135 * self.height) : int((30 + 2) / 135 * self.height),
             int(5 / 135 * self.width) : int((30 + 6) / 135 * self.width),
         ]
 
-        tmpimg = cv2.resize(tmpimg, (win_size))
-        hog = cv2.HOGDescriptor(win_size, block_size, block_stride, cell_size, bins)
-        test.append(hog.compute(tmpimg))  # 特徴量の格納
-        test = np.array(test)
-        pred = svm_exp_class.predict(test)
-
-        return int(pred[1][0][0])
+        return self.models.predict("exp_class", [tmpimg])[0]
 
     def compute_gem_hash(self, img_rgb):
         """スキル石クラス判別器
@@ -2687,7 +3731,7 @@ class Item:
             ),
         ]
 
-        return hasher.compute(img)
+        return get_hasher().compute(img)
 
 
 def classify_background(img_rgb):
@@ -2696,13 +3740,14 @@ def classify_background(img_rgb):
     img = img_rgb[30:119, width - 25 : width - 7]
     target_hist = img_hist(img)
     bg_score = []
-    score_z = calc_hist_score(target_hist, hist_zero)
+    hists = get_background_hists()
+    score_z = calc_hist_score(target_hist, hists["hist_zero"])
     bg_score.append({"background": "zero", "dist": score_z})
-    score_g = calc_hist_score(target_hist, hist_gold)
+    score_g = calc_hist_score(target_hist, hists["hist_gold"])
     bg_score.append({"background": "gold", "dist": score_g})
-    score_s = calc_hist_score(target_hist, hist_silver)
+    score_s = calc_hist_score(target_hist, hists["hist_silver"])
     bg_score.append({"background": "silver", "dist": score_s})
-    score_b = calc_hist_score(target_hist, hist_bronze)
+    score_b = calc_hist_score(target_hist, hists["hist_bronze"])
     bg_score.append({"background": "bronze", "dist": score_b})
 
     bg_score = sorted(bg_score, key=lambda x: x["dist"])
@@ -2720,7 +3765,7 @@ def compute_hash(img_rgb):
         int(23 / 135 * height) : int(77 / 135 * height),
         int(23 / 135 * width) : int(112 / 135 * width),
     ]
-    return hasher.compute(img)
+    return get_hasher().compute(img)
 
 
 def compute_hash_ce(img_rgb):
@@ -2729,7 +3774,7 @@ def compute_hash_ce(img_rgb):
     記述した比率はiPpd2018画像の実測値
     """
     img = img_rgb[12:176, 9:182]
-    return hasher.compute(img)
+    return get_hasher().compute(img)
 
 
 def compute_hash_ce_narrow(img_rgb):
@@ -2739,30 +3784,31 @@ def compute_hash_ce_narrow(img_rgb):
         int(30 / 206 * height) : int(155 / 206 * height),
         int(5 / 188 * width) : int(183 / 188 * width),
     ]
-    return hasher.compute(img)
+    return get_hasher().compute(img)
 
 
 def search_file(search_dir, dist_dic, dropPriority, category):
     """Item, Craft Essence, Pointの各ファイルを探す"""
-    files = search_dir.glob("**/*.png")
+    files = list(search_dir.glob("**/*.png"))
+    ids = set()
     for fname in files:
         img = imread(fname)
         # id 候補を決める
         # 既存のデータがあったらそれを使用
-        if fname.stem in item_name.values():
-            id = [k for k, v in item_name.items() if v == fname.stem][0]
-        elif fname.stem in item_shortname.values():
-            id = [k for k, v in item_shortname.items() if v == fname.stem][0]
+        if fname.stem in catalog.item_name.values():
+            id = [k for k, v in catalog.item_name.items() if v == fname.stem][0]
+        elif fname.stem in catalog.item_shortname.values():
+            id = [k for k, v in catalog.item_shortname.items() if v == fname.stem][0]
         else:
             for j in range(99999):
                 id = j + ID_START
-                if id in item_name:
+                if id in catalog.item_name:
                     continue
                 break
             # priotiry は固定
-            item_name[id] = fname.stem
-            item_dropPriority[id] = dropPriority
-            item_type[id] = category
+            catalog.item_name[id] = fname.stem
+            catalog.item_dropPriority[id] = dropPriority
+            catalog.item_type[id] = category
         if category == "Craft Essence":
             hash = compute_hash_ce(img)
         else:
@@ -2771,14 +3817,21 @@ def search_file(search_dir, dist_dic, dropPriority, category):
         for h in hash[0]:
             hash_hex = hash_hex + f"{h:02x}"
         dist_dic[hash_hex] = id
+        ids.add(id)
         if category == "Item" or category == "Point":
-            item_background[id] = classify_background(img)
+            catalog.item_background[id] = classify_background(img)
         if category == "Craft Essence":
             hash_narrow = compute_hash_ce_narrow(img)
             hash_hex_narrow = ""
             for h in hash_narrow[0]:
                 hash_hex_narrow = hash_hex_narrow + f"{h:02x}"
-            dist_ce_narrow[hash_hex_narrow] = id
+            catalog.dist_ce_narrow[hash_hex_narrow] = id
+    if len(files) > 0:
+        # 増えた辞書と、背景が変わったかもしれないアイテムを含む索引だけ作り直す
+        tables = [dist_dic]
+        if category == "Craft Essence":
+            tables.append(catalog.dist_ce_narrow)
+        clear_hash_index(*tables, ids=ids)
 
 
 def calc_hist_score(hist1, hist2):
@@ -2800,9 +3853,9 @@ def img_hist(src_img):
 
 def calc_dist_local():
     """既所持のアイテム画像の距離(一次元配列)の辞書を作成して保持"""
-    search_file(Item_dir, dist_item, PRIORITY_ITEM, "Item")
-    search_file(CE_dir, dist_ce, PRIORITY_CE, "Craft Essence")
-    search_file(Point_dir, dist_point, PRIORITY_POINT, "Point")
+    search_file(Item_dir, catalog.dist_item, PRIORITY_ITEM, "Item")
+    search_file(CE_dir, catalog.dist_ce, PRIORITY_CE, "Craft Essence")
+    search_file(Point_dir, catalog.dist_point, PRIORITY_POINT, "Point")
 
 
 def hex2hash(hexstr):
@@ -2812,14 +3865,564 @@ def hex2hash(hexstr):
     return np.array([hashlist], dtype="uint8")
 
 
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(a):
+        """numpy < 2.0 向けの uint64 配列のビット数計算"""
+        return _POPCOUNT_TABLE[a.view(np.uint8)].reshape(a.shape + (8,)).sum(axis=-1)
+
+
+class HashIndex:
+    """pHash の辞書を距離計算用の配列にまとめたもの
+
+    16進文字列の pHash を uint64 に詰めた配列と、同じ並びの id・背景・
+    dropPriority の配列を持つ。全件とのハミング距離は popcount 一回で求まる。
+    並び順は元の辞書の順序のままなので、辞書をループで比較していたときと
+    同じ結果を返す。
+    """
+
+    def __init__(self, pairs, item_background=None, item_dropPriority=None):
+        pairs = list(pairs)
+        if item_background is None:
+            item_background = {}
+        if item_dropPriority is None:
+            item_dropPriority = {}
+        self.keys = [key for key, _ in pairs]
+        self.ids = np.array([itemid for _, itemid in pairs], dtype=np.int64)
+        self.hashes = np.frombuffer(
+            b"".join(bytes.fromhex(key) for key in self.keys),
+            dtype=np.uint64,
+        )
+        self.background = np.array(
+            [item_background.get(itemid, "") for _, itemid in pairs],
+            dtype=str,
+        )
+        self.dropPriority = np.array(
+            [item_dropPriority.get(itemid, 0) for _, itemid in pairs],
+            dtype=np.int64,
+        )
+
+    def __len__(self):
+        return len(self.keys)
+
+    def distances(self, hash_item):
+        """hasher.compute() の結果と全件とのハミング距離"""
+        target = np.frombuffer(hash_item.tobytes(), dtype=np.uint64)[0]
+        return popcount(self.hashes ^ target)
+
+    def rank_ids(self, dist, mask):
+        """mask に該当する id を距離順に並べた [(id, 距離), ...] を返す
+
+        {id: 距離} の辞書に順番に詰めてからソートしていた処理と同じ結果になるよう、
+        同じ id が複数ある場合は位置は最初のもの、距離は最後のものを使う
+        """
+        sel = np.flatnonzero(mask)
+        if sel.size == 0:
+            return []
+        sel_ids = self.ids[sel]
+        sel_dist = dist[sel]
+        uniq, first = np.unique(sel_ids, return_index=True)
+        _, last = np.unique(sel_ids[::-1], return_index=True)
+        last = sel_ids.size - 1 - last
+        order = np.lexsort((first, sel_dist[last]))
+        return [(int(uniq[k]), int(sel_dist[last[k]])) for k in order]
+
+    def rank_keys(self, dist, mask):
+        """mask に該当する pHash を距離順に並べた [(pHash, 距離), ...] を返す"""
+        sel = np.flatnonzero(mask)
+        order = sel[np.argsort(dist[sel], kind="stable")]
+        return [(self.keys[k], int(dist[k])) for k in order]
+
+    def search(self, hash_item, threshold):
+        """距離が threshold 以下の id を距離順に返す"""
+        dist = self.distances(hash_item)
+        return self.rank_ids(dist, dist <= threshold)
+
+    def nearest(self, hash_item, threshold):
+        """search() の先頭 (id, 距離) を返す。該当無しなら None"""
+        found = self.search(hash_item, threshold)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+
+class MultiIndexHash(HashIndex):
+    """64bit の pHash を 16bit ずつ4分割し、それぞれの値で引ける表を持つ HashIndex
+
+    距離 d 以内のものは鳩の巣原理により、どれかの 16bit 部分が d // 4 以内で一致する。
+    ほとんどの検索は部分一致の候補だけを調べれば済むため、件数が増えても
+    検索時間がほぼ一定になる。候補だけでは結果を保証できない場合は全件比較に戻す。
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = 16
+    MAX_CHUNK_RADIUS = 1  # これを超える範囲は全件比較のほうが速い
+    MIN_SIZE = 4096  # これより小さい場合も全件比較のほうが速い
+
+    def __init__(self, pairs, item_background=None, item_dropPriority=None):
+        super().__init__(pairs, item_background, item_dropPriority)
+        # 部分の番号を上位に付けた 16bit 値で引けるよう、
+        # (値の一覧, 値ごとの開始位置, 値順に並べた位置) の配列を持つ
+        n = len(self.hashes)
+        values = np.concatenate(
+            [self.chunk_values(self.hashes, c) for c in range(self.CHUNKS)]
+        )
+        order = np.argsort(values, kind="stable")
+        self.chunk_keys, start = np.unique(values[order], return_index=True)
+        self.chunk_start = np.append(start, order.size)
+        self.chunk_pos = order % n if n > 0 else order
+        # 同じ id が複数の pHash を持つ場合は順位付けが特殊なので全件比較に任せる
+        uniq, counts = np.unique(self.ids, return_counts=True)
+        self.multi_ids = set(uniq[counts > 1].tolist())
+
+    def chunk_values(self, hashes, c):
+        mask = np.uint64((1 << self.CHUNK_BITS) - 1)
+        values = (hashes >> np.uint64(c * self.CHUNK_BITS)) & mask
+        return values | np.uint64(c << self.CHUNK_BITS)
+
+    def candidates(self, target, radius):
+        """いずれかの部分が radius ビット以内で一致するものの位置"""
+        if self.chunk_keys.size == 0:
+            return np.empty(0, dtype=np.intp)
+        mask = (1 << self.CHUNK_BITS) - 1
+        probes = []
+        for c in range(self.CHUNKS):
+            value = (target >> (c * self.CHUNK_BITS)) & mask | c << self.CHUNK_BITS
+            probes.append(value)
+            if radius >= 1:
+                probes += [value ^ (1 << b) for b in range(self.CHUNK_BITS)]
+        probes = np.array(probes, dtype=np.uint64)
+        hit = np.searchsorted(self.chunk_keys, probes)
+        hit = np.minimum(hit, self.chunk_keys.size - 1)
+        hit = hit[self.chunk_keys[hit] == probes]
+        if hit.size == 0:
+            return np.empty(0, dtype=np.intp)
+        start = self.chunk_start
+        found = [self.chunk_pos[start[k] : start[k + 1]] for k in hit.tolist()]
+        return np.unique(np.concatenate(found))
+
+    def nearest(self, hash_item, threshold):
+        if len(self) < self.MIN_SIZE:
+            return super().nearest(hash_item, threshold)
+        target = int(np.frombuffer(hash_item.tobytes(), dtype=np.uint64)[0])
+        for radius in range(self.MAX_CHUNK_RADIUS + 1):
+            # 距離 guaranteed 以下のものは全て候補に含まれている
+            guaranteed = self.CHUNKS * (radius + 1) - 1
+            pos = self.candidates(target, radius)
+            if pos.size > 0:
+                dist = popcount(self.hashes[pos] ^ np.uint64(target))
+                d_min = int(dist.min())
+                if d_min <= min(guaranteed, threshold):
+                    best = pos[dist == d_min]
+                    if self.multi_ids.isdisjoint(self.ids[best].tolist()):
+                        return int(self.ids[best[0]]), d_min
+                    break
+            if threshold <= guaranteed:
+                return None
+        return super().nearest(hash_item, threshold)
+
+
+# classify_ce_sub で使う検索構造
+CE_INDEX_CLASS = MultiIndexHash
+
+
+class QuestIndex:
+    """ドロップの組み合わせからクエストを引くための索引
+
+    by_drops: 礼装を除いたドロップ名と報酬QPの frozenset -> クエスト
+    by_qp: 報酬QP -> ([(クエスト, ドロップの frozenset), ...], {ドロップ名: 位置の set})
+    freequest の後ろ (新しいイベント) にあるものを優先する
+    """
+
+    def __init__(self, freequest):
+        self.by_drops = {}
+        self.by_qp = {}
+        for quest in reversed(freequest):
+            dropset = self.dropset(quest)
+            self.by_drops.setdefault(dropset, quest)
+            quests, postings = self.by_qp.setdefault(quest["qp"], ([], {}))
+            for name in dropset:
+                postings.setdefault(name, set()).add(len(quests))
+            quests.append((quest, dropset))
+
+    @staticmethod
+    def dropset(quest):
+        dropset = {i["name"] for i in quest["drop"] if i["type"] != "Craft Essence"}
+        dropset.add("QP(+" + str(quest["qp"]) + ")")
+        return frozenset(dropset)
+
+    def find(self, item_set):
+        """ドロップが完全に一致するクエスト"""
+        return self.by_drops.get(frozenset(item_set), "")
+
+    def supersets(self, item_set, reward_qp):
+        """報酬QPが同じで item_set を全て含むクエストとそのドロップ"""
+        if reward_qp not in self.by_qp:
+            return []
+        quests, postings = self.by_qp[reward_qp]
+        matched = None
+        for name in sorted(item_set, key=lambda name: len(postings.get(name, ()))):
+            found = postings.get(name)
+            if not found:
+                return []
+            matched = set(found) if matched is None else matched & found
+            if not matched:
+                return []
+        if matched is None:
+            return list(quests)
+        return [quests[pos] for pos in sorted(matched)]
+
+
+class Catalog:
+    """hash_drop.json とイベントクエストの JSON から作るアイテム・クエストの辞書一式
+
+    JSON の解析は遅いので、作った辞書と pHash を詰めた HashIndex をまとめて
+    snapshot_file に保存し、元ファイルが変わっていなければ次回からはそれを読み込む。
+    """
+
+    SNAPSHOT_VERSION = 2
+    # get_hash_index() に渡せる辞書
+    HASH_TABLES = (
+        "dist_item",
+        "dist_ce",
+        "dist_ce_narrow",
+        "dist_secret_gem",
+        "dist_magic_gem",
+        "dist_gem",
+        "dist_exp_rarity",
+        "dist_exp_class",
+        "dist_point",
+    )
+
+    def __init__(self, drop_item, freequest):
+        self._freequest = freequest
+        self._quest_index = None
+        self._quests_pickle = None
+        # JSONファイルから各辞書を作成
+        self.item_name = {item["id"]: item["name"] for item in drop_item}
+        self.item_name_eng = {
+            item["id"]: item["name_eng"]
+            for item in drop_item
+            if "name_eng" in item.keys()
+        }
+        self.item_shortname = {
+            item["id"]: item["shortname"]
+            for item in drop_item
+            if "shortname" in item.keys()
+        }
+        self.item_dropPriority = {item["id"]: item["dropPriority"] for item in drop_item}
+        self.item_background = {
+            item["id"]: item["background"]
+            for item in drop_item
+            if "background" in item.keys()
+        }
+        self.item_type = {item["id"]: item["type"] for item in drop_item}
+        self.dist_item = {
+            item["phash_battle"]: item["id"]
+            for item in drop_item
+            if item["type"] == "Item" and "phash_battle" in item.keys()
+        }
+        self.dist_ce = {
+            item["phash"]: item["id"]
+            for item in drop_item
+            if item["type"] == "Craft Essence"
+        }
+        self.dist_ce_narrow = {
+            item["phash_narrow"]: item["id"]
+            for item in drop_item
+            if item["type"] == "Craft Essence"
+        }
+        self.dist_secret_gem = {
+            item["id"]: item["phash_class"]
+            for item in drop_item
+            if 6200 < item["id"] < 6208 and "phash_class" in item.keys()
+        }
+        self.dist_magic_gem = {
+            item["id"]: item["phash_class"]
+            for item in drop_item
+            if 6100 < item["id"] < 6108 and "phash_class" in item.keys()
+        }
+        self.dist_gem = {
+            item["id"]: item["phash_class"]
+            for item in drop_item
+            if 6000 < item["id"] < 6008 and "phash_class" in item.keys()
+        }
+        self.dist_exp_rarity = {
+            item["phash_rarity"]: item["id"]
+            for item in drop_item
+            if item["type"] == "Exp. UP" and "phash_rarity" in item.keys()
+        }
+        dist_exp_rarity_sold = {
+            item["phash_rarity_sold"]: item["id"]
+            for item in drop_item
+            if item["type"] == "Exp. UP" and "phash_rarity_sold" in item.keys()
+        }
+        self.dist_exp_rarity.update(dist_exp_rarity_sold)
+        self.dist_exp_rarity["1fe03fe0517fa0bf"] = 9701200  # fix #368
+        self.dist_exp_class = {
+            item["phash_class"]: item["id"]
+            for item in drop_item
+            if item["type"] == "Exp. UP" and "phash_class" in item.keys()
+        }
+        dist_exp_class_sold = {
+            item["phash_class_sold"]: item["id"]
+            for item in drop_item
+            if item["type"] == "Exp. UP" and "phash_class_sold" in item.keys()
+        }
+        self.dist_exp_class.update(dist_exp_class_sold)
+        self.dist_point = {
+            item["phash_battle"]: item["id"]
+            for item in drop_item
+            if item["type"] == "Point" and "phash_battle" in item.keys()
+        }
+        self.hash_indexes = {}
+
+    def _load_quests(self):
+        """クエストの一覧と索引
+        件数が多く展開に時間がかかるので、スナップショットから読んだ場合は
+        最初に参照したときに展開する
+        """
+        if self._quests_pickle is not None:
+            self._freequest, index_state = pickle.loads(self._quests_pickle)
+            self._quest_index = QuestIndex.__new__(QuestIndex)
+            vars(self._quest_index).update(index_state)
+            self._quests_pickle = None
+        if self._quest_index is None:
+            self._quest_index = QuestIndex(self._freequest)
+
+    @property
+    def freequest(self):
+        self._load_quests()
+        return self._freequest
+
+    @property
+    def quest_index(self):
+        self._load_quests()
+        return self._quest_index
+
+    @classmethod
+    def from_json(cls):
+        with open(drop_file, encoding="UTF-8") as f:
+            drop_item = json.load(f)
+
+        freequest = []
+        for evnetfile in cls.eventfiles():
+            try:
+                with open(evnetfile, encoding="UTF-8") as f:
+                    event = json.load(f)
+                    freequest.extend(event)
+            except (OSError, UnicodeEncodeError) as e:
+                logger.exception(e)
+        return cls(drop_item, freequest)
+
+    @staticmethod
+    def eventfiles():
+        return list(eventquest_dir.glob("**/*.json"))
+
+    @classmethod
+    def source_signature(cls):
+        """スナップショットの元になったファイルの (パス, サイズ, 更新時刻) の一覧
+        glob の順序が変わると freequest の並びも変わるので順序も含めて比較する。
+        HashIndex の形式が変わった場合に備えてこのファイル自身も含める
+        """
+        signature = [cls.SNAPSHOT_VERSION]
+        for path in [Path(__file__), drop_file] + cls.eventfiles():
+            st = path.stat()
+            signature.append((path.as_posix(), st.st_size, st.st_mtime_ns))
+        return signature
+
+    @classmethod
+    def load(cls, snapshot=None):
+        """スナップショットが最新ならそれを、そうでなければ JSON から作って保存する
+
+        snapshot に None を渡すとスナップショットを使わない
+        """
+        if snapshot is None:
+            return cls.from_json()
+        signature = cls.source_signature()
+        try:
+            with open(snapshot, "rb") as f:
+                if pickle.load(f) == signature:
+                    return cls.from_state(pickle.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("ignore broken catalog snapshot %s: %s", snapshot, e)
+        catalog = cls.from_json()
+        catalog.compile()
+        try:
+            catalog.save(snapshot, signature)
+        except OSError as e:
+            logger.warning("failed to write catalog snapshot %s: %s", snapshot, e)
+        return catalog
+
+    def save(self, snapshot, signature):
+        """ヘッダ(signature)と本体を続けて pickle する
+        並列実行中の別プロセスが書きかけを読まないよう、一時ファイルから置き換える
+        """
+        snapshot = Path(snapshot)
+        snapshot.parent.mkdir(parents=True, exist_ok=True)
+        tmpfile = snapshot.with_name(f"{snapshot.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmpfile, "wb") as f:
+                pickle.dump(signature, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self.to_state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, snapshot)
+        finally:
+            tmpfile.unlink(missing_ok=True)
+
+    def to_state(self):
+        """pickle 用の dict
+        __main__ として実行した場合でも読めるよう、クラスは名前で保存する
+        """
+        state = dict(vars(self))
+        state["_freequest"] = None
+        state["_quest_index"] = None
+        # 索引はクエストの dict を共有しているので一緒に pickle する
+        state["_quests_pickle"] = pickle.dumps(
+            (self.freequest, dict(vars(self.quest_index))),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        state["hash_indexes"] = {
+            key: dict(vars(index)) for key, index in self.hash_indexes.items()
+        }
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        index_classes = {c.__name__: c for c in (HashIndex, MultiIndexHash)}
+        catalog = cls.__new__(cls)
+        catalog.__dict__.update(state)
+        catalog.hash_indexes = {}
+        for key, index_state in state["hash_indexes"].items():
+            index = index_classes[key[0]].__new__(index_classes[key[0]])
+            index.__dict__.update(index_state)
+            catalog.hash_indexes[key] = index
+        return catalog
+
+    def compile(self):
+        """認識で使う HashIndex とクエストの索引を作っておく"""
+        self.quest_index
+        self.hash_index("dist_item")
+        self.hash_index("dist_point")
+        self.hash_index("dist_point", "dist_item")
+        self.hash_index("dist_exp_rarity")
+        self.hash_index("dist_secret_gem")
+        self.hash_index("dist_magic_gem")
+        self.hash_index("dist_gem")
+        self.hash_index("dist_ce", index_class=CE_INDEX_CLASS)
+        self.hash_index("dist_ce_narrow", index_class=CE_INDEX_CLASS)
+
+    def table_name(self, table):
+        """辞書オブジェクトから HASH_TABLES の名前を引く"""
+        if isinstance(table, str):
+            return table
+        for name in self.HASH_TABLES:
+            if getattr(self, name) is table:
+                return name
+        raise ValueError("not a catalog hash table")
+
+    def hash_index(self, *tables, index_class=None):
+        """dist_* 辞書の HashIndex を返す
+
+        複数指定した場合は連結したものになる。
+        gem の辞書は {id: pHash} の向きなので入れ替えて扱う。
+        辞書を変更したら clear_hash_index() を呼ぶこと。
+        """
+        if index_class is None:
+            index_class = HashIndex
+        names = tuple(self.table_name(table) for table in tables)
+        key = (index_class.__name__, *names)
+        if key not in self.hash_indexes:
+            pairs = []
+            for name in names:
+                for k, v in getattr(self, name).items():
+                    pairs.append((k, v) if isinstance(k, str) else (v, k))
+            self.hash_indexes[key] = index_class(
+                pairs, self.item_background, self.item_dropPriority
+            )
+        return self.hash_indexes[key]
+
+    def clear_hash_index(self, *tables, ids=()):
+        """HashIndex を次に参照したときに作り直すようにする
+
+        tables を指定したときは、それを含むものと ids のアイテムを含むものだけ捨てる
+        (スナップショットから読んだ他の索引はそのまま使う)
+        """
+        if len(tables) == 0:
+            self.hash_indexes.clear()
+            return
+        names = {self.table_name(table) for table in tables}
+        ids = np.fromiter(ids, dtype=np.int64)
+        for key, index in list(self.hash_indexes.items()):
+            if names.intersection(key[1:]) or np.isin(index.ids, ids).any():
+                del self.hash_indexes[key]
+
+
+_catalog = None
+
+
+def get_catalog():
+    """Catalog を返す。最初に呼ばれたときに読み込む"""
+    global _catalog
+    if _catalog is None:
+        _catalog = Catalog.load(catalog_snapshot_file)
+    return _catalog
+
+
+class LazyCatalog:
+    """属性を参照したときに get_catalog() の同名の属性を返す"""
+
+    def __getattr__(self, name):
+        return getattr(get_catalog(), name)
+
+
+catalog = LazyCatalog()
+
+# 以前はモジュールの変数だった名前 (他のスクリプトから参照されている)
+CATALOG_NAMES = (
+    "item_name",
+    "item_name_eng",
+    "item_shortname",
+    "item_dropPriority",
+    "item_background",
+    "item_type",
+    "freequest",
+) + Catalog.HASH_TABLES
+BACKGROUND_HIST_NAMES = ("hist_zero", "hist_gold", "hist_silver", "hist_bronze")
+
+
+def __getattr__(name):
+    if name in CATALOG_NAMES:
+        return getattr(get_catalog(), name)
+    if name in BACKGROUND_HIST_NAMES:
+        return get_background_hists()[name]
+    if name == "hasher":
+        return get_hasher()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_hash_index(*tables, index_class=HashIndex):
+    """catalog.hash_index() を参照"""
+    return catalog.hash_index(*tables, index_class=index_class)
+
+
+def clear_hash_index(*tables, ids=()):
+    """catalog.clear_hash_index() を参照"""
+    catalog.clear_hash_index(*tables, ids=ids)
+
+
 def out_name(args, id):
     if args.lang == "eng":
-        if id in item_name_eng:
-            return item_name_eng[id]
-    if id in item_shortname:
-        name = item_shortname[id]
+        if id in catalog.item_name_eng:
+            return catalog.item_name_eng[id]
+    if id in catalog.item_shortname:
+        name = catalog.item_shortname[id]
     else:
-        name = item_name[id]
+        name = catalog.item_name[id]
     return name
 
 
@@ -2835,6 +4438,8 @@ def imread(filename, flags=cv2.IMREAD_COLOR, dtype=np.uint8):
 
 
 def get_exif(img):
+    from PIL.ExifTags import TAGS
+
     exif = img._getexif()
     try:
         for id, val in exif.items():
@@ -2846,177 +4451,962 @@ def get_exif(img):
     return "NON"
 
 
-def get_output(filenames, args):
-    """出力内容を作成"""
-    calc_dist_local()
-    if train_item.exists() is False:
-        logger.critical("item.xml is not found")
-        logger.critical("Try to run 'python makeitem.py'")
-        sys.exit(1)
-    if train_chest.exists() is False:
-        logger.critical("chest.xml is not found")
-        logger.critical("Try to run 'python makechest.py'")
-        sys.exit(1)
-    if train_dcnt.exists() is False:
-        logger.critical("dcnt.xml is not found")
-        logger.critical("Try to run 'python makedcnt.py'")
-        sys.exit(1)
-    if train_card.exists() is False:
-        logger.critical("card.xml is not found")
-        logger.critical("Try to run 'python makecard.py'")
+# EXIF の DateTimeOriginal とそれがある Exif IFD のタグ
+EXIF_TAG_EXIF_IFD = 0x8769
+EXIF_TAG_DATETIME_ORIGINAL = 0x9003
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def read_exif_datetime(data):
+    """ファイル内容 data から EXIF の DateTimeOriginal を読む。無ければ "NON"
+
+    画素は展開せず、JPEG の APP1・PNG の eXIf チャンクの TIFF ヘッダーだけを調べる。
+    この方法で読めない形式のときは PIL の get_exif() で読む
+    """
+    try:
+        text = exif_datetime_text(io.BytesIO(data))
+    except (ValueError, struct.error):
+        from PIL import Image  # 読み込みが重いので使うときに import する
+
+        with Image.open(io.BytesIO(data)) as pilimg:
+            return get_exif(pilimg)
+    if text is None:
+        return "NON"
+    return datetime.datetime.strptime(text, "%Y:%m:%d %H:%M:%S")
+
+
+def exif_datetime_text(stream, before_idat=False):
+    """バイナリストリーム stream の DateTimeOriginal の文字列 (無ければ None)
+
+    ヘッダー部分だけを読み、画像データは読み飛ばす。
+    before_idat のときは PNG の画像データより後ろは調べない。
+    読めない形式のときは ValueError
+    """
+    head = stream.read(len(PNG_SIGNATURE))
+    if head.startswith(b"\xff\xd8"):
+        stream.seek(2)
+        tiff = jpeg_exif(stream)
+    elif head == PNG_SIGNATURE:
+        tiff = png_exif(stream, before_idat)
+    else:
+        raise ValueError("unknown image format")
+    if tiff is None:
+        return None
+    return tiff_datetime_original(tiff)
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise ValueError("unexpected end of file")
+    return data
+
+
+def jpeg_exif(stream):
+    """JPEG の最初の Exif の APP1 セグメントの TIFF 部分 (無ければ None)"""
+    while True:
+        marker = stream.read(2)
+        if len(marker) < 2:
+            return None
+        if marker[0] != 0xFF:
+            raise ValueError("broken JPEG marker")
+        if marker[1] == 0xFF:  # 詰め物
+            stream.seek(-1, io.SEEK_CUR)
+            continue
+        if marker[1] == 0xDA:  # SOS: 以降は画像データ
+            return None
+        (length,) = struct.unpack(">H", read_exactly(stream, 2))
+        if marker[1] == 0xE1:
+            segment = read_exactly(stream, length - 2)
+            if segment.startswith(b"Exif\0\0"):
+                return segment[6:]
+        else:
+            stream.seek(length - 2, io.SEEK_CUR)
+
+
+def png_exif(stream, before_idat=False):
+    """PNG の eXIf チャンクの内容 (無ければ None)
+    テキストチャンクに EXIF を入れたもの (ImageMagick など) は ValueError
+    """
+    while True:
+        header = stream.read(8)
+        if len(header) < 8:
+            return None
+        length, kind = struct.unpack(">I4s", header)
+        if kind == b"eXIf":
+            tiff = read_exactly(stream, length)
+            return tiff[6:] if tiff.startswith(b"Exif\0\0") else tiff
+        if kind in (b"tEXt", b"zTXt", b"iTXt"):
+            if read_exactly(stream, length).startswith(b"Raw profile type exif\0"):
+                raise ValueError("EXIF in a text chunk")
+            stream.seek(4, io.SEEK_CUR)  # CRC
+            continue
+        if kind == b"IEND" or (kind == b"IDAT" and before_idat):
+            return None
+        stream.seek(length + 4, io.SEEK_CUR)
+
+
+def read_file_exif_datetime(filename):
+    """ファイルの先頭のヘッダーだけを読んで撮影日時を返す。読めなければ None
+
+    PNG は画像データより前にある eXIf チャンクだけを調べる
+    """
+    try:
+        with open(filename, "rb", buffering=0) as f:
+            text = exif_datetime_text(f, before_idat=True)
+        if text is None:
+            return None
+        return datetime.datetime.strptime(text, "%Y:%m:%d %H:%M:%S")
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def tiff_datetime_original(tiff):
+    """TIFF 形式の EXIF から DateTimeOriginal の文字列 (無ければ None)
+    PIL と同じく IFD0 より Exif IFD の値を使う
+    """
+    if tiff[:4] == b"II*\0":
+        order = "<"
+    elif tiff[:4] == b"MM\0*":
+        order = ">"
+    else:
+        raise ValueError("not a TIFF header")
+
+    def entries(offset):
+        (count,) = struct.unpack_from(order + "H", tiff, offset)
+        for k in range(count):
+            yield struct.unpack_from(order + "HHI4s", tiff, offset + 2 + 12 * k)
+
+    def ascii_value(kind, count, value):
+        if kind != 2:  # ASCII
+            raise ValueError("DateTimeOriginal is not ASCII")
+        if count > 4:
+            (offset,) = struct.unpack(order + "I", value)
+            value = tiff[offset : offset + count]
+            if len(value) < count:
+                raise ValueError("truncated EXIF")
+        value = value[:count]
+        if value.endswith(b"\0"):
+            value = value[:-1]
+        return value.decode("latin-1", "replace")
+
+    (ifd0,) = struct.unpack_from(order + "I", tiff, 4)
+    text = None
+    exif_ifd = None
+    for tag, kind, count, value in entries(ifd0):
+        if tag == EXIF_TAG_DATETIME_ORIGINAL:
+            text = ascii_value(kind, count, value)
+        elif tag == EXIF_TAG_EXIF_IFD:
+            (exif_ifd,) = struct.unpack(order + "I", value)
+    if exif_ifd is not None:
+        for tag, kind, count, value in entries(exif_ifd):
+            if tag == EXIF_TAG_DATETIME_ORIGINAL:
+                text = ascii_value(kind, count, value)
+    return text
+
+
+def catalog_fingerprint(args):
+    """認識結果に影響するファイル一式のハッシュ
+
+    カタログ、ローカルのアイテム画像、SVM モデル、テンプレート画像と
+    認識処理のソースコードが変わればキャッシュは使われなくなる。
+    毎回中身を読まないよう、カタログのスナップショットと同じく
+    Catalog.source_signature() と各ファイルのサイズ・更新時刻で比べる
+    """
+    files = [
+        train_item,
+        train_chest,
+        train_dcnt,
+        train_card,
+        train_exp_class,
+        train_qp,  # 無ければ train_chest で代用する
+        basedir / Path("background.npz"),
+        Path(pageinfo.__file__).resolve(),
+    ]
+    for search_dir in [Item_dir, CE_dir, Point_dir]:
+        files += sorted(search_dir.glob("**/*.png"))
+    files += sorted((basedir / Path("data/misc")).glob("*.png"))
+    files += sorted((basedir / Path("data/pageinfo")).glob("*.png"))
+
+    h = hashlib.sha256()
+    h.update(f"{VERSION}:{args.lang}".encode())
+    h.update(repr(Catalog.source_signature()).encode())
+    for file in files:
+        h.update(str(file.relative_to(basedir)).encode() + b"\0")
+        if file.exists():
+            st = file.stat()
+            h.update(f"{st.st_size}:{st.st_mtime_ns}".encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class RecognitionCache:
+    """ファイルごとの認識結果のキャッシュ
+
+    キーはファイル内容の SHA-256 と catalog_fingerprint() の組。
+    合計サイズが max_bytes を超えたら最後に使ったのが古いものから捨てる。
+    generation は fingerprint を計算した時点の catalog_generation
+    """
+
+    def __init__(self, path, fingerprint, max_bytes=CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.fingerprint = fingerprint
+        self.generation = catalog_generation
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # サーバーではスレッド間で共有する (利用側でロックする)
+        self.conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, record TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)",
+        )
+        self.conn.commit()
+
+    def key(self, data):
+        return hashlib.sha256(data).hexdigest() + ":" + self.fingerprint
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT record FROM results WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            "UPDATE results SET last_used = ? WHERE key = ?",
+            (time.time(), key),
+        )
+        self.conn.commit()
+        record = json.loads(row[0])
+        if record["datetime"] != "NON":
+            record["datetime"] = datetime.datetime.fromisoformat(record["datetime"])
+        return record
+
+    def put(self, key, record):
+        # cache_stats はそのときの認識で使ったキャッシュの記録なので保存しない
+        record = {
+            k: v for k, v in record.items() if k not in ("filename", "cache_stats")
+        }
+        if record["datetime"] != "NON":
+            record["datetime"] = record["datetime"].isoformat()
+        text = json.dumps(record, ensure_ascii=False)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            (key, text, len(text.encode()), time.time()),
+        )
+        self.conn.commit()
+
+    def evict(self):
+        """合計サイズが max_bytes 以下になるまで古いものから削除する"""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute("SELECT key, size FROM results ORDER BY last_used")
+        removed = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            removed.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM results WHERE key = ?", removed)
+        self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+
+def open_cache(args):
+    """--no-cache が指定されていなければ RecognitionCache を開く"""
+    if getattr(args, "no_cache", False):
+        return None
+    try:
+        return RecognitionCache(cache_file, catalog_fingerprint(args))
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("recognition cache is disabled: %s", e)
+        return None
+
+
+def check_svm_files():
+    """SVM のトレーニングファイルが揃っているか確認する"""
+    try:
+        get_models().check()
+    except ModelError as e:
+        for line in str(e).splitlines():
+            logger.critical(line)
         sys.exit(1)
-    if train_exp_class.exists() is False:
-        logger.critical("exp_class.xml is not found")
-        logger.critical("Try to run 'python makeexp.py'")
+
+
+def load_models(models):
+    """models の全てのモデル・テンプレートを読み込む
+
+    キャッシュにあるファイルだけなら読み込まずに済むよう、キャッシュに無い
+    ファイルを初めて認識するときとプロセスプールを起動するときに呼ぶ。
+    読み込めなければ終了する
+    """
+    if models.loaded:
+        return models
+    try:
+        return models.load_all()
+    except ModelError as e:
+        for line in str(e).splitlines():
+            logger.critical(line)
         sys.exit(1)
-    svm = cv2.ml.SVM_load(str(train_item))
-    svm_chest = cv2.ml.SVM_load(str(train_chest))
-    svm_dcnt = cv2.ml.SVM_load(str(train_dcnt))
-    svm_card = cv2.ml.SVM_load(str(train_card))
-    svm_exp_class = cv2.ml.SVM_load(str(train_exp_class))
-
-    fileoutput = []  # 出力
-    output = {}
-    prev_pages = 0
-    prev_pagenum = 0
-    prev_total_qp = QP_UNKNOWN
-    prev_itemlist = []
-    prev_datetime = datetime.datetime(year=2015, month=7, day=30, hour=0)
-    prev_qp_gained = 0
-    prev_chestnum = 0
-    all_list = []
-
-    for filename in filenames:
-        exLogger = CustomAdapter(logger, {"target": filename})
-
-        logger.debug("filename: %s", filename)
-        f = Path(filename)
-
-        if f.exists() is False:
-            output = {"filename": str(filename) + ": not found"}
-            all_list.append([])
-        elif f.is_dir():  # for ZIP file from MacOS
+
+
+def recognize_file(filename, args, models, cache=None):
+    """1ファイル分の認識結果を dict で返す
+
+    前のファイルとの比較が必要な判定 (重複・欠落) は OutputMerger で行う。
+    """
+    logger.debug("filename: %s", filename)
+    f = Path(filename)
+
+    if f.exists() is False:
+        return {"filename": filename, "status": "not found"}
+    elif f.is_dir():  # for ZIP file from MacOS
+        return {"filename": filename, "status": "dir"}
+    elif f.suffix.upper() not in IMAGE_SUFFIXES:
+        return {"filename": filename, "status": "Not Supported"}
+    try:
+        data = f.read_bytes()
+    except OSError as e:
+        logger.exception(e)
+        return {"filename": filename, "status": "not valid"}
+    return recognize_data(filename, data, args, models, cache)
+
+
+def recognize_data(filename, data, args, models, cache=None):
+    """読み込み済みのファイル内容 data を認識した結果を dict で返す
+
+    cache があればファイル内容が同じときは認識せずにキャッシュを返す
+    args.profile があれば段階ごとの処理時間を record["profile"] に入れる
+    """
+    global _profile
+    if not getattr(args, "profile", None):
+        return _recognize_data(filename, data, args, models, cache)
+    previous, _profile = _profile, Profile(filename)
+    try:
+        record = _recognize_data(filename, data, args, models, cache)
+    finally:
+        profile, _profile = _profile, previous
+    record["profile"] = profile.result()
+    return record
+
+
+def _recognize_data(filename, data, args, models, cache):
+    exLogger = CustomAdapter(logger, {"target": filename})
+    fileextention = Path(filename).suffix
+    record = {"filename": filename}
+
+    if fileextention.upper() not in IMAGE_SUFFIXES:
+        record["status"] = "Not Supported"
+        return record
+    if cache is not None:
+        key = cache.key(data)
+        cached = cache.get(key)
+        if cached is not None:
+            logger.debug("cache hit: %s", filename)
+            record.update(cached)
+            return record
+    load_models(models)
+    with stage("decode"):
+        img_rgb = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    generation = catalog_generation
+    memo = get_screen_memo()
+
+    try:
+        # 前のスクショと同じ画面なら認識結果を使い回す
+        with stage("fingerprint"):
+            fingerprint = screen_fingerprint(img_rgb)
+            recalled = memo.recall(img_rgb, fingerprint, models, exLogger)
+        sc = None
+        if recalled is None:
+            sc = ScreenShot(
+                args, img_rgb, models, fileextention, exLogger, defer_tesseract=True
+            )
+        with stage("exif"):
+            dt = read_exif_datetime(data)
+    except CatalogFrozenError:
+        record["status"] = "new item"
+        return record
+    except Exception as e:
+        logger.error(filename)
+        logger.error(e, exc_info=True)
+        record["status"] = "not valid"
+        return record
+    # カタログが増えた後の結果はキャッシュを開いた時点のフィンガープリントでは保存しない
+    cacheable = cache is not None and generation == catalog_generation == cache.generation
+    if recalled is not None:
+        logger.debug("same screen as the previous file: %s", filename)
+        record.update(
+            status="ok", **recalled, cache_stats={"screen_hit": 1}, datetime=dt
+        )
+        if cacheable:
+            cache.put(key, record)
+        return record
+    memo.remember(fingerprint, sc)
+    cache_stats = Counter(sc.cache_stats, screen_miss=1)
+    record.update(
+        status="ok",
+        itemlist=sc.itemlist,
+        chestnum=sc.chestnum,
+        pagenum=sc.pagenum,
+        pages=sc.pages,
+        lines=sc.lines,
+        total_qp=sc.total_qp,
+        qp_gained=sc.qp_gained,
+        qp_readers=sc.qp_readers,
+        cache_stats=dict(cache_stats),
+        bunyan=sc.Bunyan,
+        datetime=dt,
+    )
+    if sc.qp_pending:
+        # tesseract で読む QP は read_pending_qp() でまとめて読んでから保存する
+        record["qp_pending"] = {
+            "images": sc.qp_pending,
+            "max_qp": sc.max_qp,
+            "cache_key": key if cacheable else None,
+        }
+    elif cacheable:
+        cache.put(key, record)
+    return record
+
+
+def read_pending_qp(records, cache=None):
+    """recognize_data() が qp_pending に残した QP を1回の tesseract でまとめて読む
+
+    読んだ後の record は ScreenShot がその場で tesseract を使った場合と同じになる。
+    cache があれば確定した record を保存する
+    """
+    pending = [record for record in records if "qp_pending" in record]
+    if len(pending) == 0:
+        return
+    indexes, texts = run_tesseract_batch(pending)
+    if texts is None and len(pending) > 1:
+        # まとめて読めなかったときは1ファイルずつ読み直し、読めないファイルだけ失敗にする
+        logger.warning("tesseract batch failed: retry each file")
+        for record in pending:
+            indexes, texts = run_tesseract_batch([record])
+            finish_pending_qp(record, indexes[0], texts, cache)
+        return
+    for record, index in zip(pending, indexes, strict=True):
+        finish_pending_qp(record, index, texts, cache)
+
+
+def run_tesseract_batch(records):
+    """records の qp_pending の画像を TesseractBatch で読む
+
+    (record ごとの {名前: texts での位置} のリスト, texts) を返す。
+    tesseract が失敗したときは texts は None
+    """
+    batch = TesseractBatch()
+    indexes = [
+        {name: batch.add(image) for name, image in record["qp_pending"]["images"].items()}
+        for record in records
+    ]
+    count_event("tesseract", len(batch.images))
+    try:
+        with stage("tesseract"):
+            texts = batch.run()
+    except Exception as e:
+        logger.exception(e)
+        texts = None
+    return indexes, texts
+
+
+def finish_pending_qp(record, index, texts, cache=None):
+    """まとめて読んだ結果 texts から record の QP を確定する
+
+    tesseract が失敗した (texts が None の) record はキャッシュに保存しない
+    """
+    pending = record.pop("qp_pending")
+    filename = record["filename"]
+    exLogger = CustomAdapter(logger, {"target": filename})
+    if texts is None:
+        exLogger.warning("QP detection fails")
+        record.update(total_qp=-1, qp_gained=-1)
+    else:
+        for name, k in index.items():
+            qp = ScreenShot.get_qp_from_text(texts[k])
+            if name == "total_qp":
+                record[name] = finish_total_qp(qp, pending["max_qp"], exLogger)
+            else:
+                record[name] = finish_qp_gained(qp)
+    try:
+        check_qp_gained(record["qp_gained"], record["itemlist"])
+    except GainedQPandDropMissMatchError as e:
+        logger.error(filename)
+        logger.error(e, exc_info=True)
+        record.clear()
+        record.update(filename=filename, status="not valid")
+        return
+    if texts is not None and cache is not None and pending["cache_key"] is not None:
+        cache.put(pending["cache_key"], record)
+
+
+def read_pending_qp_in_batches(records, cache=None, size=TESSERACT_BATCH_FILES):
+    """records を順番に返すジェネレータ
+
+    tesseract で読む QP が残っている record があれば、それ以降の record を
+    size 件まで貯めてからまとめて読んで返す
+    """
+    buffer = []
+    for record in records:
+        if len(buffer) == 0 and "qp_pending" not in record:
+            yield record
             continue
-        elif f.suffix.upper() not in [".PNG", ".JPG", ".JPEG"]:
-            output = {"filename": str(filename) + ": Not Supported"}
-            all_list.append([])
+        buffer.append(record)
+        if len(buffer) >= size:
+            read_pending_qp(buffer, cache)
+            yield from buffer
+            buffer = []
+    read_pending_qp(buffer, cache)
+    yield from buffer
+
+
+# ワーカープロセスで読み込んだ引数と SVM
+_worker_args = None
+_worker_cache = None
+
+
+def _init_worker(args, loglevel, fingerprint):
+    global _worker_args, _worker_cache, catalog_frozen
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    logger.setLevel(loglevel)
+    calc_dist_local()
+    # 新規アイテムファイルの作成は親プロセスだけで行う
+    catalog_frozen = True
+    _worker_args = args
+    # fork で起動した場合は親プロセスで読み込み済みのものがそのまま使われる
+    load_models(get_models())
+    if fingerprint is not None:
+        _worker_cache = RecognitionCache(cache_file, fingerprint)
+
+
+def _recognize_in_worker(filename):
+    return recognize_file(filename, _worker_args, get_models(), _worker_cache)
+
+
+def _recognize_data_in_worker(task):
+    filename, data, run = task
+    get_screen_memo().start(run)
+    return recognize_data(filename, data, _worker_args, get_models(), _worker_cache)
+
+
+def recognize_files(filenames, args, models, cache=None):
+    """ファイルを順番に認識し、結果を入力順に返すジェネレータ
+
+    args.jobs が 2 以上のときはプロセスプールで並列に認識する。
+    カタログに無いアイテムが見つかった場合は、それ以降のファイルを
+    このプロセスで逐次処理して、--jobs 1 と同じアイテムファイル・id になるようにする。
+    """
+    filenames = list(filenames)
+    jobs = getattr(args, "jobs", 1) or os.cpu_count()
+    done = 0
+    if jobs > 1 and len(filenames) > 1:
+        # ワーカーにも読み込み済みのものを引き継ぐ
+        load_models(models)
+        with multiprocessing.Pool(
+            min(jobs, len(filenames)),
+            initializer=_init_worker,
+            initargs=(
+                args,
+                logger.getEffectiveLevel(),
+                None if cache is None else cache.fingerprint,
+            ),
+        ) as pool:
+            for record in pool.imap(_recognize_in_worker, filenames):
+                if record["status"] == "new item":
+                    logger.debug("new item found: switch to sequential mode")
+                    break
+                done += 1
+                yield record
+    for filename in filenames[done:]:
+        yield recognize_file(filename, args, models, cache)
+
+
+class OutputMerger:
+    """ファイルごとの認識結果を処理順に受け取り、重複・欠落を判定して出力を作る
+
+    fileoutput と all_list は get_output() の戻り値と同じ形式で、
+    要素は常に対応している。keep=False のときは貯めない。
+    status と missing は最後に追加した record の判定結果
+    ("ok", "duplicate" や認識時のエラー / 前に欠落したスクショがあるか)
+    """
+
+    def __init__(self, args, keep=True):
+        self.args = args
+        self.keep = keep
+        self.fileoutput = []  # 出力
+        self.all_list = []
+        self.status = None
+        self.missing = False
+        self.prev_pages = 0
+        self.prev_pagenum = 0
+        self.prev_total_qp = QP_UNKNOWN
+        self.prev_itemlist = []
+        self.prev_datetime = datetime.datetime(year=2015, month=7, day=30, hour=0)
+        self.prev_qp_gained = 0
+        self.prev_chestnum = 0
+
+    def add(self, record):
+        """record を追加し、増えた (出力, アイテムリスト) の組を返す"""
+        self.status = record["status"]
+        self.missing = False
+        entries = self.merge(record)
+        if self.keep:
+            for output, itemlist in entries:
+                self.fileoutput.append(output)
+                self.all_list.append(itemlist)
+        return entries
+
+    def merge(self, record):
+        filename = record["filename"]
+        status = record["status"]
+        if status == "dir":
+            return []
+        if status != "ok":
+            return [({"filename": str(filename) + ": " + status}, [])]
+        try:
+            return self.merge_screenshot(record)
+        except Exception as e:
+            logger.error(filename)
+            logger.error(e, exc_info=True)
+            self.status = "not valid"
+            return [({"filename": str(filename) + ": not valid"}, [])]
+
+    def merge_screenshot(self, record):
+        args = self.args
+        filename = record["filename"]
+        itemlist = record["itemlist"]
+        pagenum = record["pagenum"]
+        pages = record["pages"]
+        lines = record["lines"]
+        total_qp = record["total_qp"]
+        qp_gained = record["qp_gained"]
+        dt = record["datetime"]
+        entries = []
+
+        if itemlist[0]["id"] != ID_REWARD_QP and pagenum == 1:
+            logger.warning(
+                "Page count recognition is failing: %s",
+                filename,
+            )
+        # ドロップ内容が同じで下記のとき、重複除外
+        # QPカンストじゃない時、QPが前と一緒
+        # QPカンストの時、Exif内のファイル作成時間が15秒未満
+        if dt == "NON" or self.prev_datetime == "NON":
+            td = datetime.timedelta(days=1)
         else:
-            img_rgb = imread(filename)
-            fileextention = Path(filename).suffix
+            td = dt - self.prev_datetime
+        if record["bunyan"]:
+            if pages == 1:
+                pass
+            elif lines % 3 == 1:
+                itemlist = itemlist[-1:]
+            else:
+                itemlist = itemlist[7 - (lines + 1) % 3 * 7 :]
+        elif pages - pagenum == 0:
+            itemlist = itemlist[14 - (lines + 2) % 3 * 7 :]
+        if self.prev_itemlist == itemlist:
+            if (
+                total_qp != -1
+                and total_qp != 2000000000
+                and total_qp == self.prev_total_qp
+            ) or (
+                (total_qp == -1 or total_qp == 2000000000)
+                and td.total_seconds() < args.timeout
+            ):
+                logger.debug("args.timeout: %s", args.timeout)
+                logger.debug("filename: %s", filename)
+                logger.debug("prev_itemlist: %s", self.prev_itemlist)
+                logger.debug("sc.itemlist: %s", itemlist)
+                logger.debug("sc.total_qp: %s", total_qp)
+                logger.debug("prev_total_qp: %s", self.prev_total_qp)
+                logger.debug("datetime: %s", dt)
+                logger.debug("prev_datetime: %s", self.prev_datetime)
+                logger.debug("td.total_second: %s", td.total_seconds())
+                self.status = "duplicate"
+                return [({"filename": str(filename) + ": duplicate"}, [])]
+
+        # 2頁目以前のスクショが無い場合に migging と出力
+        # 1. 前頁が最終頁じゃない&前頁の続き頁数じゃない
+        # または前頁が最終頁なのに1頁じゃない
+        # 2. 前頁の続き頁なのに獲得QPが違う
+        if (
+            (self.prev_pages - self.prev_pagenum > 0 and pagenum - self.prev_pagenum != 1)
+            or (self.prev_pages - self.prev_pagenum == 0 and pagenum != 1)
+            or (
+                pagenum != 1
+                and pagenum - self.prev_pagenum == 1
+                and (self.prev_qp_gained != qp_gained)
+            )
+        ):
+            logger.debug("prev_pages: %s", self.prev_pages)
+            logger.debug("prev_pagenum: %s", self.prev_pagenum)
+            logger.debug("sc.pagenum: %s", pagenum)
+            logger.debug("prev_qp_gained: %s", self.prev_qp_gained)
+            logger.debug("sc.qp_gained: %s", qp_gained)
+            logger.debug("prev_chestnum: %s", self.prev_chestnum)
+            logger.debug("sc.chestnum: %s", record["chestnum"])
+            self.missing = True
+            entries.append(({"filename": "missing"}, []))
+
+        self.prev_pages = pages
+        self.prev_pagenum = pagenum
+        self.prev_total_qp = total_qp
+        self.prev_itemlist = itemlist
+        self.prev_datetime = dt
+        self.prev_qp_gained = qp_gained
+        self.prev_chestnum = record["chestnum"]
+
+        sumdrop = len([d for d in itemlist if d["id"] != ID_REWARD_QP])
+        if args.lang == "jpn":
+            drop_count = "ドロ数"
+            item_count = "アイテム数"
+            gained_qp = "獲得QP合計"
+        else:
+            drop_count = "item_count"
+            item_count = "item_count"
+            gained_qp = "gained_qp"
+        output = {
+            "filename": str(filename),
+            drop_count: record["chestnum"],
+            item_count: sumdrop,
+            gained_qp: qp_gained,
+        }
+        entries.append((output, itemlist))
+        return entries
+
+
+def iter_records(filenames, args, grouped=False):
+    """認識の準備をして、ファイルごとの認識結果を入力順に返すジェネレータ
+
+    tesseract で読む QP は read_pending_qp_in_batches() でまとめて読む。
+    最後に QP をどの方法で読んだかの集計をログに出す。
+    grouped のときは filenames はファイル名のリストを順に返すイテラブル (--watch) で、
+    リストごとに並列処理と tesseract の一括読み取りを行い、そこまでの結果を返す
+    """
+    global _profile
+    calc_dist_local()
+    # 前の実行で認識したスクショとは比べない
+    get_screen_memo().start(object())
+    # モデルはキャッシュに無いファイルを認識するときに読み込む
+    models = get_models()
+    cache = open_cache(args)
+    qp_readers = Counter()
+    cache_stats = Counter()
+    report = None
+    if getattr(args, "profile", None):
+        report = ProfileReport(args.profile)
+        # ファイル単位でない処理 (tesseract の一括読み取り) はこのプロセスの Profile に記録する
+        _profile = Profile()
+    try:
+        for group in filenames if grouped else [filenames]:
+            records = recognize_files(group, args, models, cache)
+            if report is not None:
+                records = collect_profiles(records, report)
+            for record in read_pending_qp_in_batches(records, cache):
+                qp_readers.update(record.get("qp_readers", {}).values())
+                cache_stats.update(record.get("cache_stats", {}))
+                yield record
+    finally:
+        if cache is not None:
+            cache.close()
+        log_qp_readers(qp_readers)
+        log_cache_stats(cache_stats)
+        if report is not None:
+            report.add_batch(_profile.result())
+            _profile = None
+            report.write()
+
+
+def collect_profiles(records, report):
+    """record から profile を取り出して report に加える
+    (キャッシュに保存される前に取り除く)
+    """
+    for record in records:
+        profile = record.pop("profile", None)
+        if profile is not None:
+            report.add(record["filename"], profile)
+        yield record
+
+
+def log_qp_readers(qp_readers):
+    """QP の読み取り方法ごとの回数をログに出す"""
+    if qp_readers:
+        text = ", ".join(f"{name}: {qp_readers[name]}" for name in QP_READERS)
+        logger.info("QP readers: %s", text)
+
+
+def log_cache_stats(cache_stats):
+    """スクショをまたぐキャッシュのヒット率をログに出す"""
+    for name, label in (
+        ("screen", "same screen as previous"),
+        ("tile", "tile cache"),
+        ("stack", "stack cache"),
+    ):
+        hit, miss = cache_stats[name + "_hit"], cache_stats[name + "_miss"]
+        if hit + miss:
+            logger.info(
+                "%s: %d/%d hits (%.1f%%)", label, hit, hit + miss, 100 * hit / (hit + miss)
+            )
+
+
+def get_output(filenames, args):
+    """出力内容を作成"""
+    merger = OutputMerger(args)
+    for record in iter_records(filenames, args):
+        merger.add(record)
+    return merger.fileoutput, merger.all_list
+
 
+class OutputSummary:
+    """出力したアイテムを集計し、最後にクエスト名と合計を作る
+
+    アイテムは重複を除いて持つので、ファイル数が増えてもメモリは増えない。
+    クエスト名と合計は make_csv_header() / make_csv_data() と同じになる
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.items = {}
+        self.total = Counter()
+        self.rows = 0
+        self.last_chestnum = None
+
+    def add(self, output, itemlist):
+        self.rows += 1
+        for item in itemlist:
+            short = {
+                k: item[k] for k in ("id", "name", "category", "dropPriority", "dropnum")
+            }
+            self.items.setdefault(json.dumps(short), short)
+            self.total[item_label(self.args, item)] += 1
+        if output.get("filename") != "missing":
+            self.last_chestnum = output.get(drop_count_key(self.args))
+
+    def quest_and_total(self):
+        """(クエスト名, {アイテム: 合計}) を返す"""
+        _, ce0_flag, questname = make_csv_header(self.args, [list(self.items.values())])
+        total = dict(self.total)
+        if ce0_flag:
+            total["礼装" if self.args.lang == "jpn" else "CE"] = 0
+        return questname, total
+
+
+def write_jsonl(args, records, stream):
+    """ファイルごとの認識結果を認識した順に1行ずつ JSON で書き出す
+    最後にクエスト名と合計の行を書く
+    """
+    merger = OutputMerger(args, keep=False)
+    summary = OutputSummary(args)
+    screenshots = 0
+    for record in records:
+        entries = merger.add(record)
+        if not entries:  # ディレクトリ
+            continue
+        output, itemlist = entries[-1]
+        for entry in entries:
+            summary.add(*entry)
+        line = {
+            "type": "screenshot",
+            "filename": str(record["filename"]),
+            "status": merger.status,
+            "missing": merger.missing,
+        }
+        if merger.status == "ok":
+            screenshots += 1
+            line.update(
+                drop_count=record["chestnum"],
+                item_count=len([d for d in itemlist if d["id"] != ID_REWARD_QP]),
+                qp_gained=record["qp_gained"],
+                total_qp=record["total_qp"],
+                pagenum=record["pagenum"],
+                pages=record["pages"],
+                lines=record["lines"],
+                datetime=record["datetime"],
+                items=dict(Counter(item_label(args, item) for item in itemlist)),
+                itemlist=itemlist,
+            )
+        write_json_line(line, stream)
+    questname, total = summary.quest_and_total()
+    write_json_line(
+        {
+            "type": "summary",
+            "quest": questname,
+            "screenshots": screenshots,
+            # issue: #55 と同じく、最後のスクショのドロップ数が確定しない場合
+            "missing": summary.rows > 1 and str(summary.last_chestnum).endswith("+"),
+            "items": total,
+        },
+        stream,
+    )
+
+
+def watch_folder(folder, ordering, interval=WATCH_INTERVAL):
+    """folder に増えた画像ファイルのリストを返し続けるジェネレータ (--watch)
+
+    最初は既にあるファイルをすべて返す。その後は新しいファイルのうち、
+    サイズが前回調べたときと同じ (同期が終わった) ものだけを返す
+    """
+    folder = Path(folder)
+    done = set()
+    sizes = {}
+    first = True
+    while True:
+        ready = []
+        for f in folder.glob(r"**/[!.]*"):
+            if f in done or f.suffix.upper() not in IMAGE_SUFFIXES:
+                continue
             try:
-                sc = ScreenShot(
-                    args,
-                    img_rgb,
-                    svm,
-                    svm_chest,
-                    svm_dcnt,
-                    svm_card,
-                    svm_exp_class,
-                    fileextention,
-                    exLogger,
-                )
-                if sc.itemlist[0]["id"] != ID_REWARD_QP and sc.pagenum == 1:
-                    logger.warning(
-                        "Page count recognition is failing: %s",
-                        filename,
-                    )
-                # ドロップ内容が同じで下記のとき、重複除外
-                # QPカンストじゃない時、QPが前と一緒
-                # QPカンストの時、Exif内のファイル作成時間が15秒未満
-                pilimg = Image.open(filename)
-                dt = get_exif(pilimg)
-                if dt == "NON" or prev_datetime == "NON":
-                    td = datetime.timedelta(days=1)
-                else:
-                    td = dt - prev_datetime
-                if sc.Bunyan:
-                    if sc.pages == 1:
-                        pass
-                    elif sc.lines % 3 == 1:
-                        sc.itemlist = sc.itemlist[-1:]
-                    else:
-                        sc.itemlist = sc.itemlist[7 - (sc.lines + 1) % 3 * 7 :]
-                elif sc.pages - sc.pagenum == 0:
-                    sc.itemlist = sc.itemlist[14 - (sc.lines + 2) % 3 * 7 :]
-                if prev_itemlist == sc.itemlist:
-                    if (
-                        sc.total_qp != -1
-                        and sc.total_qp != 2000000000
-                        and sc.total_qp == prev_total_qp
-                    ) or (
-                        (sc.total_qp == -1 or sc.total_qp == 2000000000)
-                        and td.total_seconds() < args.timeout
-                    ):
-                        logger.debug("args.timeout: %s", args.timeout)
-                        logger.debug("filename: %s", filename)
-                        logger.debug("prev_itemlist: %s", prev_itemlist)
-                        logger.debug("sc.itemlist: %s", sc.itemlist)
-                        logger.debug("sc.total_qp: %s", sc.total_qp)
-                        logger.debug("prev_total_qp: %s", prev_total_qp)
-                        logger.debug("datetime: %s", dt)
-                        logger.debug("prev_datetime: %s", prev_datetime)
-                        logger.debug("td.total_second: %s", td.total_seconds())
-                        fileoutput.append({"filename": str(filename) + ": duplicate"})
-                        all_list.append([])
-                        continue
-
-                # 2頁目以前のスクショが無い場合に migging と出力
-                # 1. 前頁が最終頁じゃない&前頁の続き頁数じゃない
-                # または前頁が最終頁なのに1頁じゃない
-                # 2. 前頁の続き頁なのに獲得QPが違う
-                if (
-                    (prev_pages - prev_pagenum > 0 and sc.pagenum - prev_pagenum != 1)
-                    or (prev_pages - prev_pagenum == 0 and sc.pagenum != 1)
-                    or (
-                        sc.pagenum != 1
-                        and sc.pagenum - prev_pagenum == 1
-                        and (prev_qp_gained != sc.qp_gained)
-                    )
-                ):
-                    logger.debug("prev_pages: %s", prev_pages)
-                    logger.debug("prev_pagenum: %s", prev_pagenum)
-                    logger.debug("sc.pagenum: %s", sc.pagenum)
-                    logger.debug("prev_qp_gained: %s", prev_qp_gained)
-                    logger.debug("sc.qp_gained: %s", sc.qp_gained)
-                    logger.debug("prev_chestnum: %s", prev_chestnum)
-                    logger.debug("sc.chestnum: %s", sc.chestnum)
-                    fileoutput.append({"filename": "missing"})
-                    all_list.append([])
-
-                all_list.append(sc.itemlist)
-
-                prev_pages = sc.pages
-                prev_pagenum = sc.pagenum
-                prev_total_qp = sc.total_qp
-                prev_itemlist = sc.itemlist
-                prev_datetime = dt
-                prev_qp_gained = sc.qp_gained
-                prev_chestnum = sc.chestnum
-
-                sumdrop = len([d for d in sc.itemlist if d["id"] != ID_REWARD_QP])
-                if args.lang == "jpn":
-                    drop_count = "ドロ数"
-                    item_count = "アイテム数"
-                    gained_qp = "獲得QP合計"
-                else:
-                    drop_count = "item_count"
-                    item_count = "item_count"
-                    gained_qp = "gained_qp"
-                output = {
-                    "filename": str(filename),
-                    drop_count: sc.chestnum,
-                    item_count: sumdrop,
-                    gained_qp: sc.qp_gained,
-                }
+                size = f.stat().st_size
+            except OSError:  # 調べる間に消された
+                continue
+            if first or (size > 0 and sizes.get(f) == size):
+                ready.append(f)
+            sizes[f] = size
+        for f in ready:
+            done.add(f)
+            del sizes[f]
+        if ready:
+            yield sort_files(ready, ordering)
+        first = False
+        time.sleep(interval)
+
+
+def watch_records(args):
+    """--watch: args.folder に増えたファイルの認識結果を返し続ける。Ctrl-C で終わる"""
+    groups = watch_folder(args.folder, args.ordering)
+    try:
+        yield from iter_records(groups, args, grouped=True)
+    except KeyboardInterrupt:
+        logger.info("stop watching %s", args.folder)
 
-            except Exception as e:
-                logger.error(filename)
-                logger.error(e, exc_info=True)
-                output = {"filename": str(filename) + ": not valid"}
-                all_list.append([])
-        fileoutput.append(output)
-    return fileoutput, all_list
+
+def watch_csv(args, records, path):
+    """records を1件追加するたびに、それまでの CSV を path に書き直す
+
+    前のファイルとの比較 (重複・欠落) の状態は OutputMerger が持ち続けるので、
+    認識するのは新しいファイルだけでよい
+    """
+    merger = OutputMerger(args)
+    for record in records:
+        if merger.add(record):
+            write_csv_file(args, merger.fileoutput, merger.all_list, path)
+
+
+def write_json_line(obj, stream):
+    def default(o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+    stream.write(json.dumps(obj, ensure_ascii=False, default=default) + "\n")
+    stream.flush()
 
 
 def sort_files(files, ordering):
@@ -3026,6 +5416,15 @@ def sort_files(files, ordering):
         return sorted(files)
     if ordering == Ordering.TIMESTAMP:
         return sorted(files, key=lambda f: Path(f).stat().st_ctime)
+    if ordering == Ordering.EXIF:
+        # 撮影日時順、同じ日時はファイル名順。撮影日時が無いものは最後にファイル名順
+        with ThreadPoolExecutor(EXIF_READ_THREADS) as executor:
+            times = list(executor.map(read_file_exif_datetime, files))
+        order = sorted(
+            range(len(files)),
+            key=lambda k: (times[k] is None, times[k] or datetime.datetime.min, str(files[k])),
+        )
+        return [files[k] for k in order]
     raise ValueError(f"Unsupported ordering: {ordering}")
 
 
@@ -3187,15 +5586,16 @@ def deside_tresure_valut_quest(item_list):
     return quest_candidate
 
 
-def deside_quest(item_list):
-    quest_name = deside_tresure_valut_quest(item_list)
-    if quest_name != "":
-        return quest_name
-
+def quest_item_set(item_list):
+    """クエストの判別に使うドロップ名の集合と報酬QP
+    QuestIndex.dropset() と同じく礼装・FP・イベントアイテム等は除く
+    """
+    reward_qp = 0
     item_set = set()
     for item in item_list:
         if item["id"] == ID_REWARD_QP:
             item_set.add("QP(+" + str(item["dropnum"]) + ")")
+            reward_qp = item["dropnum"]
         elif (
             item["id"] == ID_FP
             or item["id"] == 1
@@ -3208,14 +5608,16 @@ def deside_quest(item_list):
             continue
         else:
             item_set.add(item["name"])
-    quest_candidate = ""
-    for quest in reversed(freequest):
-        dropset = {i["name"] for i in quest["drop"] if i["type"] != "Craft Essence"}
-        dropset.add("QP(+" + str(quest["qp"]) + ")")
-        if dropset == item_set:
-            quest_candidate = quest
-            break
-    return quest_candidate
+    return item_set, reward_qp
+
+
+def deside_quest(item_list):
+    quest_name = deside_tresure_valut_quest(item_list)
+    if quest_name != "":
+        return quest_name
+
+    item_set, _ = quest_item_set(item_list)
+    return catalog.quest_index.find(item_set)
 
 
 def quest_name_recognition(item_list):
@@ -3228,52 +5630,23 @@ def quest_name_recognition(item_list):
         [type]: [description]
 
     """
-    reward_qp = 0
-    item_set = set()
-    for item in item_list:
-        if item["id"] == ID_REWARD_QP:
-            item_set.add("QP(+" + str(item["dropnum"]) + ")")
-            reward_qp = item["dropnum"]
-        elif (
-            item["id"] == ID_FP
-            or item["id"] == 1
-            or item["category"] == "Craft Essence"
-            or (
-                9700 <= math.floor(item["id"] / 1000) <= 9707
-                and str(item["id"])[4] not in ["4", "5"]
-            )
-        ):
-            continue
-        else:
-            item_set.add(item["name"])
+    item_set, reward_qp = quest_item_set(item_list)
     if reward_qp == 0:
         return "", []
-    quest_candidate = []
-    # 報酬QPが同じクエストの一覧を作る
-    for quest in reversed(freequest):
-        if quest["qp"] == reward_qp:
-            quest_candidate.append(quest)
-    # クエスト一覧に含まれるかチェック
+    # 報酬QPが同じで認識したアイテムを全て含むクエスト
     # 含まれるクエストが一つだったら出力
-    quest_candidate2 = []
+    candidates = catalog.quest_index.supersets(item_set, reward_qp)
+    if len(candidates) != 1:
+        return "", []
+    quest, dropset = candidates[0]
     missing_items = []
-    for quest in quest_candidate:
-        dropset = {i["name"] for i in quest["drop"] if i["type"] != "Craft Essence"}
-        dropset.add("QP(+" + str(quest["qp"]) + ")")
-        diff = item_set - dropset
-        if len(diff) == 0:
-            tmp_items = []
-            diff2 = dropset - item_set
-            quest_candidate2.append(quest)
-            for item in quest["drop"]:
-                if item["name"] in diff2:
-                    item["dropnum"] = 0
-                    item["category"] = "Item"
-                    tmp_items.append(item)
-            missing_items.append(tmp_items)
-    if len(quest_candidate2) == 1:
-        return quest_candidate2[0], missing_items[0]
-    return "", []
+    diff2 = dropset - item_set
+    for item in quest["drop"]:
+        if item["name"] in diff2:
+            item["dropnum"] = 0
+            item["category"] = "Item"
+            missing_items.append(item)
+    return quest, missing_items
 
 
 def make_csv_header(args, item_list):
@@ -3382,34 +5755,30 @@ def make_csv_header(args, item_list):
     )
 
 
+def item_label(args, item):
+    """CSV の列名になるアイテム名 (ドロップ数付き)"""
+    if (
+        item["category"] in ["Quest Reward", "Point"]
+        or item["name"] == "QP"
+        or item["name"] == "フレンドポイント"
+    ):
+        return out_name(args, item["id"]) + "(+" + change_value(args, item["dropnum"]) + ")"
+    elif item["dropnum"] > 1:
+        return out_name(args, item["id"]) + "(x" + change_value(args, item["dropnum"]) + ")"
+    return out_name(args, item["id"])
+
+
+def drop_count_key(args):
+    return "ドロ数" if args.lang == "jpn" else "drop_count"
+
+
 def make_csv_data(args, sc_list, ce0_flag):
     if sc_list == []:
         return [{}], [{}]
     csv_data = []
     allitem = []
     for sc in sc_list:
-        tmp = []
-        for item in sc:
-            if (
-                item["category"] in ["Quest Reward", "Point"]
-                or item["name"] == "QP"
-                or item["name"] == "フレンドポイント"
-            ):
-                tmp.append(
-                    out_name(args, item["id"])
-                    + "(+"
-                    + change_value(args, item["dropnum"])
-                    + ")",
-                )
-            elif item["dropnum"] > 1:
-                tmp.append(
-                    out_name(args, item["id"])
-                    + "(x"
-                    + change_value(args, item["dropnum"])
-                    + ")",
-                )
-            else:
-                tmp.append(out_name(args, item["id"]))
+        tmp = [item_label(args, item) for item in sc]
         allitem = allitem + tmp
         csv_data.append(dict(Counter(tmp)))
     csv_sum = dict(Counter(allitem))
@@ -3422,6 +5791,65 @@ def make_csv_data(args, sc_list, ce0_flag):
     return csv_sum, csv_data
 
 
+def make_output_rows(args, fileoutput, all_new_list):
+    """get_output() の結果から CSV の (ヘッダ, 行のリスト) を作る
+    先頭の行はクエスト名と合計
+    """
+    csv_header, ce0_flag, questname = make_csv_header(args, all_new_list)
+    csv_sum, csv_data = make_csv_data(args, all_new_list, ce0_flag)
+    a = list_to_dict(csv_header)
+
+    if args.lang == "jpn":
+        drop_count = "ドロ数"
+        item_count = "アイテム数"
+        gained_qp = "獲得QP合計"
+    else:
+        drop_count = "drop_count"
+        item_count = "item_count"
+        gained_qp = "gained_qp"
+    rows = []
+    if len(all_new_list) > 0:
+        if questname == "":
+            if args.lang == "jpn":
+                questname = "合計"
+            else:
+                questname = "SUM"
+        a.update({"filename": questname, drop_count: "", item_count: "", gained_qp: ""})
+        a.update(csv_sum)
+        rows.append(a)
+    for fo, cd in zip(fileoutput, csv_data, strict=False):
+        fo.update(cd)
+        rows.append(fo)
+    if drop_count in fo.keys():  # issue: #55
+        if len(fileoutput) > 1 and str(fo[drop_count]).endswith("+"):
+            rows.append({"filename": "missing"})
+    return csv_header, rows
+
+
+def write_csv(args, fileoutput, all_new_list, stream):
+    """get_output() の結果を CSV で stream に書き出す"""
+    if len(all_new_list) == 0:
+        stream.write("filename,ドロ数\n合計,0\nファイルが見つかりません,\n\n")
+        return
+    csv_header, rows = make_output_rows(args, fileoutput, all_new_list)
+    writer = csv.DictWriter(stream, fieldnames=csv_header, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def write_csv_file(args, fileoutput, all_new_list, path):
+    """CSV を path に書き出す
+    書きかけのファイルが読まれないよう、一時ファイルに書いてから置き換える
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    # make_output_rows() は fileoutput の要素を書き換えるので、書き直す場合に備えて写す
+    fileoutput = [dict(fo) for fo in fileoutput]
+    with open(tmp, "w", encoding="utf_8_sig", newline="") as f:
+        write_csv(args, fileoutput, all_new_list, f)
+    os.replace(tmp, path)
+
+
 def list_to_dict(lst):
     result = {}
     for item in lst:
@@ -3429,7 +5857,7 @@ def list_to_dict(lst):
     return result
 
 
-if __name__ == "__main__":
+def main(argv=None):
     # オプションの解析
     parser = argparse.ArgumentParser(
         description="Image Parse for FGO Battle Results",
@@ -3447,6 +5875,14 @@ if __name__ == "__main__":
         help="Language to be used for output: Default " + DEFAULT_ITEM_LANG,
     )
     parser.add_argument("-f", "--folder", help="Specify by folder")
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="Keep watching the folder (-f) and recognize only new files "
+        "(csv: rewrite the output file, jsonl: append a line per file) until Ctrl-C",
+    )
+    parser.add_argument("-o", "--output", help="Output file (default: stdout)")
     parser.add_argument(
         "--ordering",
         help="The order in which files are processed ",
@@ -3462,14 +5898,44 @@ if __name__ == "__main__":
         default=TIMEOUT,
         help=text_timeout + str(TIMEOUT) + " sec",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes (0: number of CPUs): Default 1",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use or update the recognition cache",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("csv", "jsonl"),
+        default="csv",
+        help="csv: summary table after all files (default), "
+        "jsonl: one JSON line per file as soon as it is recognized, then a summary line",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile.json",
+        metavar="FILE",
+        help="Write per-stage timings to FILE (default profile.json) "
+        "and a Chrome trace to FILE with .trace.json",
+    )
     parser.add_argument("--version", action="version", version=PROGNAME + " " + VERSION)
     parser.add_argument("-l", "--loglevel", choices=("debug", "info"), default="info")
 
-    args = parser.parse_args()  # 引数を解析
-    lformat = "%(name)s <%(filename)s-L%(lineno)s> [%(levelname)s] %(message)s"
+    args = parser.parse_args(argv)  # 引数を解析
+    if args.watch and not args.folder:
+        parser.error("--watch requires -f FOLDER")
+    if args.watch and args.format == "csv" and not args.output:
+        parser.error("--watch with csv output requires -o FILE")
     logging.basicConfig(
         level=logging.INFO,
-        format=lformat,
+        format=LOG_FORMAT,
     )
     logger.setLevel(args.loglevel.upper())
 
@@ -3477,46 +5943,34 @@ if __name__ == "__main__":
         if not ndir.is_dir():
             ndir.mkdir(parents=True)
 
-    if args.folder:
-        inputs = [x for x in Path(args.folder).glob(r"**/[!.]*")]
-    else:
-        inputs = args.filenames
-
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf_8_sig")
+    # --watch では watch_folder() がフォルダを調べて並べ替える
+    inputs = []
+    if not args.watch:
+        if args.folder:
+            inputs = [x for x in Path(args.folder).glob(r"**/[!.]*")]
+        else:
+            inputs = args.filenames
+        inputs = sort_files(inputs, args.ordering)
+    if args.format == "jsonl":
+        records = watch_records(args) if args.watch else iter_records(inputs, args)
+        if args.output:
+            with open(args.output, "w", encoding="utf_8") as f:
+                write_jsonl(args, records, f)
+        else:
+            sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf_8")
+            write_jsonl(args, records, sys.stdout)
+        return
 
-    inputs = sort_files(inputs, args.ordering)
+    if args.watch:
+        watch_csv(args, watch_records(args), args.output)
+        return
     fileoutput, all_new_list = get_output(inputs, args)
-    if len(all_new_list) == 0:
-        print("filename,ドロ数\n合計,0\nファイルが見つかりません,\n")
-        exit(0)
+    if args.output:
+        write_csv_file(args, fileoutput, all_new_list, args.output)
+    else:
+        sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf_8_sig")
+        write_csv(args, fileoutput, all_new_list, sys.stdout)
 
-    # CSVヘッダーをつくる
-    csv_header, ce0_flag, questname = make_csv_header(args, all_new_list)
-    csv_sum, csv_data = make_csv_data(args, all_new_list, ce0_flag)
-    a = list_to_dict(csv_header)
 
-    writer = csv.DictWriter(sys.stdout, fieldnames=csv_header, lineterminator="\n")
-    writer.writeheader()
-    if args.lang == "jpn":
-        drop_count = "ドロ数"
-        item_count = "アイテム数"
-        gained_qp = "獲得QP合計"
-    else:
-        drop_count = "drop_count"
-        item_count = "item_count"
-        gained_qp = "gained_qp"
-    if len(all_new_list) > 0:
-        if questname == "":
-            if args.lang == "jpn":
-                questname = "合計"
-            else:
-                questname = "SUM"
-        a.update({"filename": questname, drop_count: "", item_count: "", gained_qp: ""})
-        a.update(csv_sum)
-        writer.writerow(a)
-    for fo, cd in zip(fileoutput, csv_data, strict=False):
-        fo.update(cd)
-        writer.writerow(fo)
-    if drop_count in fo.keys():  # issue: #55
-        if len(fileoutput) > 1 and str(fo[drop_count]).endswith("+"):
-            writer.writerow({"filename": "missing"})
+if __name__ == "__main__":
+    main()
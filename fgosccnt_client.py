@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# fgosccnt_server.py のクライアント
+# スクショを送って結果を表示する。--bench を付けると同じ入力を繰り返し送って
+# 1秒あたりのリクエスト数を測り、--cli を付けると fgosccnt.py を毎回起動した場合と比べる
+import argparse
+import base64
+import json
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import fgosccnt
+from fgosccnt_server import DEFAULT_HOST, DEFAULT_PORT
+
+
+def post(url, body, content_type):
+    request = urllib.request.Request(
+        url, data=body, headers={"Content-Type": content_type}, method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+    except urllib.error.HTTPError as e:
+        raise SystemExit(f"{url}: {e.code} {e.read().decode(errors='replace')}") from e
+
+
+class Client:
+    def __init__(self, server, output_format):
+        self.server = server.rstrip("/")
+        self.output_format = output_format
+
+    def recognize(self, filename, data):
+        """1ファイルを /recognize に送る"""
+        query = urllib.parse.urlencode({"filename": filename, "format": self.output_format})
+        return post(
+            f"{self.server}/recognize?{query}", data, "application/octet-stream"
+        )
+
+    def batch(self, files):
+        """[(ファイル名, 内容), ...] を /batch でまとめて送る"""
+        body = json.dumps(
+            {
+                "files": [
+                    {"filename": filename, "data": base64.b64encode(data).decode()}
+                    for filename, data in files
+                ]
+            }
+        ).encode()
+        query = urllib.parse.urlencode({"format": self.output_format})
+        return post(f"{self.server}/batch?{query}", body, "application/json")
+
+
+def read_inputs(args):
+    """fgosccnt.py と同じ順序の (ファイル名, 内容) のリスト
+    ディレクトリ・存在しないファイルはサーバーに送れないので除く
+    """
+    if args.folder:
+        inputs = [x for x in Path(args.folder).glob(r"**/[!.]*")]
+    else:
+        inputs = args.filenames
+    files = []
+    for filename in fgosccnt.sort_files(inputs, args.ordering):
+        if Path(filename).is_file():
+            files.append((str(filename), Path(filename).read_bytes()))
+    return files
+
+
+def bench(name, func, requests, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for _ in executor.map(lambda _: func(), range(requests)):
+            pass
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<8} {requests:>5} requests in {elapsed:7.2f} s: "
+        f"{requests / elapsed:8.2f} req/s",
+        file=sys.stderr,
+    )
+    return requests / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Client for fgosccnt_server.py")
+    parser.add_argument("filenames", help="Input File(s)", nargs="*")
+    parser.add_argument("-f", "--folder", help="Specify by folder")
+    parser.add_argument(
+        "--ordering",
+        help="The order in which files are processed ",
+        type=fgosccnt.Ordering,
+        choices=list(fgosccnt.Ordering),
+        default=fgosccnt.Ordering.NOTSPECIFIED,
+    )
+    parser.add_argument(
+        "--server",
+        default=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}",
+        help="Default http://%s:%s" % (DEFAULT_HOST, DEFAULT_PORT),
+    )
+    parser.add_argument("--format", choices=("csv", "json"), default="csv")
+    parser.add_argument(
+        "--single",
+        action="store_true",
+        help="Send one request per file instead of one batch",
+    )
+    parser.add_argument(
+        "--bench",
+        type=int,
+        metavar="N",
+        help="Send the same request N times and report requests per second",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of concurrent requests for --bench: Default 1",
+    )
+    parser.add_argument(
+        "--cli",
+        action="store_true",
+        help="With --bench, also run fgosccnt.py once per request for comparison",
+    )
+    args = parser.parse_args(argv)
+
+    files = read_inputs(args)
+    client = Client(args.server, args.format)
+    if args.single:
+
+        def request():
+            return [client.recognize(filename, data) for filename, data in files]
+
+    else:
+
+        def request():
+            return [client.batch(files)]
+
+    if args.bench is None:
+        for body in request():
+            sys.stdout.buffer.write(body)
+        return
+
+    print(f"files per request: {len(files)}", file=sys.stderr)
+    server_rps = bench("server", request, args.bench, args.concurrency)
+    if args.cli:
+        command = [sys.executable, str(fgosccnt.basedir / "fgosccnt.py")]
+        command += [filename for filename, _ in files]
+
+        def run_cli():
+            subprocess.run(command, check=True, capture_output=True)
+
+        cli_rps = bench("cli", run_cli, args.bench, args.concurrency)
+        print(f"speedup: {server_rps / cli_rps:.1f}x", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
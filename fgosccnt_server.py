@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# fgosccnt の認識処理を常駐させるローカル HTTP サーバー
+#
+# カタログ・ローカルのアイテム画像・SVM を一度だけ読み込み、
+# スクショの内容を受け取って fgosccnt.py と同じ CSV / JSON を返す
+#
+#   POST /recognize?filename=NAME  本体: 画像ファイルの内容 (1ファイル)
+#   POST /batch                    本体: {"files": [{"filename": NAME, "data": base64}, ...]}
+#   GET  /health
+#
+# どちらの POST も ?format=csv で fgosccnt.py の出力と同じ CSV を、
+# 省略時は {"records": [...], "header": [...], "rows": [...]} の JSON を返す
+import argparse
+import base64
+import binascii
+import datetime
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import fgosccnt
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_BODY_BYTES = 256 * 1024 * 1024
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Recognizer:
+    """読み込み済みのカタログ・モデルとワーカープロセスを保持して認識する
+
+    --jobs が 2 以上のときはプロセスプールを起動したまま使い回す。
+    カタログに無いアイテムはこのプロセスで逐次処理して登録し (fgosccnt.py と同じ)、
+    その後はワーカーとキャッシュを新しいカタログで開き直す。
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.jobs = args.jobs or os.cpu_count()
+        fgosccnt.calc_dist_local()
+        fgosccnt.check_svm_files()
+        # モデルはキャッシュに無いファイルを初めて認識するときに読み込む
+        # (ワーカーはプールの起動時に読み込む)
+        self.models = fgosccnt.get_models()
+        # カタログの更新とこのプロセスでの認識・キャッシュの読み書きを保護する
+        self.lock = threading.Lock()
+        # リクエストの番号 (ScreenMemo は別のリクエストのスクショとは比べない)
+        self.requests = itertools.count()
+        self.cache = None
+        self.pool = None
+        with self.lock:
+            self.restart()
+
+    def restart(self):
+        """キャッシュとワーカーを現在のカタログで開き直す (lock を取って呼ぶ)"""
+        if self.cache is not None:
+            self.cache.close()
+        self.cache = fgosccnt.open_cache(self.args)
+        self.generation = fgosccnt.catalog_generation
+        old_pool = self.pool
+        if self.jobs > 1:
+            # スレッドから fork しないよう forkserver で起動する
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["fgosccnt"])
+            self.pool = context.Pool(
+                self.jobs,
+                initializer=fgosccnt._init_worker,
+                initargs=(
+                    self.args,
+                    fgosccnt.logger.getEffectiveLevel(),
+                    None if self.cache is None else self.cache.fingerprint,
+                ),
+            )
+        if old_pool is not None:
+            # 処理中のリクエストには最後まで結果を返す
+            old_pool.close()
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+            if self.cache is not None:
+                self.cache.close()
+                self.cache = None
+
+    def recognize(self, tasks):
+        """(ファイル名, 内容) のリストを認識して、入力順に record のリストを返す"""
+        records = []
+        run = next(self.requests)
+        while self.pool is not None and tasks:
+            try:
+                results = self.pool.imap(
+                    fgosccnt._recognize_data_in_worker,
+                    [(filename, data, run) for filename, data in tasks],
+                )
+            except ValueError:  # restart() で閉じられた
+                continue
+            for record in results:
+                if record["status"] == "new item":
+                    logger.debug("new item found: switch to sequential mode")
+                    break
+                records.append(record)
+            break
+        if len(records) < len(tasks):
+            with self.lock:
+                fgosccnt.get_screen_memo().start(run)
+                for filename, data in tasks[len(records) :]:
+                    records.append(
+                        fgosccnt.recognize_data(
+                            filename, data, self.args, self.models, self.cache
+                        )
+                    )
+                if fgosccnt.catalog_generation != self.generation:
+                    self.restart()
+        # tesseract で読む QP はリクエスト内でまとめて読む
+        if any("qp_pending" in record for record in records):
+            with self.lock:
+                fgosccnt.read_pending_qp(records, self.cache)
+        return records
+
+    def output(self, records):
+        """get_output() と同じ (fileoutput, all_list) を作る"""
+        merger = fgosccnt.OutputMerger(self.args)
+        for record in records:
+            merger.add(record)
+        return merger.fileoutput, merger.all_list
+
+
+def json_default(o):
+    if isinstance(o, datetime.datetime):
+        return o.isoformat()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+def parse_batch(body):
+    try:
+        files = json.loads(body)["files"]
+        return [(f["filename"], base64.b64decode(f["data"], validate=True)) for f in files]
+    except (ValueError, KeyError, TypeError, binascii.Error) as e:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"invalid batch: {e}") from e
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = "fgosccnt/" + fgosccnt.VERSION
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self.send_json({"error": "not found"}, HTTPStatus.NOT_FOUND)
+            return
+        recognizer = self.server.recognizer
+        self.send_json(
+            {"status": "ok", "version": fgosccnt.VERSION, "jobs": recognizer.jobs}
+        )
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            output_format = query.get("format", ["json"])[0]
+            if output_format not in ("json", "csv"):
+                raise RequestError(HTTPStatus.BAD_REQUEST, "format must be json or csv")
+            if url.path == "/recognize":
+                filename = query.get("filename", [""])[0]
+                if filename == "":
+                    raise RequestError(HTTPStatus.BAD_REQUEST, "filename is required")
+                tasks = [(filename, self.read_body())]
+            elif url.path == "/batch":
+                tasks = parse_batch(self.read_body())
+            else:
+                raise RequestError(HTTPStatus.NOT_FOUND, "not found")
+        except RequestError as e:
+            self.send_json({"error": str(e)}, e.status)
+            return
+
+        recognizer = self.server.recognizer
+        records = recognizer.recognize(tasks)
+        fileoutput, all_list = recognizer.output(records)
+        args = recognizer.args
+        if output_format == "csv":
+            stream = io.StringIO()
+            fgosccnt.write_csv(args, fileoutput, all_list, stream)
+            # fgosccnt.py の標準出力と同じく BOM 付き
+            self.send_body(
+                stream.getvalue().encode("utf_8_sig"), "text/csv; charset=utf-8"
+            )
+            return
+        header, rows = [], []
+        if all_list:
+            header, rows = fgosccnt.make_output_rows(args, fileoutput, all_list)
+        self.send_json({"records": records, "header": header, "rows": rows})
+
+    def read_body(self):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise RequestError(HTTPStatus.LENGTH_REQUIRED, "Content-Length is required")
+        try:
+            length = int(length)
+        except ValueError as e:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "invalid Content-Length") from e
+        if length > MAX_BODY_BYTES:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "request is too large")
+        return self.rfile.read(length)
+
+    def send_json(self, obj, status=HTTPStatus.OK):
+        body = json.dumps(obj, ensure_ascii=False, default=json_default).encode()
+        self.send_body(body, "application/json; charset=utf-8", status)
+
+    def send_body(self, body, content_type, status=HTTPStatus.OK):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+
+def make_server(args):
+    """args の設定で認識の準備をした ThreadingHTTPServer を返す"""
+    for ndir in [fgosccnt.Item_dir, fgosccnt.CE_dir, fgosccnt.Point_dir]:
+        if not ndir.is_dir():
+            ndir.mkdir(parents=True)
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.daemon_threads = True
+    try:
+        server.recognizer = Recognizer(args)
+    except BaseException:
+        server.server_close()
+        raise
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Local recognition server for FGO Battle Results",
+    )
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Default " + DEFAULT_HOST)
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="Default " + str(DEFAULT_PORT),
+    )
+    parser.add_argument(
+        "--lang",
+        default=fgosccnt.DEFAULT_ITEM_LANG,
+        choices=("jpn", "eng"),
+        help="Language to be used for output: Default " + fgosccnt.DEFAULT_ITEM_LANG,
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=fgosccnt.TIMEOUT,
+        help="Duplicate check interval at QP MAX (sec): Default "
+        + str(fgosccnt.TIMEOUT)
+        + " sec",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes (0: number of CPUs): Default 1",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use or update the recognition cache",
+    )
+    parser.add_argument("-l", "--loglevel", choices=("debug", "info"), default="info")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format=fgosccnt.LOG_FORMAT)
+    logger.setLevel(args.loglevel.upper())
+    fgosccnt.logger.setLevel(args.loglevel.upper())
+
+    server = make_server(args)
+    # kill でも finally でワーカーを終了させる
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    host, port = server.server_address[:2]
+    logger.info("listening on http://%s:%s/ (jobs: %s)", host, port, server.recognizer.jobs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.recognizer.close()
+
+
+if __name__ == "__main__":
+    main()
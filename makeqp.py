@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#-*- coding:utf-8 -*-
+# FGO戦利品スクショの QP の数字を読む機械学習モデルを作成
+# QP 欄の位置が検出できなかったときに固定範囲から切り出した数字を読むのに使う
+# (tesseract の代わり)
+#
+# QP の数字は旧 UI のドロップ数と同じフォントなので data/chest/input を元にし、
+# 固定範囲の二値化 (しきい値 65) で生じる字の太さ・余白の違いを加えて水増しする
+# data/qp/input/<数字>/*.png があればそれも使う
+#
+# 以下のサイトを参考にした
+# https://algorithm.joho.info/programming/python/hog-svm-classifier-py/
+
+import cv2
+import numpy as np
+from pathlib import Path
+
+qp = 'qp'                   # output model name
+sources = ['chest', 'qp']   # training data directories
+
+train = []
+label = []
+
+
+def augment(img, rng):
+    """1枚の数字画像から太さ・余白・ぼけを変えた画像を作る"""
+    imgs = [img]
+    kernel = np.ones((2, 2), np.uint8)
+    imgs.append(cv2.erode(img, kernel))
+    imgs.append(cv2.dilate(img, kernel))
+    blur = cv2.GaussianBlur(img, (3, 3), 0)
+    for th in (96, 160):
+        imgs.append(cv2.threshold(blur, th, 255, cv2.THRESH_BINARY)[1])
+    out = []
+    for im in imgs:
+        out.append(im)
+        # 切り出し位置のずれ
+        top, bottom, left, right = rng.integers(0, 3, 4)
+        out.append(cv2.copyMakeBorder(im, top, bottom, left, right,
+                                      cv2.BORDER_REPLICATE))
+    return out
+
+
+# Hog特徴の計算とラベリング
+def calc_hog(hog, dirname, win_size, rng):
+    p_label_dir = Path('data') / Path(dirname) / Path('input')
+    if not p_label_dir.is_dir():
+        return
+
+    # read image files from input directory
+    for dir in sorted(p_label_dir.iterdir()):
+        if not dir.is_dir():
+            continue
+        for file in sorted(dir.glob('*.png')):
+            img = cv2.imread(str(file), 0) #0はグレースケール
+            for im in augment(img, rng):
+                im = cv2.resize(im, (win_size))
+                train.append(hog.compute(im)) # 特徴量の格納
+                label.append(int(dir.name))
+
+
+def main():
+    # Hog特徴のパラメータ
+    win_size = (120, 60)
+    block_size = (16, 16)
+    block_stride = (4, 4)
+    cell_size = (4, 4)
+    bins = 9
+
+    # 毎回同じモデルができるように乱数を固定する
+    rng = np.random.default_rng(0)
+
+    # Hog特徴の計算とラベリング
+    hog = cv2.HOGDescriptor(win_size, block_size, block_stride, cell_size, bins)
+    for dirname in sources:
+        calc_hog(hog, dirname, win_size, rng)
+
+    # Hog特徴からSVM識別器の作成
+    svm = cv2.ml.SVM_create()
+    svm.setKernel(cv2.ml.SVM_LINEAR)
+    svm.setType(cv2.ml.SVM_C_SVC)
+    svm.setC(0.5)
+    svm.train(np.array(train), cv2.ml.ROW_SAMPLE, np.array(label, dtype=int))
+    svm.save(qp + '.xml')
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@
 import argparse
 import csv
 import enum
+import functools
 import logging
 import math
 import os
@@ -33,6 +34,7 @@ import sys
 from pathlib import Path
 
 import cv2  # type: ignore
+import numpy as np
 
 logger = logging.getLogger(__name__)
 pageinfo_basedir = Path(__file__).parent
@@ -76,6 +78,42 @@ class UnsupportedGamescreenTypeError(PageInfoError):
     pass
 
 
+class ScreenAnalysis:
+    """
+        1枚のスクリーンショットに対する前処理の結果をまとめて保持する。
+
+        グレースケール画像・左右の黒領域・所持 QP 領域は最初に使われたときに
+        一度だけ計算し、guess_pageinfo() や fgosccnt の ScreenShot など
+        同じ画像を調べる処理の間で使い回す。
+    """
+    def __init__(self, im, im_gray=None):
+        self.im = im
+        if im_gray is not None:
+            self.gray = im_gray
+        self._qp_regions = {}
+
+    @functools.cached_property
+    def gray(self):
+        return cv2.cvtColor(self.im, cv2.COLOR_BGR2GRAY)
+
+    @functools.cached_property
+    def side_black_margin(self):
+        """detect_side_black_margin() の結果 (左幅, 右幅)"""
+        return detect_side_black_margin(self.gray)
+
+    def columns(self, left, right):
+        """im[:, left:right] についての ScreenAnalysis
+        グレースケール画像は計算済みのものを切り出して使う
+        """
+        return ScreenAnalysis(self.im[:, left:right], self.gray[:, left:right])
+
+    def qp_region(self, mode=QPDetectionMode.JP.value):
+        """detect_qp_region() の結果 mode ごとに一度だけ検出する"""
+        if mode not in self._qp_regions:
+            self._qp_regions[mode] = detect_qp_region(self.im, mode, im_gray=self.gray)
+        return self._qp_regions[mode]
+
+
 def detect_side_black_margin(im_gray):
     """
         画像の左右にある黒領域を検出する。
@@ -91,19 +129,19 @@ def detect_side_black_margin(im_gray):
     # 問題が生じた。許容範囲をより厳しくすることでこの問題に対処する。
     black_ratio = 0.91
 
-    for i in range(width):
-        black_pixels = sum([pixel < black_threshold for pixel in im_gray[:, i]])
-        if black_pixels / height < black_ratio:
-            break
+    def find_margin(columns):
+        # 端から block 列ずつ黒画素の数をまとめて数え、最初に黒くない列を探す
+        block = 64
+        for start in range(0, width, block):
+            black_pixels = np.count_nonzero(columns[:, start:start + block] < black_threshold, axis=0)
+            not_black = np.flatnonzero(black_pixels / height < black_ratio)
+            if len(not_black) > 0:
+                return start + int(not_black[0])
+        # 全列が黒の場合は端から端まで走査したのと同じ値にする
+        return width - 1
 
-    left_margin = i
-
-    for j in range(width):
-        black_pixels = sum([pixel < black_threshold for pixel in im_gray[:, width - j - 1]])
-        if black_pixels / height < black_ratio:
-            break
-
-    right_margin = j
+    left_margin = find_margin(im_gray)
+    right_margin = find_margin(im_gray[:, ::-1])
 
     # 真っ黒画像の場合はマージンなしとする
     if left_margin + right_margin >= width:
@@ -153,7 +191,7 @@ def filter_contour_qp(contour, im):
     return True
 
 
-def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False, debug_image_name=None):
+def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False, debug_image_name=None, im_gray=None):
     """
         "所持 QP" 領域を検出し、その座標を返す。
 
@@ -161,6 +199,7 @@ def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False,
         つまり ((topleft_x, topleft_y), (bottomright_x, bottomright_y))
         領域が検出されなかった場合は None を返す。
         複数箇所が検出された場合は TooManyAreasDetectedError が発生する。
+        im_gray に im のグレースケール画像を渡すと変換を省略する。
     """
     # 縦横2分割して4領域に分け、左下の領域だけ使う。
     # QP の領域を調べたいならそれで十分。
@@ -172,7 +211,10 @@ def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False,
     cropped = im[int(im_h/2):im_h, 0:int(im_w/1.93)]
     cr_h, cr_w = cropped.shape[:2]
     logger.debug('cropped image size (for qp): (width, height) = (%s, %s)', cr_w, cr_h)
-    im_gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
+    if im_gray is None:
+        im_gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
+    else:
+        im_gray = im_gray[int(im_h/2):im_h, 0:int(im_w/1.93)]
     binary_threshold = 50
     _, th1 = cv2.threshold(im_gray, binary_threshold, 255, cv2.THRESH_BINARY)
     contours, _ = cv2.findContours(th1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -511,12 +553,21 @@ def guess_pageinfo(im, debug_draw_image=False, debug_image_name=None, **kwargs):
         返却値は (現ページ数, 全体ページ数, 全体行数)
         スクロールバーがない場合は全体行数の推定は不可能。その場合は
         NOSCROLL_PAGE_INFO すなわち (1, 1, 0) を返す
+        next_button に読み込み済みの next.png (カラーまたはグレースケール) を
+        渡すとファイルを読まずに済む
+        im には ScreenAnalysis も渡せる。その場合はグレースケール画像と
+        左右の黒領域を ScreenAnalysis で計算済みのものを使う
     """
+    if isinstance(im, ScreenAnalysis):
+        analysis = im
+    else:
+        analysis = ScreenAnalysis(im)
+    im = analysis.im
     im_h, im_w = im.shape[:2]
     logger.debug('image size: (width, height) = (%s, %s)', im_w, im_h)
 
-    im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-    left_margin, right_margin = detect_side_black_margin(im_gray)
+    im_gray = analysis.gray
+    left_margin, right_margin = analysis.side_black_margin
     logger.debug('side margin: (left, right) = (%s, %s)', left_margin, right_margin)
 
     # 左右に黒領域がある場合、まずこれを除去する。
@@ -541,10 +592,15 @@ def guess_pageinfo(im, debug_draw_image=False, debug_image_name=None, **kwargs):
     cropped = im[top:bottom, int(net_width*3/4):net_width]
     cr_h, cr_w = cropped.shape[:2]
     logger.debug('cropped image size (for scrollbar): (width, height) = (%s, %s)', cr_w, cr_h)
-    cropped_gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
+    cropped_gray = im_gray[top:bottom, int(net_width*3/4):net_width]
 
-    next_button = cv2.imread(str(pageinfo_basedir / "data" / "pageinfo" / "next.png"))
-    next_button_gray = cv2.cvtColor(next_button, cv2.COLOR_BGR2GRAY)
+    next_button = kwargs.get("next_button")
+    if next_button is None:
+        next_button = cv2.imread(str(pageinfo_basedir / "data" / "pageinfo" / "next.png"))
+    if next_button.ndim == 3:
+        next_button_gray = cv2.cvtColor(next_button, cv2.COLOR_BGR2GRAY)
+    else:
+        next_button_gray = next_button
     gamescreen_type = get_gamescreen_type(cropped_gray, next_button_gray)
 
     if debug_draw_image:
@@ -1,5 +1,4 @@
 import argparse
-import cv2
 from pathlib import Path
 import shutil
 import logging
@@ -8,18 +7,10 @@ import fgosccnt
 
 logger = logging.getLogger(__name__)
 
-training = Path(__file__).resolve().parent / Path("item.xml")
-train_item = Path(__file__).resolve().parent / Path("item.xml")  # アイテム下部
-train_chest = Path(__file__).resolve().parent / Path("chest.xml")  # ドロップ数
-train_card = Path(__file__).resolve().parent / Path("card.xml")  # ドロップ数
-train_dcnt = Path(__file__).resolve().parent / Path("dcnt.xml")
-
 
 def file_Assignment(args, files):
-    svm = cv2.ml.SVM_load(str(train_item))
-    svm_chest = cv2.ml.SVM_load(str(train_chest))
-    svm_card = cv2.ml.SVM_load(str(train_card))
-    svm_dcnt = cv2.ml.SVM_load(str(train_dcnt))
+    fgosccnt.check_svm_files()
+    models = fgosccnt.get_models()
 
     prev_pagenum = 0
     prev_chestnum = 0
@@ -32,10 +23,10 @@ def file_Assignment(args, files):
             img_rgb = fgosccnt.imread(filename)
             fileextention = f.suffix
             try:
+                exLogger = fgosccnt.CustomAdapter(logger, {"target": filename})
                 a = fgosccnt.ScreenShot(
-                                        args, img_rgb,
-                                        svm, svm_chest, svm_dcnt, svm_card,
-                                        fileextention,
+                                        args, img_rgb, models,
+                                        fileextention, exLogger,
                                         reward_only=True
                                         )
             except Exception:
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# 戦利品スクショの合成画像を作る
+#
+# 実際のスクショが無くても ScreenShot の処理を最後まで通して計測・確認できるよう、
+# アイテム画像と data/*/input の文字画像を ScreenShot が読む位置に並べ、
+# 画像と正解 (ドロップ数・ページ情報・アイテムの数・QP) を返す
+#
+# 位置は枠の幅が standardize_size() と同じ 1754px になる縮尺で描き、
+# 最後に指定の解像度に縮小・拡大する
+#
+#   python synthetic.py -o OUTDIR [-n 10] [--size 1920x1080] [--mode na]
+import argparse
+import functools
+import math
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import fgosccnt
+
+basedir = Path(__file__).resolve().parent
+data_dir = basedir / "data"
+
+FRAME_WIDTH = 1754  # standardize_size() の TRAINING_WIDTH
+FRAME_HEIGHT = 964
+TILE_WIDTH = 188
+TILE_HEIGHT = 206
+
+# 明るさ: get_coodinates() は 30 未満を枠とし、detect_qp_region() は 50、
+# スクロールバーは 65、アイテム枠とドロップ数は 80 (ドロップ数の線より下は 10) で二値化する
+SCENERY = 40
+PANEL = 5
+QP_BOX = 65
+WHITE = 235
+
+# classify_background() の判定に使うヒストグラムの最頻値 (HSV)
+# 背景が "zero" だと pHash の距離 30 以下でカタログのアイテムと一致してしまう
+BACKGROUND_HSV = {
+    "gold": (22, 70, 237),
+    "silver": (0, 0, 229),
+    "bronze": (12, 39, 255),
+}
+
+# 枠内の位置 (ScreenShot が固定で切り出す位置に合わせる)
+SCROLL_BAR_X = 1670  # 7列目のアイテムの右
+QP_BOX_Y = 838  # 所持 QP 欄の上端 (get_qp() の固定範囲と同じ)
+QP_BOX_HEIGHT = 76
+QP_DIGIT_HEIGHT = 44
+
+# data/card/input のラベル
+CARD_LABELS = {
+    "Quest Reward": 0,
+    "Item": 1,
+    "Point": 2,
+    "Craft Essence": 3,
+    "Exp. UP": 4,
+}
+# pageinfo.guess_lines() で行数 (4-14行) になるスクロールバーの高さの比率
+SCROLL_BAR_RATIOS = {
+    4: 0.688,
+    5: 0.556,
+    6: 0.466,
+    7: 0.404,
+    8: 0.356,
+    9: 0.325,
+    10: 0.297,
+    11: 0.272,
+    12: 0.252,
+    13: 0.232,
+    14: 0.220,
+}
+MAX_CHESTNUM = 7 * max(SCROLL_BAR_RATIOS) - 1
+
+
+@functools.cache
+def glyph(name, label):
+    """data/<name>/input/<label>/ の最初の画像 (グレースケール)"""
+    files = sorted((data_dir / name / "input" / str(label)).glob("*.png"))
+    if len(files) == 0:
+        raise FileNotFoundError(f"no glyph in data/{name}/input/{label}")
+    return cv2.imread(str(files[0]), cv2.IMREAD_GRAYSCALE)
+
+
+@functools.cache
+def card_glyph(label):
+    files = sorted((data_dir / "card" / "input" / str(label)).glob("*.png"))
+    return cv2.imread(str(files[0]))
+
+
+def page_layout(chestnum):
+    """ドロップ数から (ページ数, 行数)  1ページのときの行数は 0 (スクロールバー無し)"""
+    lines = math.ceil((chestnum + 1) / 7)
+    if lines <= 3:
+        return 1, 0
+    return math.ceil(lines / 3), lines
+
+
+def page_range(chestnum, pagenum):
+    """pagenum ページ目に表示されるドロップ (報酬 QP を含む) の範囲
+    最後のページは最後の3行を表示する
+    """
+    pages, lines = page_layout(chestnum)
+    if pagenum < pages:
+        first = (pagenum - 1) * 21
+    else:
+        first = max(lines - 3, 0) * 7
+    return first, min(first + 21, chestnum + 1)
+
+
+def make_tile(rng, background="gold"):
+    """アイテム枠の画像 (188x206)
+    明るい縁で囲み、中は乱数の図形にする。下部の文字はあとで描く
+    background は classify_background() がそう判定する色を右上に塗る
+    """
+    tile = np.empty((TILE_HEIGHT, TILE_WIDTH, 3), np.uint8)
+    tile[:] = rng.integers(110, 200, 3)
+    for _ in range(6):
+        color = [int(c) for c in rng.integers(0, 256, 3)]
+        center = [int(c) for c in rng.integers(20, 170, 2)]
+        cv2.circle(tile, center, int(rng.integers(15, 60)), color, -1)
+    hsv = np.uint8([[BACKGROUND_HSV[background]]])
+    tile[30:119, TILE_WIDTH - 25 : TILE_WIDTH - 7] = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    # 文字の下地
+    tile[140:186, 4:-4] = tile[140:186, 4:-4] // 2 + 60
+    cv2.rectangle(tile, (0, 0), (TILE_WIDTH - 1, TILE_HEIGHT - 1), (225, 225, 225), 3)
+    return tile
+
+
+def random_tiles(rng, n):
+    """新規アイテムとして登録される n 個のアイテム枠の画像
+    classify_item() でカタログのアイテムや互いに一致しないよう、
+    pHash の距離が 20 (縮小・拡大による差を見込んで 23) 以下になるものは作り直す
+    低解像度のスクショを想定して、縮小してから戻した画像の pHash も調べる
+    """
+    index = fgosccnt.get_hash_index(fgosccnt.catalog.dist_item)
+    hasher = fgosccnt.get_hasher()
+    tiles, hashes = [], []
+    while len(tiles) < n:
+        tile = make_tile(rng, rng.choice(list(BACKGROUND_HSV)))
+        small = cv2.resize(tile, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+        small = cv2.resize(small, (TILE_WIDTH, TILE_HEIGHT))
+        candidates = [fgosccnt.compute_hash(tile), fgosccnt.compute_hash(small)]
+        if len(index) > 0 and min(index.distances(h).min() for h in candidates) <= 23:
+            continue
+        if any(hasher.compare(c, h) <= 23 for c in candidates for h in hashes):
+            continue
+        tiles.append(tile)
+        hashes.append(candidates[0])
+    return tiles
+
+
+def load_tiles(dirs):
+    """dirs (item/ など) にあるアイテム画像を 188x206 にしたもの"""
+    tiles = []
+    for d in dirs:
+        for file in sorted(Path(d).glob("*.png")):
+            img = cv2.imread(str(file))
+            if img is not None:
+                tiles.append(cv2.resize(img, (TILE_WIDTH, TILE_HEIGHT)))
+    return tiles
+
+
+def paste(dst, src, left, top):
+    h, w = src.shape[:2]
+    dst[top : top + h, left : left + w] = src
+
+
+def draw_text(tile, text, base_line, margin_right, cut_width, cut_height, comma_width):
+    """Item.get_number2() などが1文字ずつ切り出す位置に data/item/input の文字を置く
+    text は "x12" や "+1400" (記号と数字)。記号の左端の x 座標を返す
+    """
+    width = tile.shape[1]
+    symbol, digits = text[0], text[1:]
+    cells = [
+        (c, width - margin_right - cut_width * (j + 1) - comma_width * int(j / 3))
+        for j, c in enumerate(reversed(digits))
+    ]
+    k = len(digits)
+    left = width - margin_right - cut_width * (k + 1) - comma_width * int((k - 1) / 3)
+    cells.append((symbol, left))
+    for c, x in cells:
+        img = cv2.resize(glyph("item", ord(c)), (cut_width, cut_height))
+        paste(tile, cv2.cvtColor(img, cv2.COLOR_GRAY2BGR), x, base_line - cut_height)
+    return left
+
+
+def draw_paren(tile, c, left, base_line):
+    img = glyph("item", ord(c))
+    img = cv2.resize(img, (img.shape[1], 20))
+    paste(tile, cv2.cvtColor(img, cv2.COLOR_GRAY2BGR), left, base_line - 24)
+
+
+def draw_drop(tile, drop):
+    """ドロップ1つ分のアイテム枠に種別と個数・ボーナスを描いたもの"""
+    tile = tile.copy()
+    card = cv2.resize(card_glyph(CARD_LABELS[drop["category"]]), (37, 12))
+    paste(tile, card, 78, 189)
+    width = tile.shape[1]
+    if drop["category"] == "Quest Reward":
+        # ボーナスが無い報酬 QP は旧仕様の位置 (get_number() の FONTSIZE_NORMAL)
+        draw_text(tile, f"+{drop['dropnum']}", 180, 15, 20, 28, 9)
+        return tile
+    margin_right = 15
+    if drop["bonus"]:
+        # detect_bonus_char4jpg2() の位置に "(+600)" を描き、個数はその左に置く
+        plus = draw_text(tile, drop["bonus"][1:-1], 179, 26, 21, 30, 5)
+        draw_paren(tile, "(", plus - 8, 179)
+        draw_paren(tile, ")", width - 24, 179)
+        margin_right = width - plus + 12
+    draw_text(tile, f"x{drop['dropnum']}", 180, margin_right, 21, 26, 5)
+    return tile
+
+
+def random_drops(rng, chestnum, tiles=None, bonus_rate=0.3):
+    """報酬 QP と chestnum 個のドロップ
+    tiles を省略するとアイテム画像も乱数で作る。同じアイテムは同じ画像を使う
+    """
+    if not tiles:
+        tiles = random_tiles(rng, min(chestnum, 12) + 1)
+    drops = [
+        {
+            "tile": tiles[0],
+            "category": "Quest Reward",
+            "dropnum": int(rng.integers(10, 100)) * 100,
+            "bonus": "",
+        }
+    ]
+    # 同じアイテムは並んで出て、ボーナスも同じ (前のドロップの値が引き継がれる)
+    bonuses = [""] * len(tiles)
+    for i in range(1, len(tiles)):
+        if rng.random() < bonus_rate:
+            bonuses[i] = f"(+{int(rng.integers(1, 1000))})"
+    for i in np.sort(rng.integers(1, len(tiles), chestnum)):
+        drops.append(
+            {
+                "tile": tiles[i],
+                "category": "Item",
+                # ボーナスがあるときは幅が足りないので2桁まで
+                "dropnum": int(rng.integers(1, 100 if bonuses[i] else 1000)),
+                "bonus": bonuses[i],
+            }
+        )
+    return drops
+
+
+def draw_digits(img, value, right, top, height):
+    """data/chest/input の数字で value を右寄せで描く (所持 QP・獲得 QP 用)"""
+    x = right
+    for j, c in enumerate(reversed(str(value))):
+        if j > 0 and j % 3 == 0:
+            x -= 10
+            cv2.rectangle(img, (x + 2, top + height - 6), (x + 6, top + height), (WHITE,) * 3, -1)
+        ink = glyph("chest", c)[1:-1, 1:-1] < 128
+        w = round(ink.shape[1] * height / ink.shape[0])
+        ink = cv2.resize(ink.astype(np.uint8), (w, height), interpolation=cv2.INTER_NEAREST)
+        x -= w + 4
+        img[top : top + height, x : x + w][ink > 0] = WHITE
+
+
+@functools.cache
+def dcnt_glyph(label):
+    """data/dcnt/input の文字を drop_count_area() の切り出しの高さ (33px) にしたもの
+    学習データは明るい線で上下に分かれた切り出しそのもので、線より上は膨張済みなので、
+    読むときの膨張で形がつぶれないよう細くしておく (5 は切れ込みがふさがりやすい)
+    """
+    digit = cv2.resize(glyph("dcnt", label), (28, 33), interpolation=cv2.INTER_NEAREST)
+    size = (3, 3) if str(label) == "5" else (2, 2)
+    digit[:17] = cv2.erode(digit, np.ones(size, np.uint8))[:17]
+    return digit
+
+
+def draw_drop_count(img, chestnum, region):
+    """ocr_dcnt() が読むドロップ数とそれを横切る明るい線
+    region は drop_count_area() が切り出す範囲 (left, top, right)
+    """
+    left, top, right = region
+    x = right - 4
+    for c in reversed(str(chestnum)):
+        # 縮小・拡大でにじんでも膨張で隣とつながらないよう間隔を空ける
+        x -= 32
+        area = img[top : top + 33, x : x + 28]
+        np.maximum(area, dcnt_glyph(c)[:, :, np.newaxis], out=area)
+    # 線より下は閾値 10 で読まれるので、パネルは十分暗くしておく
+    img[top + 17 : top + 19, left - 25 : right] = WHITE
+
+
+def scroll_bar(cr_w, cr_h, pagenum, lines):
+    """guess_pageinfo() が (pagenum, ページ数, lines) と読むスクロールバーの
+    右4分の1の切り出し内での (x, y, 幅, 高さ)
+    """
+    esr_y = round(cr_h * 0.122)  # GS_TYPE_2
+    esr_h = round(cr_h * 0.56)
+    cap = int(cr_h * 0.0122)
+    inner = SCROLL_BAR_RATIOS[lines] * esr_h
+    scrolled = min((pagenum - 1) * 3, lines - 3)
+    y = round(esr_y + scrolled / 3 * inner - cap)
+    return round(cr_w * 3 / 16), y, round(cr_h * 0.04), round(inner + cap * 2)
+
+
+def make_screen(
+    drops,
+    pagenum=1,
+    mode="jp",
+    size=(1920, 1080),
+    total_qp=123456789,
+    qp_gained=None,
+):
+    """drops (報酬 QP が先頭) の pagenum ページ目のスクショと正解
+
+    正解は ScreenShot と同じ名前の dict:
+    chestnum, pagenum, pages, lines, total_qp, qp_gained, mode と
+    items (そのページのドロップの category, dropnum, bonus)
+    """
+    chestnum = len(drops) - 1
+    if chestnum > MAX_CHESTNUM:
+        raise ValueError(f"too many drops: {chestnum}")
+    pages, lines = page_layout(chestnum)
+    if not 1 <= pagenum <= pages:
+        raise ValueError(f"pagenum must be 1-{pages}")
+    if qp_gained is None:
+        qp_gained = drops[0]["dropnum"]
+    width, height = size
+    rate = width / height
+    # これより横長だとドロップ数が枠の外に出る
+    if not 4 / 3 <= rate <= 20 / 9 + 0.001:
+        raise ValueError("aspect ratio must be 4:3 - 20:9")
+    # 枠の幅が 1754px になる縮尺の画面 (高さは枠の 1.187 倍より大きくする)
+    dw = max(math.ceil(FRAME_WIDTH * 1.12), math.ceil(1160 * rate))
+    dh = round(dw / rate)
+    x1 = (dw - FRAME_WIDTH) // 2
+    y1 = (dh - FRAME_HEIGHT) // 2
+
+    img = np.full((dh, dw, 3), SCENERY, np.uint8)
+    frame = img[y1 : y1 + FRAME_HEIGHT, x1 : x1 + FRAME_WIDTH]
+    frame[:] = PANEL
+    if mode == "na":
+        paste(frame, cv2.imread(str(data_dir / "misc" / "items_img.png")), 20, 25)
+
+    # ドロップ数 (drop_count_area() の新 UI の範囲)
+    if dw / dh > 16 / 8.96:
+        region = (dw - 495, y1 - 20, dw - 415)
+    else:
+        region = (dw - 430, y1 - 20, dw - 340)
+    draw_drop_count(img, chestnum, region)
+
+    # アイテム
+    first, last = page_range(chestnum, pagenum)
+    pts = fgosccnt.generate_booty_pts(102, 99, TILE_WIDTH, TILE_HEIGHT, 32, 21)
+    for drop, pt in zip(drops[first:last], pts):
+        paste(frame, draw_drop(drop["tile"], drop), pt[0], pt[1])
+
+    # 所持 QP 欄と、その上の獲得 QP (detect_qp_region() の条件に合わせる)
+    crop_w = int(dw / 1.93)
+    box_x = max(x1 + 60, int(crop_w * 0.12))
+    box_w = min(int(crop_w * 0.72), crop_w - 5 - box_x)
+    box_y = y1 + QP_BOX_Y
+    cv2.rectangle(
+        img, (box_x, box_y), (box_x + box_w - 1, box_y + QP_BOX_HEIGHT - 1), (QP_BOX,) * 3, -1
+    )
+    right = box_x + int(box_w * 0.96) - 8
+    top = (QP_BOX_HEIGHT - QP_DIGIT_HEIGHT) // 2
+    draw_digits(img, total_qp, right, box_y + top, QP_DIGIT_HEIGHT)
+    draw_digits(img, qp_gained, right, box_y - QP_BOX_HEIGHT + 12, QP_DIGIT_HEIGHT)
+
+    # 右4分の1: スクロールバーと次へボタン (pageinfo.guess_pageinfo())
+    if dh / dw > 0.57:
+        cut = math.ceil(int(dh - dw * 0.56) / 2)
+    else:
+        cut = 0
+    cr_left = int(dw * 3 / 4)
+    cr_w, cr_h = dw - cr_left, dh - cut * 2
+    if lines > 0:
+        x, y, w, h = scroll_bar(cr_w, cr_h, pagenum, lines)
+        if cr_w / cr_h <= 0.55:
+            # 中央線から 1/4 以内 (横長の画面では枠の右端寄りになる)
+            x = max(x1 + SCROLL_BAR_X - cr_left, cr_w // 4 + 2)
+        cv2.rectangle(
+            img, (cr_left + x, cut + y), (cr_left + x + w - 1, cut + y + h - 1), (200,) * 3, -1
+        )
+    # ボタンは縮小・拡大した後に元の大きさになるようにしておく
+    button = cv2.imread(str(data_dir / "pageinfo" / "next.png"))
+    scale = dw / width
+    button = cv2.resize(button, None, fx=scale, fy=scale)
+    bh, bw = button.shape[:2]
+    # 枠からはみ出すと枠の輪郭が変わるので、枠の中に収める
+    top = min(cut + int(cr_h * 0.8), y1 + FRAME_HEIGHT - bh - 10)
+    paste(img, button, x1 + FRAME_WIDTH - bw - 20, top)
+
+    # 拡大で暗い縁ができると枠の輪郭が変わるので INTER_CUBIC は使わない
+    interpolation = cv2.INTER_AREA if width < dw else cv2.INTER_LINEAR
+    img = cv2.resize(img, size, interpolation=interpolation)
+    truth = {
+        "chestnum": chestnum,
+        "pagenum": pagenum,
+        "pages": pages,
+        "lines": lines,
+        "total_qp": total_qp,
+        "qp_gained": qp_gained,
+        "mode": mode,
+        "items": [
+            {k: drop[k] for k in ("category", "dropnum", "bonus")}
+            for drop in drops[first:last]
+        ],
+    }
+    return img, truth
+
+
+def random_screen(
+    rng,
+    chestnum=None,
+    pagenum=None,
+    mode="jp",
+    size=(1920, 1080),
+    tiles=None,
+    bonus_rate=0.3,
+):
+    """乱数でドロップ数・ページ・QP を決めた make_screen()"""
+    if chestnum is None:
+        chestnum = int(rng.integers(1, MAX_CHESTNUM + 1))
+    drops = random_drops(rng, chestnum, tiles, bonus_rate)
+    if pagenum is None:
+        pagenum = int(rng.integers(1, page_layout(chestnum)[0] + 1))
+    total_qp = int(rng.integers(1, 2000000000))
+    return make_screen(drops, pagenum, mode, size, total_qp)
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Make synthetic FGO battle result screenshots")
+    parser.add_argument("-o", "--outdir", type=Path, required=True, help="Output folder")
+    parser.add_argument("-n", type=int, default=10, help="Number of images: Default 10")
+    parser.add_argument(
+        "--size", type=parse_size, default=(1920, 1080), help="Default 1920x1080"
+    )
+    parser.add_argument("--mode", choices=("jp", "na"), default="jp", help="Default jp")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--item-dir",
+        action="store_true",
+        help="Use images in item/ (otherwise random images)",
+    )
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    tiles = None
+    if args.item_dir:
+        tiles = load_tiles([fgosccnt.Item_dir, fgosccnt.Point_dir])
+    args.outdir.mkdir(parents=True, exist_ok=True)
+    for i in range(args.n):
+        img, truth = random_screen(rng, mode=args.mode, size=args.size, tiles=tiles)
+        name = f"{i:03}_{truth['chestnum']}_{truth['pagenum']}.png"
+        cv2.imwrite(str(args.outdir / name), img)
+        print(name, truth["pages"], truth["lines"], truth["total_qp"])
+
+
+if __name__ == "__main__":
+    main()
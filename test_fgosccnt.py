@@ -1,6 +1,21 @@
+import argparse
+import base64
+import datetime
+import io
+import json
+import pickle
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
 import pytest  # type: ignore
 
 import fgosccnt
+import pageinfo
+import synthetic
 
 
 params_check_page_mismatch = [
@@ -73,3 +88,930 @@ params_check_page_mismatch = [
 @pytest.mark.parametrize("expected, page_items, chestnum, pagenum, pages, lines", params_check_page_mismatch)
 def test_check_page_mismatch(expected, page_items, chestnum, pagenum, pages, lines):
     assert expected == fgosccnt.check_page_mismatch(page_items, chestnum, pagenum, pages, lines)
+
+
+def make_record(filename, pagenum=1, pages=1, lines=0, total_qp=100000, qp_gained=1400):
+    itemlist = [
+        {
+            "id": fgosccnt.ID_REWARD_QP,
+            "name": "クエストクリア報酬QP",
+            "dropPriority": fgosccnt.PRIORITY_REWARD_QP,
+            "dropnum": qp_gained,
+            "bonus": "",
+            "category": "Quest Reward",
+        },
+    ]
+    return {
+        "filename": filename,
+        "status": "ok",
+        "itemlist": itemlist,
+        "chestnum": 1,
+        "pagenum": pagenum,
+        "pages": pages,
+        "lines": lines,
+        "total_qp": total_qp,
+        "qp_gained": qp_gained,
+        "bunyan": False,
+        "datetime": datetime.datetime(2024, 1, 1),
+    }
+
+
+def test_output_merger_duplicate():
+    merger = fgosccnt.OutputMerger(argparse.Namespace(lang="jpn", timeout=15))
+    merger.add(make_record("a.png"))
+    merger.add(make_record("b.png"))
+    merger.add(make_record("c.png", total_qp=101400))
+    assert [o["filename"] for o in merger.fileoutput] == [
+        "a.png",
+        "b.png: duplicate",
+        "c.png",
+    ]
+    assert merger.all_list[1] == []
+
+
+def test_output_merger_missing():
+    merger = fgosccnt.OutputMerger(argparse.Namespace(lang="jpn", timeout=15))
+    merger.add({"filename": "x.txt", "status": "Not Supported"})
+    merger.add(make_record("a.png", pagenum=2, pages=2, lines=4))
+    assert [o["filename"] for o in merger.fileoutput] == [
+        "x.txt: Not Supported",
+        "missing",
+        "a.png",
+    ]
+    assert len(merger.fileoutput) == len(merger.all_list)
+
+
+def test_recognition_cache(tmp_path):
+    cache = fgosccnt.RecognitionCache(tmp_path / "cache.sqlite3", "fp", max_bytes=1500)
+    record = make_record("a.png")
+    key = cache.key(b"image data")
+    assert cache.get(key) is None
+    cache.put(key, record)
+    cached = cache.get(key)
+    assert cached == {k: v for k, v in record.items() if k != "filename"}
+
+    # 古いものから削除される
+    for i in range(10):
+        cache.put(cache.key(bytes([i])), make_record(f"{i}.png"))
+    cache.evict()
+    assert cache.get(key) is None
+    assert cache.get(cache.key(bytes([9]))) is not None
+    cache.close()
+
+
+def test_models_are_loaded_on_cache_miss(tmp_path, monkeypatch):
+    monkeypatch.setattr(fgosccnt, "calc_dist_local", lambda: None)
+    monkeypatch.setattr(fgosccnt, "cache_file", tmp_path / "cache.sqlite3")
+    calls = []
+
+    def load_all(self):
+        calls.append("load_all")
+        raise fgosccnt.ModelError("item.xml is not found")
+
+    monkeypatch.setattr(fgosccnt.ModelRegistry, "load_all", load_all)
+    args = argparse.Namespace(lang="jpn", jobs=1, no_cache=False, profile=None)
+    cached, missed = tmp_path / "a.png", tmp_path / "b.png"
+    cached.write_bytes(b"cached")
+    missed.write_bytes(b"missed")
+    cache = fgosccnt.open_cache(args)
+    cache.put(cache.key(b"cached"), make_record(str(cached)))
+    cache.close()
+
+    # キャッシュにあるファイルだけならモデルは読み込まない
+    records = list(fgosccnt.iter_records([str(cached)], args))
+    assert [r["status"] for r in records] == ["ok"]
+    assert calls == []
+    with pytest.raises(SystemExit):
+        list(fgosccnt.iter_records([str(cached), str(missed)], args))
+    assert calls == ["load_all"]
+
+
+def test_quest_index():
+    def quest(id, qp, *names):
+        drop = [{"name": name, "type": "Item"} for name in names]
+        drop.append({"name": "CE", "type": "Craft Essence"})
+        return {"id": id, "qp": qp, "drop": drop}
+
+    freequest = [
+        quest(1, 1400, "a", "b"),
+        quest(2, 1400, "a", "b"),
+        quest(3, 1400, "a", "c"),
+        quest(4, 2900, "a", "b", "d"),
+    ]
+    index = fgosccnt.QuestIndex(freequest)
+    # 後ろにあるものを優先
+    assert index.find({"a", "b", "QP(+1400)"}) is freequest[1]
+    assert index.find({"a", "QP(+1400)"}) == ""
+    assert [q["id"] for q, _ in index.supersets({"a", "QP(+1400)"}, 1400)] == [3, 2, 1]
+    assert [q["id"] for q, _ in index.supersets({"d"}, 2900)] == [4]
+    assert index.supersets({"d"}, 1400) == []
+    assert index.supersets(set(), 6400) == []
+
+
+@pytest.mark.skipif(not fgosccnt.drop_file.is_file(), reason="fgoscdata not found")
+def test_catalog_snapshot(tmp_path):
+    snapshot = tmp_path / "catalog.pickle"
+    built = fgosccnt.Catalog.load(snapshot)
+    loaded = fgosccnt.Catalog.load(snapshot)
+    assert loaded.item_name == built.item_name
+    assert loaded.dist_ce == built.dist_ce
+    assert loaded.freequest == built.freequest
+    assert loaded.quest_index.by_drops == built.quest_index.by_drops
+    index = loaded.hash_index("dist_point", "dist_item")
+    assert index.keys == built.hash_index("dist_point", "dist_item").keys
+    # __main__ として実行したときに書いたものも読めるよう、クラスを参照しない
+    assert b"QuestIndex" not in snapshot.read_bytes()
+
+    # 元ファイルと一致しないスナップショットは作り直す
+    snapshot.write_bytes(pickle.dumps(["stale"]) + pickle.dumps({}))
+    assert fgosccnt.Catalog.load(snapshot).item_type == built.item_type
+    assert fgosccnt.Catalog.load(snapshot).item_type == built.item_type
+
+
+def test_search_file_keeps_other_indexes(tmp_path, monkeypatch):
+    monkeypatch.setattr(fgosccnt, "_catalog", fgosccnt.Catalog.load(fgosccnt.catalog_snapshot_file))
+    catalog = fgosccnt.catalog
+    ce_index = fgosccnt.get_hash_index(catalog.dist_ce, index_class=fgosccnt.CE_INDEX_CLASS)
+    point_index = fgosccnt.get_hash_index(catalog.dist_point)
+    item_index = fgosccnt.get_hash_index(catalog.dist_item)
+    img = np.random.default_rng(0).integers(0, 256, (206, 188, 3), dtype=np.uint8)
+    cv2.imwrite(str(tmp_path / "local001.png"), img)
+
+    fgosccnt.search_file(tmp_path, catalog.dist_item, fgosccnt.PRIORITY_ITEM, "Item")
+    id = next(k for k, v in catalog.item_name.items() if v == "local001")
+    # ローカルのファイルが増やした辞書の索引だけ作り直す
+    assert fgosccnt.get_hash_index(catalog.dist_ce, index_class=fgosccnt.CE_INDEX_CLASS) is ce_index
+    assert fgosccnt.get_hash_index(catalog.dist_point) is point_index
+    assert fgosccnt.get_hash_index(catalog.dist_item) is not item_index
+    assert id in fgosccnt.get_hash_index(catalog.dist_item).ids
+    assert id in fgosccnt.get_hash_index(catalog.dist_point, catalog.dist_item).ids
+
+
+def test_import_is_lazy():
+    """import だけではカタログや重いモジュールを読み込まない"""
+    code = (
+        "import sys, time\n"
+        "import cv2, numpy\n"
+        "start = time.perf_counter()\n"
+        "import fgosccnt\n"
+        "elapsed = time.perf_counter() - start\n"
+        "loaded = [m for m in ('pytesseract', 'PIL') if m in sys.modules]\n"
+        "print(elapsed, fgosccnt._catalog is None, loaded)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(fgosccnt.__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed, lazy, loaded = result.stdout.split(maxsplit=2)
+    assert float(elapsed) < 0.5
+    assert lazy == "True"
+    assert loaded.strip() == "[]"
+
+
+@pytest.mark.parametrize("option", ["--help", "--version"])
+def test_help_does_not_load_catalog(monkeypatch, capsys, option):
+    def fail(*args, **kwargs):
+        raise AssertionError("catalog loaded")
+
+    monkeypatch.setattr(fgosccnt, "_catalog", None)
+    monkeypatch.setattr(fgosccnt.Catalog, "load", fail)
+    monkeypatch.setattr(fgosccnt.Catalog, "from_json", fail)
+    with pytest.raises(SystemExit) as e:
+        fgosccnt.main([option])
+    assert e.value.code == 0
+    assert fgosccnt._catalog is None
+    assert capsys.readouterr().out != ""
+
+
+def test_hog_ocr_matches_svm_predict():
+    rng = np.random.default_rng(0)
+    ocr = fgosccnt.HogOcr()
+    imgs = [rng.integers(0, 256, (28, 20), dtype=np.uint8) for _ in range(40)]
+    hog = cv2.HOGDescriptor((120, 60), (16, 16), (4, 4), (4, 4), 9)
+    expected = np.array([hog.compute(cv2.resize(img, (120, 60))) for img in imgs])
+    features = ocr.features(imgs)
+    assert np.array_equal(features, expected)
+
+    svm = cv2.ml.SVM_create()
+    svm.setKernel(cv2.ml.SVM_LINEAR)
+    svm.setType(cv2.ml.SVM_C_SVC)
+    labels = np.array([48 + k % 5 for k in range(len(imgs))], dtype=np.int32)
+    svm.train(features, cv2.ml.ROW_SAMPLE, labels)
+    noisy = features + rng.normal(0, 0.05, features.shape).astype(np.float32)
+    assert ocr.predictor(svm).linear
+    assert ocr.predict(svm, imgs) == [int(v) for v in svm.predict(features)[1][:, 0]]
+    assert ocr.predictor(svm).predict(noisy) == [
+        int(v) for v in svm.predict(noisy)[1][:, 0]
+    ]
+
+
+def test_model_registry_reports_missing_model(tmp_path, monkeypatch):
+    models = fgosccnt.ModelRegistry()
+    monkeypatch.setitem(
+        models.MODELS, "item", (tmp_path / "item.xml", "makeitem.py")
+    )
+    with pytest.raises(fgosccnt.ModelError, match="makeitem.py"):
+        models.check()
+    with pytest.raises(KeyError):
+        models.template("unknown")
+
+
+def test_model_registry_substitutes_qp_model(tmp_path, monkeypatch):
+    # qp.xml が無くても動き、"chest" の SVM で代用する
+    models = fgosccnt.ModelRegistry()
+    monkeypatch.setitem(models.MODELS, "qp", (tmp_path / "qp.xml", "makeqp.py"))
+    models.check()
+    assert models.svm("qp") is models.svm("chest")
+
+
+def test_model_registry_templates_are_read_only():
+    models = fgosccnt.ModelRegistry()
+    next_button = models.template("next")
+    # pageinfo が next.png を読んで変換したものと同じ
+    expected = cv2.cvtColor(cv2.imread(str(fgosccnt.next_img)), cv2.COLOR_BGR2GRAY)
+    assert np.array_equal(next_button, expected)
+    assert models.template("red_tea").ndim == 3
+    for name in models.TEMPLATES:
+        assert not models.template(name).flags.writeable
+    assert models.template("items") is models.template("items")
+
+
+def test_server_matches_get_output(tmp_path, monkeypatch):
+    import threading
+    import urllib.request
+
+    import fgosccnt_server
+
+    # 認識まで進まない入力だけなので、カタログ・モデルは読み込まない
+    monkeypatch.setattr(fgosccnt, "calc_dist_local", lambda: None)
+    monkeypatch.setattr(fgosccnt.ModelRegistry, "load_all", lambda self: self)
+    files = [tmp_path / "a.txt", tmp_path / "b.png"]
+    files[0].write_text("text")
+    cv2.imwrite(str(files[1]), np.zeros((10, 10, 3), dtype=np.uint8))
+
+    args = fgosccnt_server.parse_args(["--port", "0", "--no-cache"])
+    server = fgosccnt_server.make_server(args)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = "http://%s:%s" % server.server_address[:2]
+        body = json.dumps(
+            {
+                "files": [
+                    {
+                        "filename": str(f),
+                        "data": base64.b64encode(f.read_bytes()).decode(),
+                    }
+                    for f in files
+                ]
+            }
+        ).encode()
+        with urllib.request.urlopen(f"{url}/batch?format=csv", data=body) as response:
+            actual = response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.recognizer.close()
+
+    stream = io.StringIO()
+    fgosccnt.write_csv(args, *fgosccnt.get_output([str(f) for f in files], args), stream)
+    assert actual == stream.getvalue().encode("utf_8_sig")
+    assert b"a.txt: Not Supported" in actual
+
+
+@pytest.mark.skipif(not fgosccnt.drop_file.is_file(), reason="fgoscdata not found")
+def test_write_jsonl_matches_csv():
+    args = argparse.Namespace(lang="jpn", timeout=15)
+    records = [
+        make_record("a.png"),
+        make_record("b.png"),
+        make_record("c.png", pagenum=2, pages=2, total_qp=101400),
+        {"filename": "d.txt", "status": "Not Supported"},
+    ]
+    stream = io.StringIO()
+    fgosccnt.write_jsonl(args, iter(records), stream)
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(line["status"], line["missing"]) for line in lines[:-1]] == [
+        ("ok", False),
+        ("duplicate", False),
+        ("ok", True),
+        ("Not Supported", False),
+    ]
+    assert lines[0]["pagenum"] == 1 and lines[0]["datetime"] == "2024-01-01T00:00:00"
+
+    merger = fgosccnt.OutputMerger(args)
+    for record in records:
+        merger.add(record)
+    _, rows = fgosccnt.make_output_rows(args, merger.fileoutput, merger.all_list)
+    summary = lines[-1]
+    assert summary["type"] == "summary"
+    assert summary["screenshots"] == 2
+    # 報酬 QP しか無いのでクエストは決まらず、make_csv_header() のクエスト名は ""
+    # (CSV の先頭行ではその代わりに "合計" になる)
+    assert summary["quest"] == ""
+    assert rows[0]["filename"] == "合計"
+    assert summary["items"] == {
+        k: v for k, v in rows[0].items() if v != "" and k != "filename"
+    }
+
+
+def test_is_grayscale():
+    gray = np.zeros((200, 30, 3), dtype=np.uint8)
+    gray[:] = np.arange(30, dtype=np.uint8)[None, :, None]
+    assert fgosccnt.is_grayscale(gray)
+    color = gray.copy()
+    color[150, 7, 2] = 255  # 最初のブロック以外の1画素だけ色がある
+    assert not fgosccnt.is_grayscale(color)
+
+
+@pytest.mark.parametrize("size", [(2732, 2048), (2436, 1125), (1334, 750)])
+def test_get_coodinates_downscaled(size):
+    width, height = size
+    rng = np.random.default_rng(0)
+    img = rng.integers(60, 255, (height, width, 3), dtype=np.uint8)
+    frame_height = int(min((width - 40) / 1.82, height * 0.8))
+    frame_width = int(frame_height * 1.82)
+    left, top = (width - frame_width) // 2, (height - frame_height) // 2
+    # 黒帯と枠の中の暗い数字
+    img[:top] = 0
+    img[:, :left] = 0
+    for _ in range(200):
+        x = int(rng.integers(left + 20, left + frame_width * 3 // 4))
+        y = int(rng.integers(top + 60, top + frame_height - 20))
+        cv2.putText(img, "123", (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+    cv2.rectangle(
+        img, (left, top), (left + frame_width, top + frame_height), (0, 0, 0), 3
+    )
+
+    _, inv = cv2.threshold(
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), 30, 255, cv2.THRESH_BINARY_INV
+    )
+    expected = fgosccnt.find_frame(inv, height, width)
+    assert expected is not None
+    assert fgosccnt.find_frame_downscaled(inv) == expected
+    x, y, w, h = expected
+    assert fgosccnt.get_coodinates(img) == ((x, y), (x + w, y + h))
+
+
+def test_detect_side_black_margin():
+    img = np.full((100, 60), 200, dtype=np.uint8)
+    img[:, :7] = 0
+    img[:95, 52:] = 5  # 右端の列は 95% が黒
+    assert pageinfo.detect_side_black_margin(img) == (7, 8)
+    img[:, 52:] = 200
+    img[:10, 52:] = 0  # 黒が 91% 未満の列は余白にしない
+    assert pageinfo.detect_side_black_margin(img) == (7, 0)
+    assert pageinfo.detect_side_black_margin(np.zeros((10, 10), np.uint8)) == (0, 0)
+
+
+def test_screen_analysis_shares_work(monkeypatch):
+    img = np.random.default_rng(0).integers(0, 255, (90, 160, 3), dtype=np.uint8)
+    calls = []
+
+    def detect_qp_region(im, mode, im_gray=None):
+        calls.append(mode)
+        assert np.array_equal(im_gray, cv2.cvtColor(im, cv2.COLOR_BGR2GRAY))
+        return ((1, 2), (3, 4))
+
+    monkeypatch.setattr(pageinfo, "detect_qp_region", detect_qp_region)
+    analysis = pageinfo.ScreenAnalysis(img)
+    assert analysis.qp_region("jp") == analysis.qp_region("jp") == ((1, 2), (3, 4))
+    analysis.qp_region("na")
+    assert calls == ["jp", "na"]
+    sub = analysis.columns(20, 140)
+    assert np.array_equal(sub.gray, cv2.cvtColor(img[:, 20:140], cv2.COLOR_BGR2GRAY))
+
+
+def test_qp_fallback_reads_digits_without_tesseract():
+    # 固定範囲に "+1,234,567,890" を置いた画像 (明るい数字・暗い背景)
+    chest_dir = synthetic.data_dir / "chest" / "input"
+    digits = {
+        d: cv2.bitwise_not(cv2.imread(str(next((chest_dir / str(d)).glob("*.png"))), 0))
+        for d in range(10)
+    }
+    img = np.full((76, 550), 30, dtype=np.uint8)
+    x = 20
+    cv2.line(img, (x + 4, 38), (x + 24, 38), 255, 5)  # "+"
+    cv2.line(img, (x + 14, 28), (x + 14, 48), 255, 5)
+    x += 40
+    for k, c in enumerate("1234567890"):
+        glyph = cv2.resize(digits[int(c)], None, fx=1.5, fy=1.5)
+        h, w = glyph.shape
+        img[14 : 14 + h, x : x + w] = glyph
+        x += w + 4
+        if k in (0, 3, 6):
+            img[56:66, x : x + 5] = 255  # ","
+            x += 12
+    sc = fgosccnt.ScreenShot.__new__(fgosccnt.ScreenShot)
+    sc.__dict__.update(
+        img_gray=img, max_qp=2000000000, models=fgosccnt.get_models(), qp_readers={}
+    )
+    bounds = ((0, 0), (550, 76))
+    assert sc.ocr_qp_fallback(bounds) == 1234567890
+    assert sc.read_qp_fallback("total_qp", bounds) == 1234567890
+    assert sc.qp_readers == {"total_qp": "fallback"}
+    # 数字が無ければ -1
+    assert sc.ocr_qp_fallback(((0, 0), (20, 76))) == -1
+
+
+def qp_box(value, scale=1.0):
+    """synthetic と同じ QP 欄の固定範囲 (550x76) を 1/scale の画面から拡大したもの"""
+    box = np.full((76, 550, 3), synthetic.QP_BOX, np.uint8)
+    synthetic.draw_digits(box, value, 540, 16, synthetic.QP_DIGIT_HEIGHT)
+    small = cv2.resize(box, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return cv2.resize(small, (550, 76), interpolation=cv2.INTER_LINEAR)
+
+
+def qp_fallback_screenshot(img_rgb):
+    sc = fgosccnt.ScreenShot.__new__(fgosccnt.ScreenShot)
+    sc.__dict__.update(
+        img_rgb=img_rgb,
+        img_gray=cv2.cvtColor(img_rgb, cv2.COLOR_BGR2GRAY),
+        max_qp=2000000000,
+        models=fgosccnt.get_models(),
+        qp_readers={},
+        qp_pending={},
+        defer_tesseract=True,
+    )
+    return sc
+
+
+def test_qp_fallback_rejects_unreliable_reads(monkeypatch):
+    import types
+
+    monkeypatch.setitem(sys.modules, "pytesseract", types.SimpleNamespace())
+    bounds = ((0, 0), (550, 76))
+    assert qp_fallback_screenshot(qp_box(1234567)).ocr_qp_fallback(bounds) == 1234567
+    # 縮小された画面で数字がつながると桁が欠けて読めるので tesseract に回す
+    sc = qp_fallback_screenshot(qp_box(1138849738, 0.55))
+    assert sc.ocr_qp_fallback(bounds) == -1
+    assert sc.read_qp_fallback("total_qp", bounds) is None
+    assert sc.qp_readers == {"total_qp": "tesseract"}
+    assert set(sc.qp_pending) == {"total_qp"}
+    # 先頭の 0 と max_qp を超える値は QP ではない
+    img = qp_box(123)
+    synthetic.draw_digits(img, 0, 400, 16, synthetic.QP_DIGIT_HEIGHT)
+    assert qp_fallback_screenshot(img).ocr_qp_fallback(bounds) == -1
+    sc = qp_fallback_screenshot(qp_box(1999999999))
+    sc.max_qp = 999999999
+    assert sc.ocr_qp_fallback(bounds) == -1
+    # 決定値の余裕が小さい字
+    monkeypatch.setattr(fgosccnt, "QP_FALLBACK_MARGIN", 10.0)
+    assert qp_fallback_screenshot(qp_box(1234567)).ocr_qp_fallback(bounds) == -1
+
+
+@pytest.mark.skipif(shutil.which("tesseract") is None, reason="tesseract is not installed")
+def test_qp_fallback_agrees_with_tesseract():
+    pytest.importorskip("pytesseract")
+    rng = np.random.default_rng(0)
+    bounds = ((0, 0), (550, 76))
+    read = 0
+    for k in range(40):
+        value = int(rng.integers(1, 2000000000))
+        sc = qp_fallback_screenshot(qp_box(value, (1.0, 0.7, 0.55)[k % 3]))
+        qp = sc.ocr_qp_fallback(bounds)
+        if qp == -1:
+            continue
+        read += 1
+        text = sc.extract_text_from_image(sc.img_rgb)
+        assert qp == sc.get_qp_from_text(text) == value
+    assert read >= 10
+
+
+def test_read_pending_qp_in_batches(monkeypatch):
+    import types
+
+    calls = []
+    page_texts = {}
+
+    def image_to_data(page, config, output_type):
+        # 並べた画像の位置に、その画像の数字を置いたことにする
+        calls.append("batch")
+        assert "--psm 6" in config
+        words = [(top + 10, text) for top, text in page_texts.items()]
+        return {
+            "text": [text for _, text in words] + [" "],
+            "left": [5] * len(words) + [0],
+            "top": [top for top, _ in words] + [0],
+            "height": [40] * len(words) + [page.shape[0]],
+        }
+
+    def image_to_string(image, config):
+        calls.append("single")
+        return "777"
+
+    pytesseract = types.SimpleNamespace(
+        image_to_data=image_to_data,
+        image_to_string=image_to_string,
+        Output=types.SimpleNamespace(DICT="dict"),
+    )
+    monkeypatch.setitem(sys.modules, "pytesseract", pytesseract)
+
+    def pending(record, **texts):
+        images = {name: np.full((76, 550), 255, np.uint8) for name in texts}
+        record["qp_pending"] = {"images": images, "max_qp": 2000000000, "cache_key": None}
+        record.update({name: None for name in texts})
+        return texts
+
+    records = [make_record("a.png"), make_record("b.png"), make_record("c.png")]
+    texts = [
+        pending(records[1], total_qp="+12,345,678", qp_gained=""),
+        pending(records[2], total_qp="12,345,678", qp_gained="1,400"),
+    ]
+    batch = fgosccnt.TesseractBatch()
+    for t in texts:
+        for text in t.values():
+            batch.add(np.full((76, 550), 255, np.uint8))
+    _, tops = batch.page()
+    page_texts.update(
+        {top: text for top, text in zip(tops, [x for t in texts for x in t.values()]) if text}
+    )
+    records[2]["itemlist"] = []  # 獲得 QP があるのにドロップが無い
+
+    out = list(fgosccnt.read_pending_qp_in_batches(iter(records), size=8))
+    assert [r["filename"] for r in out] == ["a.png", "b.png", "c.png"]
+    # 数字が見つからなかった画像だけ1枚で読み直す
+    assert calls == ["batch", "single"]
+    assert out[0] == make_record("a.png")
+    assert (out[1]["total_qp"], out[1]["qp_gained"]) == (12345678, 777)
+    assert "qp_pending" not in out[1]
+    assert out[2] == {"filename": "c.png", "status": "not valid"}
+
+
+def test_read_pending_qp_retries_each_file(tmp_path, monkeypatch):
+    import types
+
+    calls = []
+
+    def image_to_data(page, config, output_type):
+        # 真っ黒な行を含むページは読めないことにする
+        calls.append(page.shape[0])
+        if (page == 0).all(axis=1).any():
+            raise RuntimeError("tesseract failed")
+        # 各画像の 10 行目に置いた灰色の線の位置に "12,345" があることにする
+        tops = [y - 10 for y in np.flatnonzero((page == 128).all(axis=1))]
+        return {
+            "text": ["12,345"] * len(tops),
+            "left": [5] * len(tops),
+            "top": tops,
+            "height": [40] * len(tops),
+        }
+
+    monkeypatch.setitem(
+        sys.modules,
+        "pytesseract",
+        types.SimpleNamespace(
+            image_to_data=image_to_data, Output=types.SimpleNamespace(DICT="dict")
+        ),
+    )
+    cache = fgosccnt.RecognitionCache(tmp_path / "cache.sqlite3", "fp")
+    records = []
+    for name in ("a.png", "b.png", "c.png"):
+        image = np.full((76, 550), 255, np.uint8)
+        image[10] = 0 if name == "b.png" else 128
+        record = make_record(name, total_qp=None)
+        record["qp_pending"] = {
+            "images": {"total_qp": image},
+            "max_qp": 2000000000,
+            "cache_key": cache.key(name.encode()),
+        }
+        records.append(record)
+
+    fgosccnt.read_pending_qp(records, cache)
+    # まとめて読めなかったので1ファイルずつ読み直す
+    assert len(calls) == 4
+    assert [r["total_qp"] for r in records] == [12345, -1, 12345]
+    # 読めなかったファイルはキャッシュに保存しない
+    assert cache.get(cache.key(b"a.png"))["total_qp"] == 12345
+    assert cache.get(cache.key(b"b.png")) is None
+    assert cache.get(cache.key(b"c.png")) is not None
+    cache.close()
+
+
+@pytest.mark.skipif(shutil.which("tesseract") is None, reason="tesseract is not installed")
+def test_read_pending_qp_with_tesseract():
+    pytest.importorskip("pytesseract")
+    values = [123456789, 1400, 2000000000, 5]
+    records = []
+    for k, value in enumerate(values):
+        record = make_record(f"{k}.png", total_qp=None)
+        record["qp_pending"] = {
+            "images": {"total_qp": fgosccnt.tesseract_qp_image(qp_box(value))},
+            "max_qp": 2000000000,
+            "cache_key": None,
+        }
+        records.append(record)
+    fgosccnt.read_pending_qp(records)
+    assert [r["total_qp"] for r in records] == values
+
+
+@pytest.mark.parametrize(
+    "mode, size, chestnum, pagenum",
+    [("jp", (1920, 1080), 30, 2), ("na", (1280, 720), 62, 3)],
+)
+def test_synthetic_screenshot(tmp_path, monkeypatch, mode, size, chestnum, pagenum):
+    # 合成したアイテムは新規アイテムとして一時フォルダと読み直したカタログに登録される
+    for name in ("Item_dir", "CE_dir", "Point_dir"):
+        (tmp_path / name).mkdir()
+        monkeypatch.setattr(fgosccnt, name, tmp_path / name)
+    monkeypatch.setattr(fgosccnt, "_catalog", fgosccnt.Catalog.load(fgosccnt.catalog_snapshot_file))
+    # 読み直したカタログでは新規アイテムの id が前のテストと重なる
+    fgosccnt.get_stack_cache().clear()
+    fgosccnt.get_tile_cache().clear()
+    rng = np.random.default_rng(0)
+    img, truth = synthetic.random_screen(rng, chestnum, pagenum, mode, size)
+    sc = fgosccnt.ScreenShot(
+        argparse.Namespace(lang="jpn"),
+        img,
+        fgosccnt.get_models(),
+        ".png",
+        fgosccnt.CustomAdapter(fgosccnt.logger, {"target": "synthetic"}),
+    )
+    assert (sc.chestnum, sc.pagenum, sc.pages, sc.lines) == (
+        truth["chestnum"],
+        truth["pagenum"],
+        truth["pages"],
+        truth["lines"],
+    )
+    assert (sc.total_qp, sc.qp_gained) == (truth["total_qp"], truth["qp_gained"])
+    assert [
+        {k: item[k] for k in ("category", "dropnum", "bonus")} for item in sc.itemlist
+    ] == truth["items"]
+
+
+def test_profile_report(tmp_path, monkeypatch):
+    # 使わないときは何も記録しない
+    with fgosccnt.stage("frame"):
+        fgosccnt.count_event("new_file")
+    assert fgosccnt._profile is None
+
+    report = fgosccnt.ProfileReport(tmp_path / "profile.json")
+    for name in ("a.png", "b.png"):
+        monkeypatch.setattr(fgosccnt, "_profile", fgosccnt.Profile(name))
+        with fgosccnt.stage("frame"):
+            pass
+        for _ in range(2):
+            with fgosccnt.stage("tile"):
+                fgosccnt.count_event("background_retry")
+        report.add(name, fgosccnt._profile.result())
+    report.write()
+
+    summary = json.loads((tmp_path / "profile.json").read_text(encoding="utf-8"))
+    assert summary["files"] == 2
+    assert list(summary["stages"]) == ["frame", "tile"]
+    assert summary["stages"]["tile"]["count"] == 2
+    assert summary["events"]["background_retry"] == 4
+    assert summary["events"]["new_file"] == 0
+    assert {s["filename"] for s in summary["slowest"]} == {"a.png", "b.png"}
+    trace = json.loads((tmp_path / "profile.trace.json").read_text(encoding="utf-8"))
+    # ファイルごとに file 1つと stage 3つ
+    assert len(trace["traceEvents"]) == 8
+
+
+def test_watch_folder_waits_for_stable_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(fgosccnt.time, "sleep", lambda s: None)
+    (tmp_path / "a.png").write_bytes(b"a")
+    (tmp_path / "note.txt").write_bytes(b"x")
+    groups = fgosccnt.watch_folder(tmp_path, fgosccnt.Ordering.FILENAME)
+    assert next(groups) == [tmp_path / "a.png"]
+    (tmp_path / "b.png").write_bytes(b"bb")
+    (tmp_path / "c.png").write_bytes(b"")  # 同期中
+    # b.png はサイズが2回続けて同じになってから返す
+    assert next(groups) == [tmp_path / "b.png"]
+    (tmp_path / "c.png").write_bytes(b"cc")
+    assert next(groups) == [tmp_path / "c.png"]
+
+
+@pytest.mark.skipif(not fgosccnt.drop_file.is_file(), reason="fgoscdata not found")
+def test_main_watch_leaves_sorting_to_watch_folder(tmp_path, monkeypatch):
+    def sort_files(files, ordering):
+        raise AssertionError("sorted before watching")
+
+    monkeypatch.setattr(fgosccnt, "sort_files", sort_files)
+    monkeypatch.setattr(fgosccnt, "watch_records", lambda args: iter([]))
+    output = tmp_path / "out.jsonl"
+    fgosccnt.main(
+        ["-f", str(tmp_path), "--watch", "--format", "jsonl", "-o", str(output)]
+    )
+    assert json.loads(output.read_text(encoding="utf_8"))["type"] == "summary"
+
+
+def test_watch_csv_rewrites_output(tmp_path):
+    args = argparse.Namespace(lang="jpn", timeout=15)
+    path = tmp_path / "out.csv"
+    seen = []
+
+    def records():
+        for record in [
+            make_record("a.png"),
+            make_record("b.png"),
+            make_record("c.png", total_qp=101400),
+        ]:
+            yield record
+            seen.append(path.read_text(encoding="utf_8_sig"))
+
+    fgosccnt.watch_csv(args, records(), path)
+    assert len(seen) == 3
+    assert "b.png: duplicate" not in seen[0] and "b.png: duplicate" in seen[1]
+    stream = io.StringIO()
+    merger = fgosccnt.OutputMerger(args)
+    for record in [make_record("a.png"), make_record("b.png")]:
+        merger.add(record)
+    merger.add(make_record("c.png", total_qp=101400))
+    fgosccnt.write_csv(args, merger.fileoutput, merger.all_list, stream)
+    assert path.read_text(encoding="utf_8_sig") == stream.getvalue()
+    assert not (tmp_path / "out.csv.tmp").exists()
+
+
+def test_stack_cache():
+    cache = fgosccnt.StackCache(keys=2, entries=2)
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (206, 188), dtype=np.uint8)
+    cache.add((1, "jp"), img, 150, dropnum="x3", bonus="", bonus_pts=[], font_size=0)
+    assert cache.find((1, "jp"), img)["dropnum"] == "x3"
+    # 1px ずれていてもほぼ一致すれば同じ結果
+    assert cache.find((1, "jp"), np.roll(img, 1, axis=1))["dropnum"] == "x3"
+    other = img.copy()
+    other[160:180, 100:150] = 255 - other[160:180, 100:150]  # ボーナスが変わった
+    assert cache.find((1, "jp"), other) is None
+    assert cache.find((2, "jp"), img) is None
+    # 最後に使ったのが古いキーから捨てる
+    cache.add((2, "jp"), img, 150, dropnum="x1", bonus="", bonus_pts=[], font_size=0)
+    cache.find((1, "jp"), img)
+    cache.add((3, "jp"), img, 150, dropnum="x2", bonus="", bonus_pts=[], font_size=0)
+    assert list(cache.table) == [(1, "jp"), (3, "jp")]
+
+
+def test_tile_cache():
+    cache = fgosccnt.TileCache(size=2)
+    h = np.frombuffer(bytes.fromhex("0123456789abcdef"), np.uint8).reshape(1, 8)
+    near = h.copy()
+    near[0, 0] ^= 0b111  # 距離 3
+    far = h.copy()
+    far[0, :2] ^= 0xFF
+    assert cache.find("gold", h) is None
+    cache.add("gold", h, 9401234, "Item")
+    assert cache.find("gold", h) == (9401234, "Item")
+    assert cache.find("gold", near) == (9401234, "Item")
+    assert cache.find("silver", near) is None
+    assert cache.find("gold", far) is None
+    # 似ているものがあるアイテムは覚えない
+    cache.add("gold", far, fgosccnt.ID_2ZORO_DICE, "Item")
+    cache.add("zero", far, fgosccnt.ID_QP, "Item")
+    assert cache.find("gold", far) is None and cache.find("zero", far) is None
+    # 最後に使ったのが古いものから捨てる
+    cache.add("silver", far, 9401235, "Item")
+    cache.find("gold", near)
+    cache.add("bronze", far, 9401236, "Item")
+    assert cache.find("silver", far) is None
+    assert cache.find("gold", h) == (9401234, "Item")
+
+
+def test_tile_cache_respects_drop_priority(tmp_path, monkeypatch):
+    for name in ("Item_dir", "CE_dir", "Point_dir"):
+        (tmp_path / name).mkdir()
+        monkeypatch.setattr(fgosccnt, name, tmp_path / name)
+    monkeypatch.setattr(fgosccnt, "_catalog", fgosccnt.Catalog.load(fgosccnt.catalog_snapshot_file))
+    monkeypatch.setattr(fgosccnt, "catalog_frozen", False)
+    catalog = fgosccnt.catalog
+    ce = next(id for id, p in catalog.item_dropPriority.items() if p == fgosccnt.PRIORITY_CE)
+    point = next(id for id, t in catalog.item_type.items() if t == "Point")
+    monkeypatch.setattr(fgosccnt.Item, "classify_category", lambda self: "Point")
+    monkeypatch.setattr(fgosccnt.Item, "classify_card", lambda self, img, p: point)
+    img = np.random.default_rng(0).integers(0, 256, (206, 188, 3), dtype=np.uint8)
+    tiles = fgosccnt.get_tile_cache()
+    tiles.clear()
+    tiles.add(fgosccnt.classify_background(img), fgosccnt.compute_hash(img), ce, "Craft Essence")
+    args = argparse.Namespace(lang="jpn")
+
+    item = fgosccnt.Item.__new__(fgosccnt.Item)
+    item.img_rgb = img
+    item.identify_item(args, None, fgosccnt.PRIORITY_REWARD_QP)
+    assert (item.id, item.tile_cached) == (ce, True)
+    # 前のアイテムより dropPriority が高いものは判別し直す
+    item.identify_item(args, None, fgosccnt.PRIORITY_POINT)
+    assert (item.id, item.tile_cached) == (point, False)
+
+    # カタログが増えたら覚えた結果は捨てる
+    fgosccnt.get_stack_cache().add(
+        (point, "jp"), img[:, :, 0], 150, dropnum="x1", bonus="", bonus_pts=[], font_size=0
+    )
+    item.make_new_file(img, fgosccnt.Item_dir, catalog.dist_item, fgosccnt.PRIORITY_ITEM, "Item")
+    assert len(tiles.table) == 0
+    assert len(fgosccnt.get_stack_cache().table) == 0
+
+
+def test_screen_memo_recalls_same_screen(tmp_path, monkeypatch):
+    for name in ("Item_dir", "CE_dir", "Point_dir"):
+        (tmp_path / name).mkdir()
+        monkeypatch.setattr(fgosccnt, name, tmp_path / name)
+    monkeypatch.setattr(fgosccnt, "_catalog", fgosccnt.Catalog.load(fgosccnt.catalog_snapshot_file))
+    fgosccnt.get_stack_cache().clear()
+    fgosccnt.get_tile_cache().clear()
+    rng = np.random.default_rng(0)
+    drops = synthetic.random_drops(rng, 5)
+    img, _ = synthetic.make_screen(drops, total_qp=12345678)
+    models = fgosccnt.get_models()
+    exLogger = fgosccnt.CustomAdapter(fgosccnt.logger, {"target": "synthetic"})
+    sc = fgosccnt.ScreenShot(argparse.Namespace(lang="jpn"), img, models, ".png", exLogger)
+    memo = fgosccnt.ScreenMemo()
+    memo.remember(fgosccnt.screen_fingerprint(img), sc)
+
+    # 同じ画面を撮り直したもの
+    noisy = np.clip(img.astype(int) + rng.integers(-2, 3, img.shape), 0, 255).astype(np.uint8)
+    recalled = memo.recall(noisy, fgosccnt.screen_fingerprint(noisy), models, exLogger)
+    assert recalled["itemlist"] == sc.itemlist
+    assert (recalled["total_qp"], recalled["pagenum"]) == (12345678, sc.pagenum)
+    # ドロップが同じでも所持 QP が違えば使い回さない
+    other, _ = synthetic.make_screen(drops, total_qp=12345679)
+    assert memo.recall(other, fgosccnt.screen_fingerprint(other), models, exLogger) is None
+    # 縮小画像では区別できなくてもドロップ数が違えば使い回さない
+    monkeypatch.setattr(fgosccnt, "SCREEN_FINGERPRINT_TOLERANCE", 255)
+    changed = [dict(drop) for drop in drops]
+    changed[-1]["dropnum"] += 1
+    other, _ = synthetic.make_screen(changed, total_qp=12345678)
+    assert memo.recall(other, fgosccnt.screen_fingerprint(other), models, exLogger) is None
+    assert memo.recall(noisy, fgosccnt.screen_fingerprint(noisy), models, exLogger) is not None
+    # 別の実行・リクエストになったら忘れる
+    memo.start(1)
+    assert memo.last is None
+    memo.remember(fgosccnt.screen_fingerprint(img), sc)
+    memo.start(1)
+    assert memo.last is not None
+    memo.start(2)
+    assert memo.last is None
+    # 所持 QP がカンストしていると別の戦闘でも同じなので覚えない
+    capped, _ = synthetic.make_screen(drops, total_qp=sc.max_qp)
+    sc = fgosccnt.ScreenShot(argparse.Namespace(lang="jpn"), capped, models, ".png", exLogger)
+    assert sc.total_qp == sc.max_qp
+    memo.remember(fgosccnt.screen_fingerprint(capped), sc)
+    assert memo.last is None
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "PNG"])
+@pytest.mark.parametrize("exif_ifd", [True, False])
+def test_read_exif_datetime_matches_pil(fmt, exif_ifd):
+    from PIL import Image
+
+    def pil_exif(data):
+        with Image.open(io.BytesIO(data)) as img:
+            return fgosccnt.get_exif(img)
+
+    img = Image.new("RGB", (16, 16), (200, 100, 50))
+    exif = Image.Exif()
+    if exif_ifd:
+        exif.get_ifd(fgosccnt.EXIF_TAG_EXIF_IFD)[fgosccnt.EXIF_TAG_DATETIME_ORIGINAL] = (
+            "2024:05:06 07:08:09"
+        )
+    else:
+        exif[0x0110] = "iPhone"  # Model だけ
+    for kwargs in ({"exif": exif.tobytes()}, {}):
+        stream = io.BytesIO()
+        img.save(stream, fmt, **kwargs)
+        data = stream.getvalue()
+        expected = pil_exif(data)
+        assert fgosccnt.read_exif_datetime(data) == expected
+        if kwargs and exif_ifd:
+            assert expected == datetime.datetime(2024, 5, 6, 7, 8, 9)
+        else:
+            assert expected == "NON"
+
+
+def test_read_exif_datetime_big_endian():
+    # IFD0 -> Exif IFD -> DateTimeOriginal (ビッグエンディアン)
+    text = b"2023:01:02 03:04:05\0"
+    tiff = b"MM\0*" + (8).to_bytes(4, "big")
+    tiff += (1).to_bytes(2, "big") + bytes.fromhex("8769 0004 00000001") + (26).to_bytes(4, "big")
+    tiff += bytes(4)
+    tiff += (1).to_bytes(2, "big") + bytes.fromhex("9003 0002") + len(text).to_bytes(4, "big")
+    tiff += (44).to_bytes(4, "big") + bytes(4) + text
+    assert fgosccnt.tiff_datetime_original(tiff) == "2023:01:02 03:04:05"
+
+
+def test_sort_files_by_exif(tmp_path):
+    from PIL import Image
+
+    img = Image.new("RGB", (16, 16))
+    files = []
+    for name, fmt, dt in [
+        ("a.png", "PNG", "2024:01:01 10:00:30"),
+        ("b.jpg", "JPEG", "2024:01:01 10:00:00"),
+        ("c.png", "PNG", None),
+        ("d.png", "PNG", "2024:01:01 10:00:10"),
+        ("e.jpg", "JPEG", None),
+        ("f.txt", None, None),
+    ]:
+        f = tmp_path / name
+        if fmt is None:
+            f.write_text("text")
+        else:
+            exif = Image.Exif()
+            if dt is not None:
+                exif.get_ifd(fgosccnt.EXIF_TAG_EXIF_IFD)[fgosccnt.EXIF_TAG_DATETIME_ORIGINAL] = dt
+            img.save(f, fmt, exif=exif.tobytes())
+        files.append(f)
+    ordered = fgosccnt.sort_files(files[::-1], fgosccnt.Ordering.EXIF)
+    assert [f.name for f in ordered] == ["b.jpg", "d.png", "a.png", "c.png", "e.jpg", "f.txt"]